@@ -43,6 +43,21 @@ class Config(object):
     """
     Class to represent configuration operations for a toil workflow run. 
     """
+    #The defaults of the options added since the config was first pickled into jobStores are
+    #class attributes, so that the configs unpickled from jobStores made by earlier versions,
+    #which lack them, take the defaults
+    profileJobs = None
+    profileRate = 0.0
+    resultCache = None
+    collectFiles = False
+    fuseJobs = False
+    jobCompression = "zlib"
+    fileCompression = "none"
+    fileDeduplication = False
+    #Set by the jobStore once files may have been compressed, so that they are then checked
+    #for compression as they are read, see AbstractJobStore.writeConfigToStore
+    filesCompressed = False
+    
     def __init__(self):
         #Core options
         self.jobStore = os.path.abspath("./toil")
@@ -116,6 +131,13 @@ class Config(object):
         #TODO: LOG LEVEL STRING
         setOption("workDir")
         setOption("stats")
+        setOption("profileJobs", parsingFn=lambda x : x.split(","))
+        def checkRate(x):
+            assert x >= 0 and x <= 1
+        setOption("profileRate", float, checkRate)
+        if self.profileJobs is not None or self.profileRate > 0:
+            #The profiles are reported with the stats
+            self.stats = True
         setOption("clean")
         if self.stats:
             if self.clean != "never" and self.clean is not None:
@@ -156,6 +178,12 @@ class Config(object):
                 assert(len(f.readline().rstrip()) == 32)
         setOption("sseKey", checkFn=checkSse)
         setOption("cseKey", checkFn=checkSse)
+        setOption("resultCache", parsingFn=os.path.abspath)
+        setOption("collectFiles")
+        setOption("fuseJobs")
+        setOption("jobCompression")
+        setOption("fileCompression")
+        setOption("fileDeduplication")
 
 def _addOptions(addGroupFn, config):
     #
@@ -168,7 +196,8 @@ def _addOptions(addGroupFn, config):
                       help=("Store in which to place job management files \
                       and the global accessed temporary files"
                       "(If this is a file path this needs to be globally accessible "
-                      "by all machines running jobs).\n"
+                      "by all machines running jobs, and may be followed by further paths, "
+                      "separated by commas, over which the jobs and files are spread).\n"
                       "If the store already exists and restart is false an"
                       " ExistingJobStoreException exception will be thrown."))
     addOptionFn("--workDir", dest="workDir", default=None,
@@ -176,6 +205,15 @@ def _addOptions(addGroupFn, config):
                      "Default is determined by environmental variables (TMPDIR, TEMP, TMP) via mkdtemp")
     addOptionFn("--stats", dest="stats", action="store_true", default=None,
                       help="Records statistics about the toil workflow to be used by 'toil stats'.")
+    addOptionFn("--profileJobs", dest="profileJobs", default=None,
+                help=("Comma separated list of the job classes, as named by 'toil stats', whose "
+                      "jobs are run under cProfile. The name of the class of a job, or of the "
+                      "function a job wraps, may also be given. The profiles are stored in the "
+                      "jobStore and can be examined with 'toil stats --profile'. Implies --stats."))
+    addOptionFn("--profileRate", dest="profileRate", default=None,
+                help=("The fraction of the jobs of any class, between 0 and 1, that are run "
+                      "under cProfile, as for --profileJobs. Implies --stats if non-zero. "
+                      "default=%s" % config.profileRate))
     addOptionFn("--clean", dest="clean", choices=['always', 'onError','never', 'onSuccess'], default=None,
                       help=("Determines the deletion of the jobStore upon completion of the program. "
                             "Choices: 'always', 'onError','never', 'onSuccess'. The --stats option requires "
@@ -263,6 +301,43 @@ def _addOptions(addGroupFn, config):
     addOptionFn("--cseKey", dest="cseKey", default=None,
                 help="Path to file containing 256-bit key to be used for client-side encryption on "
                 "azureJobStore. By default, no encryption is used.")
+    addOptionFn("--resultCache", dest="resultCache", default=None,
+                help=("Path to a directory, accessible by all the workers, in which to cache the "
+                      "results of jobs. A job whose pickled form and input files match an entry "
+                      "in the cache is not run again, instead its return values and output "
+                      "files are restored from the cache. The cache may be shared between "
+                      "workflows. Jobs that create successors are never cached. "
+                      "By default, no cache is used."))
+    addOptionFn("--collectFiles", dest="collectFiles", action="store_true", default=None,
+                help=("Delete each global file written by a job once the jobs it was passed to "
+                      "as an argument or as part of a promised return value have completed, "
+                      "rather than at the end of the workflow. Files that are only referred to "
+                      "in other ways, for example by IDs written into other files, must not be "
+                      "used after the job that wrote them completes. The storage used by the "
+                      "files over time is reported in the stats. default=%s" % config.collectFiles))
+    addOptionFn("--fuseJobs", dest="fuseJobs", action="store_true", default=None,
+                help=("Run each chain of jobs, in which each job is the only child of the "
+                      "previous one, its only predecessor, and requires the same resources, "
+                      "as a single job. The jobs of a chain are committed together, so if one "
+                      "fails the whole chain is retried, running again the jobs of the chain "
+                      "that succeeded. Only use this when rerunning jobs is safe. "
+                      "default=%s" % config.fuseJobs))
+    addOptionFn("--jobCompression", dest="jobCompression", default=None,
+                choices=["none", "zlib", "bz2"],
+                help=("The compression of the jobs in the jobStore, one of none, zlib, which "
+                      "is fast, or bz2, which is small. default=%s" % config.jobCompression))
+    addOptionFn("--fileCompression", dest="fileCompression", default=None,
+                choices=["none", "zlib"],
+                help=("The compression of the files in the jobStore, none or zlib. Files that "
+                      "do not compress well are stored uncompressed, and the bytes saved are "
+                      "reported in the stats. default=%s" % config.fileCompression))
+    addOptionFn("--fileDeduplication", dest="fileDeduplication", action="store_true",
+                default=None,
+                help=("Store files with the same content once in the jobStore. Each file is "
+                      "hashed as it is written, and a file whose content is already stored is "
+                      "not copied into the jobStore again. Only the file and SQLite job stores "
+                      "support deduplication, the others reject the option. default=%s" %
+                      config.fileDeduplication))
 
 def addOptions(parser, config=Config()):
     """
@@ -355,7 +430,12 @@ def loadJobStore( jobStoreString, config=None ):
 
     if jobStoreName == 'file':
         from toil.jobStores.fileJobStore import FileJobStore
-        return FileJobStore( jobStoreArgs, config=config )
+        #Any further volumes follow the path of the job store, separated by commas
+        volumes = jobStoreArgs.split( ',' )
+        return FileJobStore( volumes[ 0 ], config=config, volumes=volumes[ 1: ] )
+    elif jobStoreName == 'sqlite':
+        from toil.jobStores.sqliteJobStore import SQLiteJobStore
+        return SQLiteJobStore( jobStoreArgs, config=config )
     elif jobStoreName == 'aws':
         from toil.jobStores.awsJobStore import AWSJobStore
         region, namePrefix = jobStoreArgs.split( ':', 1 )
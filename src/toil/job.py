@@ -21,17 +21,29 @@ from argparse import ArgumentParser
 import xml.etree.cElementTree as ET
 from abc import ABCMeta, abstractmethod
 import tempfile
+import shutil
 import uuid
 import time
+import random
+import itertools
 import copy_reg
 import cPickle
+import cProfile
+import marshal
+import struct
 import logging
+import threading
+import socket
+from Queue import Queue
+from contextlib import contextmanager, closing
 
 from bd2k.util.humanize import human2bytes
 from io import BytesIO
 
 from toil.resource import ModuleDescriptor
 from toil.common import loadJobStore
+from toil.resultCache import ResultCache
+from toil.jobWrapper import ChunkedSuccessors
 
 logger = logging.getLogger( __name__ )
 
@@ -58,10 +70,21 @@ class Job(object):
         
         Memory is the maximum number of bytes of memory the job will
         require to run. Cores is the number of CPU cores required.
-        """
-        self.cores = cores
-        self.memory = human2bytes(str(memory)) if memory is not None else memory
-        self.disk = human2bytes(str(disk)) if disk is not None else disk
+        
+        Any of the requirements may instead be a promise (see Job.rv) or a callable, for
+        example a function made with functools.partial, that is evaluated when the job is
+        issued, see Job.RequirementContext. Both must be picklable.
+        """
+        #The requirements computed when the job is issued, see Job._evaluateRequirements
+        self._dynamicRequirements = {}
+        for name, requirement in (("memory", memory), ("cores", cores), ("disk", disk)):
+            if isinstance(requirement, PromisedJobReturnValue) or callable(requirement):
+                self._dynamicRequirements[name] = requirement
+        isStatic = lambda name, requirement : (requirement is not None
+                                               and name not in self._dynamicRequirements)
+        self.cores = cores if isStatic("cores", cores) else None
+        self.memory = human2bytes(str(memory)) if isStatic("memory", memory) else None
+        self.disk = human2bytes(str(disk)) if isStatic("disk", disk) else None
         #Private class variables
 
         #See Job.addChild
@@ -80,6 +103,11 @@ class Job(object):
         #See Job.rv()
         self._rvs = {}
         self._promiseJobStore = None
+        #The file store of the job while its run method is running, see Job.releaseChildren
+        self._fileStore = None
+        #See Job.releaseChildren
+        self._releasedJobs = []
+        self._releasedUpdateIDs = []
 
     def run(self, fileStore):
         """
@@ -116,6 +144,73 @@ class Job(object):
         childJob._addPredecessor(self)
         return childJob
 
+    def releaseChildren(self):
+        """
+        Commits the children added to the job so far, and their successors, to the job store
+        and tells the leader about them, so that they can be scheduled while the run method
+        of the job continues, for example to start the jobs of a fan-out before a long local
+        computation. May only be called from within the run method.
+        
+        The released children remain children of the job, so its follow-ons are only run
+        once the released children and their successors have been run. As with the other
+        successors of the job, the released children and their successors are removed from
+        the job store if the job fails, and those running are killed, though they may already
+        have been run. If the job is retried it releases them again. Released jobs can not
+        take the return values of the job, can not share successors with jobs that are not
+        released and can not be given successors once released.
+        """
+        if self._fileStore is None:
+            raise JobException("Children can only be released from within the run method of the job")
+        if len(self._children) == 0:
+            return
+        jobStore = self._fileStore.jobStore
+        jobWrapper = self._fileStore.jobWrapper
+        #Make the children the children of a job that does nothing, which is serialised
+        #as if it were a child of this job
+        releasedJob = Job()
+        for child in self._children:
+            child._directPredecessors.remove(self)
+            Job.addChild(releasedJob, child)
+        self._children = []
+        jobs = set()
+        releasedJob._dfs(jobs)
+        for job in jobs:
+            if job != releasedJob and not job._directPredecessors.issubset(jobs):
+                raise JobException("Released jobs can not share successors with jobs that are "
+                                   "not released")
+        #The released jobs share an updateID, which is recorded as one to delete, so that
+        #the leader deletes them if this job fails or is lost, see
+        #toil.leader.JobBatcher.withdrawJobs
+        updateID = str(uuid.uuid1())
+        self._releasedUpdateIDs.append(updateID)
+        jobWrapper.jobsToDelete = list(jobWrapper.jobsToDelete) + [ updateID ]
+        jobStore.update(jobWrapper)
+        releasedJobWrapper = releasedJob._createEmptyJobForJob(jobStore, updateID, 
+                                                               predecessorNumber=1)
+        releasedJob._serialiseJobGraph(releasedJobWrapper, jobStore, None, False, updateID)
+        self._releasedJobs.append((releasedJobWrapper.jobStoreID, releasedJobWrapper.memory,
+                                   releasedJobWrapper.cores, releasedJobWrapper.disk, None))
+        #Tell the leader, see toil.leader.statsAndLoggingAggregatorProcess
+        release = ET.Element("release")
+        release.attrib["predecessor"] = jobWrapper.jobStoreID
+        release.attrib["job"] = releasedJobWrapper.jobStoreID
+        jobStore.writeStatsAndLogging(ET.tostring(release))
+
+    def addChildrenFrom(self, jobs, batchSize=1000):
+        """
+        Adds the jobs yielded by the given iterable, for example a generator, as children
+        of the job. The children are released (see Job.releaseChildren) in batches of
+        batchSize jobs as they are yielded, so that the jobs of a large fan-out need not all
+        be held in memory, and so that they can be run while later jobs are still being
+        created. Any children already added are released with the first batch. May only
+        be called from within the run method.
+        """
+        for job in jobs:
+            self.addChild(job)
+            if len(self._children) >= batchSize:
+                self.releaseChildren()
+        self.releaseChildren()
+
     def addService(self, service):
         """
         Add a service of type Job.Service. The Job.Service.start() method
@@ -173,6 +268,29 @@ class Job(object):
         """
         return self.addFollowOn(JobFunctionWrappingJob(fn, *args, **kwargs))
 
+    def map(self, fn, iterable, chunkSize=1000, **kwargs):
+        """
+        Adds a child that applies the function fn to each element of iterable, in jobs each
+        given up to chunkSize elements. The jobs form a balanced tree, in which the elements
+        are split between the children of each job and the results of the children are
+        gathered by a follow-on, so that no job has more than MapJob.defaultArity children
+        or takes more than that many promises. The memory, cores and disk keyword arguments
+        are the requirements of each job of the tree.
+        
+        The elements are written to files in the job store, from which each job of the tree
+        reads only the elements it maps. If map is called from within the run method of the
+        job they are written as they are read from iterable, otherwise they are held by the
+        MapJob until it is run.
+        
+        Returns the MapJob, whose return value is the list of the results of fn, in the
+        order of the elements, unless the results are combined using MapJob.reduce.
+        """
+        if self._fileStore is None:
+            return self.addChild(MapJob(fn, list(iterable), chunkSize, **kwargs))
+        mapJob = MapJob(fn, None, chunkSize, **kwargs)
+        mapJob._writeElements(self._fileStore, iterable)
+        return self.addChild(mapJob)
+
     @staticmethod
     def wrapJobFn(fn, *args, **kwargs):
         """
@@ -376,6 +494,40 @@ class Job(object):
             self.localTempDir = localTempDir
             self.loggingMessages = []
             self.deletedJobStoreFileIDs = set()
+            #The global files read and written by the job, used by the result cache,
+            #see toil.resultCache.ResultCache
+            self.readJobStoreFileIDs = set()
+            self.writtenJobStoreFileIDs = {}
+            #The sizes of the global files written by the job, where known, reported to the
+            #leader when the collectFiles option is set, see Job._reportFileReferences
+            self.writtenFileSizes = {}
+            #The downloads of global files started by prefetchGlobalFiles, by fileStoreID
+            self._downloads = {}
+            #Queue of downloads for the threads, see _startDownload
+            self._downloadQueue = Queue()
+            self._downloadThreads = []
+            self._downloadLock = threading.Lock()
+            #Number of downloads in progress, and the time the number last became non-zero
+            self._activeDownloads = 0
+            self._downloadStartTime = None
+            #The total number of bytes downloaded and the total time during which
+            #downloads were in progress, reported in the stats
+            self.downloadedBytes = 0
+            self.downloadTime = 0.0
+            #The bytes saved by the job store compressing files before the job ran, see
+            #compressionSavedBytes
+            self._compressionSavedBytesAtStart = jobStore.compressionSavedBytes
+        
+        #The maximum number of threads used to download global files concurrently
+        maxDownloadThreads = 8
+        
+        @property
+        def compressionSavedBytes(self):
+            """
+            The number of bytes saved by the job store compressing the global files 
+            written by the job, reported in the stats, see the fileCompression option.
+            """
+            return self.jobStore.compressionSavedBytes - self._compressionSavedBytesAtStart
         
         def getLocalTempDir(self):
             """
@@ -394,7 +546,7 @@ class Job(object):
             os.close(handle)
             return tmpFile
 
-        def writeGlobalFile(self, localFileName, cleanup=False):
+        def writeGlobalFile(self, localFileName, cleanup=False, move=False):
             """
             Takes a file (as a path) and uploads it to to the global file store, returns
             an ID that can be used to retrieve the file. 
@@ -407,10 +559,21 @@ class Job(object):
             localFileName will result in undetermined behavior. The file is safely removed 
             at the end of the job by placing it in (a subdirectory) of the location returned 
             by getLocalTempDir.
+            
+            If move is True the local file is removed, which avoids copying it where the
+            job store is on the same file system.
+            
+            The ID returned is a FileID. If the collectFiles option is set the file is deleted
+            once no job or promised return value refers to it, see FileID.
             """
-            return self.jobStore.writeFile(localFileName, 
-                                           None if not cleanup else self.jobWrapper.jobStoreID)
+            size = os.path.getsize(localFileName)
+            jobStoreFileID = FileID((self.jobStore.moveFile if move else self.jobStore.writeFile)(
+                localFileName, None if not cleanup else self.jobWrapper.jobStoreID))
+            self.writtenJobStoreFileIDs[jobStoreFileID] = cleanup
+            self.writtenFileSizes[jobStoreFileID] = size
+            return jobStoreFileID
         
+        @contextmanager
         def writeGlobalFileStream(self, cleanup=False):
             """
             Similar to writeGlobalFile, but returns a context manager yielding a 
@@ -420,7 +583,16 @@ class Job(object):
             
             owner is as in writeGlobalFile.
             """
-            return self.jobStore.writeFileStream(None if not cleanup else self.jobWrapper.jobStoreID)
+            with self.jobStore.writeFileStream(None if not cleanup 
+                                               else self.jobWrapper.jobStoreID) as (fileHandle, jobStoreFileID):
+                jobStoreFileID = FileID(jobStoreFileID)
+                self.writtenJobStoreFileIDs[jobStoreFileID] = cleanup
+                yield fileHandle, jobStoreFileID
+                #Not all the job stores' file handles can tell their position
+                try:
+                    self.writtenFileSizes[jobStoreFileID] = fileHandle.tell()
+                except (AttributeError, IOError):
+                    self.writtenFileSizes[jobStoreFileID] = None
 
         def readGlobalFile(self, fileStoreID, localFilePath=None):
             """
@@ -431,23 +603,343 @@ class Job(object):
             """
             if fileStoreID in self.deletedJobStoreFileIDs:
                 raise RuntimeError("Trying to access a file in the jobStore you've deleted: %s" % fileStoreID)
+            self.readJobStoreFileIDs.add(fileStoreID)
+            if localFilePath is None and fileStoreID in self._downloads:
+                #Prefetched, see prefetchGlobalFiles
+                return self._downloads[fileStoreID].getPath()
             if localFilePath is None:
                 fd, localFilePath = tempfile.mkstemp(dir=self.getLocalTempDir())
-                self.jobStore.readFile(fileStoreID, localFilePath)
+                self.jobStore.linkFile(fileStoreID, localFilePath)
                 os.close(fd)
+            elif os.path.abspath(localFilePath).startswith(
+                    os.path.join(os.path.abspath(self.getLocalTempDir()), "")):
+                #Files in the local temp dir may share storage with the job store's copy, as
+                #they are deleted with the temp dir at the end of the job
+                self.jobStore.linkFile(fileStoreID, localFilePath)
             else:
                 self.jobStore.readFile(fileStoreID, localFilePath)
             return localFilePath
         
-        def readGlobalFileStream(self, fileStoreID):
+        def prefetchGlobalFiles(self, fileStoreIDs):
+            """
+            Hints that the global files will be read, starting their download to the local
+            temp dir in the background. A subsequent readGlobalFile for one of the files, without
+            a localFilePath, returns the path of the downloaded file, waiting for the download
+            to complete if need be. Up to maxDownloadThreads files are downloaded concurrently,
+            each thread using its own instance of the job store, and so its own connections.
+            """
+            for fileStoreID in fileStoreIDs:
+                if fileStoreID in self.deletedJobStoreFileIDs:
+                    raise RuntimeError("Trying to access a file in the jobStore you've deleted: %s" % fileStoreID)
+                if fileStoreID not in self._downloads:
+                    self._startDownload(fileStoreID)
+        
+        def readGlobalFiles(self, fileStoreIDs):
+            """
+            Reads the given global files, as readGlobalFile does without a localFilePath, but
+            downloads them concurrently, see prefetchGlobalFiles. The downloads are started when
+            this is called. Returns an iterator over tuples of the fileStoreID and local path of
+            each file, in the order in which the downloads complete.
+            """
+            fileStoreIDs = list(fileStoreIDs)
+            self.prefetchGlobalFiles(fileStoreIDs)
+            completed = Queue()
+            for fileStoreID in fileStoreIDs:
+                self._downloads[fileStoreID].notify(completed)
+            return self._readCompletedDownloads(completed, len(fileStoreIDs))
+        
+        def _readCompletedDownloads(self, completed, n):
+            """
+            Generator used by readGlobalFiles, yielding the fileStoreID and local path of each of
+            the n downloads put on the completed queue.
+            """
+            for i in xrange(n):
+                download = completed.get()
+                yield download.fileStoreID, self.readGlobalFile(download.fileStoreID)
+        
+        def _startDownload(self, fileStoreID):
+            download = _Download(fileStoreID)
+            self._downloads[fileStoreID] = download
+            self._downloadQueue.put(download)
+            if len(self._downloadThreads) < self.maxDownloadThreads:
+                thread = threading.Thread(target=self._downloadFiles)
+                thread.daemon = True
+                thread.start()
+                self._downloadThreads.append(thread)
+        
+        def _downloadFiles(self):
+            """
+            Run by the download threads, downloading files from the queue until it holds None.
+            """
+            #The connections of a job store, such as those of boto, can not be shared between
+            #threads, so each thread loads the job store again. If that fails the downloads
+            #the thread takes from the queue fail with the error, rather than never finishing
+            try:
+                jobStore = loadJobStore(self.jobStore.config.jobStore)
+                loadError = None
+            except Exception as e:
+                logger.exception("Failed to load the job store to download global files")
+                jobStore, loadError = None, e
+            while True:
+                download = self._downloadQueue.get()
+                if download is None:
+                    break
+                with self._downloadLock:
+                    if self._activeDownloads == 0:
+                        self._downloadStartTime = time.time()
+                    self._activeDownloads += 1
+                try:
+                    if loadError is not None:
+                        raise loadError
+                    fd, localFilePath = tempfile.mkstemp(dir=self.getLocalTempDir())
+                    os.close(fd)
+                    jobStore.linkFile(download.fileStoreID, localFilePath)
+                    fileSize = os.path.getsize(localFilePath)
+                except Exception as e:
+                    logger.exception("Failed to download global file %s", download.fileStoreID)
+                    download.finish(error=e)
+                    fileSize = 0
+                else:
+                    download.finish(path=localFilePath)
+                with self._downloadLock:
+                    self.downloadedBytes += fileSize
+                    self._activeDownloads -= 1
+                    if self._activeDownloads == 0:
+                        self.downloadTime += time.time() - self._downloadStartTime
+        
+        def _stopDownloads(self):
+            """
+            Waits for the outstanding downloads to complete and stops the download threads.
+            Called once the job's run method has returned.
+            """
+            for thread in self._downloadThreads:
+                self._downloadQueue.put(None)
+            for thread in self._downloadThreads:
+                thread.join()
+            self._downloadThreads = []
+        
+        def readGlobalFileStream(self, fileStoreID, memoryMap=False, seekable=False):
             """
             Similar to readGlobalFile, but returns a context manager yielding a 
             file handle which can be read from. The yielded file handle does not 
             need to and should not be closed explicitly.
+            
+            If memoryMap is True the yielded object need only support the read, readline,
+            seek and tell methods of a file, and may be a memory map of the file in the job
+            store, see toil.jobStores.abstractJobStore.AbstractJobStore.readFileMemoryMap.
+            
+            If seekable is True the file handle supports seek and tell, only the parts of the
+            file that are read being transferred from the job store.
             """
             if fileStoreID in self.deletedJobStoreFileIDs:
                 raise RuntimeError("Trying to access a file in the jobStore you've deleted: %s" % fileStoreID)
+            self.readJobStoreFileIDs.add(fileStoreID)
+            if memoryMap:
+                return self.jobStore.readFileMemoryMap(fileStoreID)
+            if seekable:
+                return self.jobStore.readSeekableFileStream(fileStoreID)
             return self.jobStore.readFileStream(fileStoreID)
+        
+        def readGlobalFileRange(self, fileStoreID, start, end):
+            """
+            Returns the content of the global file between the byte offsets start (inclusive)
+            and end (exclusive), without reading the rest of the file where the job store
+            allows it. The content is shorter than end - start if the file ends before end.
+            """
+            if fileStoreID in self.deletedJobStoreFileIDs:
+                raise RuntimeError("Trying to access a file in the jobStore you've deleted: %s" % fileStoreID)
+            self.readJobStoreFileIDs.add(fileStoreID)
+            return self.jobStore.readFileRange(fileStoreID, start, end)
+        
+        def getGlobalFileSplitPoints(self, fileStoreID, start, end, pieces=2, separator="\n"):
+            """
+            Returns a list of the offsets at which to split the range of the global file
+            between start and end into up to the given number of pieces of roughly equal size,
+            without splitting any of the records, which are terminated by separator. The
+            offsets are in ascending order, each being that of the first byte of a record
+            and strictly between start and end. Only the parts of the file around the
+            offsets are read.
+            """
+            splitPoints = []
+            for i in xrange(1, pieces):
+                #Find the first record starting at or after the ideal split point
+                position = max(start + (end - start) * i / pieces, 
+                               splitPoints[-1] + 1 if len(splitPoints) > 0 else start + 1)
+                splitPoint = self._findRecordStart(fileStoreID, position, end, separator)
+                if splitPoint is None:
+                    break
+                splitPoints.append(splitPoint)
+            return splitPoints
+        
+        def _findRecordStart(self, fileStoreID, position, end, separator):
+            """
+            Returns the offset of the first record of the global file starting at or after
+            position and before end, or None if there is no such record.
+            """
+            #The record starts after a separator, which may end at the position
+            position = max(0, position - len(separator))
+            while position < end - len(separator):
+                data = self.readGlobalFileRange(fileStoreID, position, 
+                                                min(end, position + self._splitBlockSize))
+                i = data.find(separator)
+                if i >= 0:
+                    recordStart = position + i + len(separator)
+                    return recordStart if recordStart < end else None
+                if len(data) < len(separator):
+                    break
+                #Separators may span the blocks
+                position += len(data) - len(separator) + 1
+            return None
+        
+        #The number of bytes read at a time when looking for the start of a record
+        _splitBlockSize = 1 << 16
+
+        def getGlobalFileSize(self, fileStoreID):
+            """
+            Returns the size in bytes of the global file with the given fileStoreID.
+            """
+            return self.jobStore.getFileSize(fileStoreID)
+        
+        def createGlobalStream(self):
+            """
+            Returns the ID of a new stream, through which the job can pass data to one of its
+            successors without storing it in the job store. The ID is passed to the successor,
+            which reads the data with readGlobalStream while the job writes it with
+            writeGlobalStream. For the two to run at the same time the successor must be a
+            child released with releaseChildren before the data is written, e.g.
+            
+            streamID = job.fileStore.createGlobalStream()
+            job.addChildJobFn(consume, streamID)
+            job.releaseChildren()
+            with job.fileStore.writeGlobalStream(streamID) as fileHandle:
+                fileHandle.write(...)
+            
+            If the successor has not started reading the stream within streamTimeout seconds
+            of the job starting to write it, for example because the batch system can not run
+            the two jobs at once, the data is written to the job store instead and read from it
+            by the successor.
+            
+            The data of a stream can only be read once, so a successor that fails after
+            reading streamed data can not be retried. A stream is deleted with the job.
+            """
+            return self.jobStore.getEmptyFileStoreID(self.jobWrapper.jobStoreID)
+        
+        #The number of seconds writeGlobalStream waits for the reader of a stream to connect,
+        #and for a connection to send the token of the stream
+        streamTimeout = 60
+        streamTokenTimeout = 10
+        
+        @contextmanager
+        def writeGlobalStream(self, streamID, timeout=None):
+            """
+            Returns a context manager yielding a file handle to which the data of the stream
+            with the given ID, see createGlobalStream, is written. The handle is connected to the
+            reader of the stream by a socket if the reader connects within timeout seconds,
+            defaulting to streamTimeout, otherwise it writes the data to the job store. The
+            yielded file handle does not need to and should not be closed explicitly.
+            
+            The socket listens on the address of the node, and only a connection that sends
+            the random token written with the address in the stream file is taken to be the
+            reader. The data is framed, see _StreamWriter, so that the reader fails if this
+            job fails before all the data is written.
+            """
+            #The stream file holds a header describing how to read the stream, being the
+            #address of the socket to connect to and the token, followed by the data if it
+            #is materialised, see readGlobalStream
+            token = uuid.uuid4().hex
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            connection = None
+            try:
+                listener.bind((socket.gethostbyname(socket.getfqdn()), 0))
+                listener.listen(1)
+                with self.jobStore.updateFileStream(streamID) as fileHandle:
+                    fileHandle.write("socket %s %i %s\n" % (listener.getsockname() + (token,)))
+                deadline = time.time() + (self.streamTimeout if timeout is None else timeout)
+                while connection is None and time.time() < deadline:
+                    listener.settimeout(deadline - time.time())
+                    try:
+                        connection, _ = listener.accept()
+                    except socket.timeout:
+                        break
+                    if not self._receiveToken(connection, token):
+                        logger.warn("Ignoring a connection to stream %s without its token",
+                                    streamID)
+                        connection.close()
+                        connection = None
+            finally:
+                listener.close()
+            if connection is None:
+                logger.info("The reader of stream %s did not connect, so writing it to the job "
+                            "store", streamID)
+                with self.jobStore.updateFileStream(streamID) as fileHandle:
+                    fileHandle.write("file\n")
+                    yield fileHandle
+            else:
+                with closing(connection):
+                    connection.settimeout(None)
+                    with closing(connection.makefile("wb")) as fileHandle:
+                        fileHandle = _StreamWriter(fileHandle)
+                        yield fileHandle
+                        fileHandle.end()
+                #Tell a retried reader that the data has gone
+                with self.jobStore.updateFileStream(streamID) as fileHandle:
+                    fileHandle.write("done\n")
+        
+        def _receiveToken(self, connection, token):
+            """
+            :rtype : True if the given token is the first thing sent over the connection, within
+            streamTokenTimeout seconds, see writeGlobalStream.
+            """
+            connection.settimeout(self.streamTokenTimeout)
+            data = ""
+            try:
+                while len(data) < len(token):
+                    chunk = connection.recv(len(token) - len(data))
+                    if len(chunk) == 0:
+                        return False
+                    data += chunk
+            except socket.error:
+                return False
+            return data == token
+        
+        @contextmanager
+        def readGlobalStream(self, streamID):
+            """
+            Returns a context manager yielding a file handle from which the data of the stream
+            with the given ID, see createGlobalStream, is read, waiting for the writer of the
+            stream to start writing it. Raises a RuntimeError if the data has already been read
+            or the job writing the stream has failed, including when reading data from the
+            handle that the writer failed to finish writing. The yielded file handle does not
+            need to and should not be closed explicitly.
+            """
+            with self.jobStore._watchFiles([streamID]) as waitForChange:
+                interval = self.jobStore.minPollInterval
+                while True:
+                    with self.jobStore.readFileStream(streamID) as fileHandle:
+                        header = fileHandle.readline().split()
+                        if header == ["file"]:
+                            yield fileHandle
+                            return
+                    if header == ["done"]:
+                        raise RuntimeError("The data of stream %s has already been read" % streamID)
+                    if len(header) == 4 and header[0] == "socket":
+                        try:
+                            connection = socket.create_connection((header[1], int(header[2])))
+                            connection.sendall(header[3])
+                        except socket.error:
+                            #The writer has stopped listening and is writing the data to the job
+                            #store, or has failed
+                            pass
+                        else:
+                            with closing(connection):
+                                with closing(connection.makefile("rb")) as fileHandle:
+                                    yield _StreamReader(fileHandle, streamID)
+                            return
+                    #The job is deleted if the job writing the stream fails
+                    if not self.jobStore.exists(self.jobWrapper.jobStoreID):
+                        raise RuntimeError("The job writing stream %s has failed" % streamID)
+                    waitForChange(interval)
+                    interval = min(2 * interval, self.jobStore.maxPollInterval)
 
         def deleteGlobalFile(self, fileStoreID):
             """
@@ -464,6 +956,25 @@ class Job(object):
             """
             self.loggingMessages.append(str(string))
 
+    class RequirementContext:
+        """
+        Passed to the callables given as the requirements of a job (see Job.__init__), which
+        are called by the leader when the job is issued. A callable returns the requirement, as
+        a number or, for memory and disk, a human readable string such as "4G", or None for
+        the default.
+        """
+        def __init__(self, jobStore):
+            """
+            This constructor should not be called by the user.
+            """
+            self.jobStore = jobStore
+        
+        def getGlobalFileSize(self, fileStoreID):
+            """
+            Returns the size in bytes of the global file with the given fileStoreID.
+            """
+            return self.jobStore.getFileSize(fileStoreID)
+
     class Service:
         """
         Abstract class used to define the interface to a service.
@@ -594,8 +1105,13 @@ class Job(object):
             else:
                 argToStore = returnValues[i]
             for promiseFileStoreID in self._rvs[i]:
+                with collectFileIDs(promiseFileStoreID):
+                    pickledValue = cPickle.dumps(argToStore, cPickle.HIGHEST_PROTOCOL)
                 with jobStore.updateFileStream(promiseFileStoreID) as fileHandle:
-                    cPickle.dump(argToStore, fileHandle, cPickle.HIGHEST_PROTOCOL)
+                    fileHandle.write(pickledValue)
+                #Keep the value in memory if it may be used by a job fused with this one
+                if promisedValues is not None:
+                    promisedValues[promiseFileStoreID] = pickledValue
 
     ####################################################
     #Functions associated with Job.checkJobGraphAcyclic to establish
@@ -699,6 +1215,123 @@ class Job(object):
             t2.addFollowOnJobFn(deleteFileStoreIDs, map(lambda i : i.stopFileStoreID, self._services))
             self._services = [] #Defensive
             
+    def _isNoOp(self):
+        """
+        :rtype : boolean, True if the job's run method is the no-op Job.run and no promise
+        has been made for its return value, such that it only serves to order its
+        predecessors and successors.
+        """
+        return self.__class__.run.im_func is Job.run.im_func and len(self._rvs) == 0
+        
+    def _elideNoOpJobs(self):
+        """
+        Removes the jobs that do nothing (see Job._isNoOp), other than this job, from the job
+        graph, rewiring their edges so that the order in which the remaining jobs are run is
+        unchanged, and hence saving the creation and issuing of a job that does nothing.
+        
+        Let N be such a job with predecessor P. If N has only children or only follow-ons
+        then N is replaced in the successors of P by the successors of N, keeping the type of
+        the edge from P to N. If N has a single child C and C has no follow-ons, as with an
+        encapsulated job, then the follow-ons of N are first made follow-ons of C. Otherwise N
+        is not removed if it has both children and follow-ons, as it is needed to order them.
+        N is neither removed if it has multiple predecessors and multiple successors, as the
+        rewiring would then create more edges than it saves.
+        """
+        jobs = set()
+        self._dfs(jobs)
+        for job in jobs:
+            if job == self or not job._isNoOp() or len(job._services) > 0:
+                continue
+            if len(job._children) == 1 and len(job._followOns) > 0:
+                child = job._children[0]
+                if len(child._followOns) == 0 and len(set(child._children) & set(job._followOns)) == 0:
+                    for followOn in job._followOns:
+                        followOn._directPredecessors.remove(job)
+                        followOn._directPredecessors.add(child)
+                    child._followOns = job._followOns
+                    job._followOns = []
+            if len(job._children) > 0 and len(job._followOns) > 0:
+                continue
+            successors = job._children + job._followOns
+            if len(job._directPredecessors) > 1 and len(successors) > 1:
+                continue
+            for predecessor in job._directPredecessors:
+                predecessorSuccessors = predecessor._children + predecessor._followOns
+                newSuccessors = [ successor for successor in successors 
+                                 if successor not in predecessorSuccessors ]
+                for edges in (predecessor._children, predecessor._followOns):
+                    if job in edges:
+                        i = edges.index(job)
+                        edges[i:i+1] = newSuccessors
+                for successor in newSuccessors:
+                    successor._directPredecessors.add(predecessor)
+            for successor in successors:
+                successor._directPredecessors.remove(job)
+            job._directPredecessors = set()
+            job._children = []
+            job._followOns = []
+            
+    def _isFusable(self):
+        """
+        :rtype : boolean, True if the job may be fused with its predecessor or successor
+        into a FusedJob (see Job._fuseJobChains). Jobs whose requirements are computed when
+        they are issued are not fused.
+        """
+        return len(self._dynamicRequirements) == 0
+
+    def _fuseJobChains(self, jobStore):
+        """
+        Replaces each maximal chain of jobs in the job graph, other than this job, in which each
+        job is the only child of the previous job and the previous job is the only predecessor
+        of that job, with a FusedJob that runs the jobs of the chain sequentially in a single
+        worker. The jobs of a chain must require the same resources, and all but the last must
+        have no follow-ons or services. The FusedJob takes the predecessors of the first job of
+        the chain and the successors of the last. Jobs with services are not fused.
+        """
+        def getFusableChild(job):
+            if (job == self or not job._isFusable() or len(job._children) != 1
+                or len(job._followOns) > 0 or len(job._services) > 0):
+                return None
+            child = job._children[0]
+            if (not child._isFusable() or child._directPredecessors != set((job,))
+                or len(child._services) > 0
+                or (child.memory, child.cores, child.disk) != (job.memory, job.cores, job.disk)):
+                return None
+            return child
+
+        jobs = set()
+        self._dfs(jobs)
+        fusableChildren = {}
+        for job in jobs:
+            child = getFusableChild(job)
+            if child is not None:
+                fusableChildren[job] = child
+        for head in set(fusableChildren.keys()) - set(fusableChildren.values()):
+            chain = [ head ]
+            while chain[-1] in fusableChildren:
+                chain.append(fusableChildren[chain[-1]])
+            tail = chain[-1]
+            fusedJob = FusedJob(chain, memory=head.memory, cores=head.cores, disk=head.disk)
+            #Replace the head of the chain in its predecessors
+            for predecessor in head._directPredecessors:
+                for edges in (predecessor._children, predecessor._followOns):
+                    if head in edges:
+                        edges[edges.index(head)] = fusedJob
+                fusedJob._directPredecessors.add(predecessor)
+            #Move the successors of the tail of the chain to the fused job
+            for child in tail._children:
+                child._directPredecessors.remove(tail)
+                Job.addChild(fusedJob, child)
+            for followOn in tail._followOns:
+                followOn._directPredecessors.remove(tail)
+                Job.addFollowOn(fusedJob, followOn)
+            for job in chain:
+                job._directPredecessors = set()
+                job._children = []
+                job._followOns = []
+                #Set so that promises made for the return values of the jobs can be registered
+                job._promiseJobStore = jobStore
+
     def _getHashOfJobsToUUIDs(self, jobsToUUIDs):
         """
         Creates a map of the jobs in the graph to randomly selected UUIDs.
@@ -717,15 +1350,16 @@ class Job(object):
     def _createEmptyJobForJob(self, jobStore, updateID=None, command=None,
                                  predecessorNumber=0):
         """
-        Create an empty job for the job.
+        Create an empty job for the job. The requirements computed when the job is issued
+        are left as None.
         """
+        def getRequirement(name, default):
+            value = getattr(self, name)
+            return value if value is not None or name in self._dynamicRequirements else default
         return jobStore.create(command=command,
-                               memory=(self.memory if self.memory is not None
-                                       else jobStore.config.defaultMemory),
-                               cores=(self.cores if self.cores is not None
-                                    else float(jobStore.config.defaultCores)),
-                               disk=(self.disk if self.disk is not None
-                                    else float(jobStore.config.defaultDisk)),
+                               memory=getRequirement("memory", jobStore.config.defaultMemory),
+                               cores=getRequirement("cores", float(jobStore.config.defaultCores)),
+                               disk=getRequirement("disk", float(jobStore.config.defaultDisk)),
                                updateID=updateID, predecessorNumber=predecessorNumber)
         
     def _makeJobWrappers(self, jobWrapper, jobStore, jobsToUUIDs):
@@ -739,6 +1373,12 @@ class Job(object):
                                            jobsToJobWrappers), successors)
             if len(jobs) > 0:
                 jobWrapper.stack.append(jobs)
+        #The children released while the job was running, see Job.releaseChildren
+        if len(self._releasedJobs) > 0:
+            if len(self._children) > 0:
+                jobWrapper.stack[-1] += self._releasedJobs
+            else:
+                jobWrapper.stack.append(self._releasedJobs[:])
         return jobsToJobWrappers
 
     def _makeJobWrappers2(self, jobStore, jobsToUUIDs, jobsToJobWrappers):
@@ -796,33 +1436,101 @@ class Job(object):
         self._followOns = []
         self._services = []
         self._directPredecessors = set()
+        #The requirements computed when the job is issued are pickled separately, so that
+        #the leader can evaluate them without loading the job, see Job._evaluateRequirements
+        if len(self._dynamicRequirements) > 0:
+            jobWrapper = jobsToJobWrappers[self]
+            with jobStore.writeFileStream(jobWrapper.jobStoreID) as (fileHandle, requirementsFileID):
+                with collectFileIDs(requirementsFileID):
+                    cPickle.dump(self.userModule.globalize(), fileHandle, cPickle.HIGHEST_PROTOCOL)
+                    cPickle.dump(self._dynamicRequirements, fileHandle, cPickle.HIGHEST_PROTOCOL)
+            jobWrapper.requirementsFileID = requirementsFileID
+            self._dynamicRequirements = {}
         #The pickled job is "run" as the command of the job, see worker
         #for the mechanism which unpickles the job and executes the Job.run
         #method.
         with jobStore.writeFileStream(rootJobWrapper.jobStoreID) as (fileHandle, fileStoreID):
-            cPickle.dump(self, fileHandle, cPickle.HIGHEST_PROTOCOL)
+            with collectFileIDs(fileStoreID):
+                cPickle.dump(self, fileHandle, cPickle.HIGHEST_PROTOCOL)
         jobsToJobWrappers[self].command = ' '.join( ('_toil', fileStoreID) + self.userModule.globalize())      
         #Update the status of the jobWrapper on disk
         jobStore.update(jobsToJobWrappers[self])
     
-    def _serialiseJobGraph(self, jobWrapper, jobStore, returnValues, firstJob):  
+    @classmethod
+    def _evaluateRequirements(cls, jobWrapper, jobStore):
+        """
+        Sets the requirements of the job wrapper that are computed when the job is issued,
+        which are None, by unpickling the promises and callables given for them (see
+        Job.__init__) and calling the callables. Requirements beyond the maxima given in the
+        config are reduced to the maxima. The promise files read are returned rather than
+        deleted, as they must only be deleted once the requirements have been recorded in the
+        job store, the requirements then being evaluated only once.
+
+        :rtype : set of the jobStoreFileIDs of the promise files read.
+        """
+        config = jobStore.config
+        consumedPromiseFiles = set(promiseFilesToDelete)
+        with jobStore.readFileStream(jobWrapper.requirementsFileID) as fileHandle:
+            userModule = cls._loadUserModule(ModuleDescriptor(*cPickle.load(fileHandle)))
+            requirements = cls._unpickle(userModule, fileHandle)
+        promiseFiles = promiseFilesToDelete - consumedPromiseFiles
+        promiseFilesToDelete.difference_update(promiseFiles)
+        context = Job.RequirementContext(jobStore)
+        for name, default, maximum in (("memory", config.defaultMemory, config.maxMemory),
+                                       ("cores", config.defaultCores, config.maxCores),
+                                       ("disk", config.defaultDisk, config.maxDisk)):
+            if getattr(jobWrapper, name) is not None:
+                continue
+            value = requirements.get(name)
+            if callable(value):
+                value = value(context)
+            if value is None:
+                value = default
+            elif name == "cores":
+                value = float(value)
+            elif isinstance(value, basestring):
+                value = human2bytes(value)
+            else:
+                value = int(value)
+            if value > maximum:
+                logger.warn("The %s required by job %s, %s, is reduced to the maximum of %s",
+                            name, jobWrapper.jobStoreID, value, maximum)
+                value = maximum
+            setattr(jobWrapper, name, value)
+        return promiseFiles
+
+    def _serialiseJobGraph(self, jobWrapper, jobStore, returnValues, firstJob, updateID=None):  
         """
-        Pickle the graph of jobs in the jobStore.
+        Pickle the graph of jobs in the jobStore. If updateID is given it is used as the
+        updateID of all the jobWrappers created for the successors of the job, rather than
+        a UUID per jobWrapper.
         """
         #Modify job graph to run any services correctly
         self._modifyJobGraphForServices(jobStore, jobWrapper.jobStoreID)
         #Check if the job graph has created
         #any cycles of dependencies or has multiple roots
         self.checkJobGraphForDeadlocks()
+        #Remove the jobs that do nothing but order other jobs
+        self._elideNoOpJobs()
+        #Replace chains of jobs with jobs that run the chains within a single worker
+        if jobStore.config.fuseJobs:
+            self._fuseJobChains(jobStore)
         #Create a UUIDs for each job
         jobsToUUIDs = self._getHashOfJobsToUUIDs({})
-        #Set the jobs to delete
-        jobWrapper.jobsToDelete = list(jobsToUUIDs.values())
+        if updateID is not None:
+            jobsToUUIDs = dict.fromkeys(jobsToUUIDs.keys(), updateID)
+        #Set the jobs to delete, including any released while the job was running
+        jobWrapper.jobsToDelete = list(set(jobsToUUIDs.values()) | set(jobWrapper.jobsToDelete)
+                                       | set(self._releasedUpdateIDs))
         #Update the job on disk. The jobs to delete is a record of what to
         #remove if the update goes wrong
         jobStore.update(jobWrapper)
         #Create the jobWrappers for followOns/children
-        jobsToJobWrappers = self._makeJobWrappers(jobWrapper, jobStore, jobsToUUIDs)
+        with jobStore.batch():
+            jobsToJobWrappers = self._makeJobWrappers(jobWrapper, jobStore, jobsToUUIDs)
+            #Store any very long lists of successors in separate files, see ChunkedSuccessors
+            for jobWrapper2 in jobsToJobWrappers.values():
+                ChunkedSuccessors.chunkStack(jobStore, jobWrapper2)
         #Get an ordering on the jobs which we use for pickling the jobs in the 
         #correct order to ensure the promises are properly established
         ordering = self.getTopologicalOrderingOfJobs()
@@ -884,27 +1592,136 @@ class Job(object):
         if stats != None:
             startTime = time.time()
             startClock = getTotalCpuTime()
+            profiler = self._startProfiler(jobStore.config)
         baseDir = os.getcwd()
+        #The ID of the file holding the pickled job, which is released once the job completes
+        pickleFileID = jobWrapper.command.split()[1]
         #Run the job, first cleanup then run.
         fileStore = Job.FileStore(jobStore, jobWrapper, localTempDir)
-        returnValues = self.run(fileStore)
+        returnValues, cacheStatus = self._runMemoised(fileStore)
         #Serialize the new jobs defined by the run method to the jobStore
         self._serialiseJobGraph(jobWrapper, jobStore, returnValues, False)
+        if jobStore.config.collectFiles:
+            self._reportFileReferences(jobWrapper, jobStore, pickleFileID, fileStore)
+        heldFileIDs.clear()
         #Change dir back to cwd dir, if changed by job (this is a safety issue)
         if os.getcwd() != baseDir:
             os.chdir(baseDir)
         #Finish up the stats
         if stats != None:
-            stats = ET.SubElement(stats, "job")
-            stats.attrib["time"] = str(time.time() - startTime)
-            totalCpuTime, totalMemoryUsage = getTotalCpuTimeAndMemoryUsage()
-            stats.attrib["clock"] = str(totalCpuTime - startClock)
-            stats.attrib["class"] = self._jobName()
-            stats.attrib["memory"] = str(totalMemoryUsage)
+            self._addStats(stats, startTime, startClock, cacheStatus, fileStore, profiler)
         #Return any logToMaster logging messages + the files that should be deleted
         #from the job store once the job has been registered as complete
         return fileStore.loggingMessages, fileStore.deletedJobStoreFileIDs.union(promiseFilesToDelete)
 
+    def _reportFileReferences(self, jobWrapper, jobStore, pickleFileID, fileStore):
+        """
+        Tells the leader which global files the job wrote, which files are referred to by the
+        pickled jobs and promised return values the job created, and which pickled jobs and
+        promised return values the job has finished with, so that files no longer referred to
+        can be deleted, see toil.leader.FileCollector. Must be called once the job has been
+        committed to the job store.
+        """
+        references = ET.Element("references")
+        references.attrib["job"] = jobWrapper.jobStoreID
+        for jobStoreFileID, size in fileStore.writtenFileSizes.iteritems():
+            write = ET.SubElement(references, "write")
+            write.attrib["file"] = jobStoreFileID
+            if size is not None:
+                write.attrib["size"] = str(size)
+        for holder, jobStoreFileIDs in heldFileIDs.iteritems():
+            for jobStoreFileID in jobStoreFileIDs:
+                ET.SubElement(references, "hold", { "holder":holder, "file":jobStoreFileID })
+        releasedHolders = set([ pickleFileID ]) | promiseFilesToDelete
+        if jobWrapper.requirementsFileID is not None:
+            releasedHolders.add(jobWrapper.requirementsFileID)
+        for holder in releasedHolders:
+            ET.SubElement(references, "release", { "holder":holder })
+        for jobStoreFileID in fileStore.deletedJobStoreFileIDs:
+            ET.SubElement(references, "delete", { "file":jobStoreFileID })
+        jobStore.writeStatsAndLogging(ET.tostring(references))
+
+    def _runMemoised(self, fileStore):
+        """
+        Runs the job's run method, or restores its results from the result cache if one is in
+        use and it holds them.
+
+        :rtype : tuple of the return values of the run method and of the status of the job
+        in the result cache, either "hit", "miss" or None if the result cache is not used.
+        """
+        jobStore = fileStore.jobStore
+        #If a result cache is in use, try to get the result of the run method from it
+        resultCache = None
+        cachedResult = None
+        if jobStore.config.resultCache is not None and self._isMemoisable():
+            resultCache = ResultCache(jobStore.config.resultCache)
+            cacheKey, keyedFileIDs = resultCache.getKey(self, jobStore)
+            cachedResult = resultCache.lookup(cacheKey, jobStore)
+        if cachedResult is not None:
+            logger.debug("Found the result of job %s in the result cache", self._jobName())
+            return resultCache.restore(cachedResult, self, fileStore), "hit"
+        self._fileStore = fileStore
+        try:
+            returnValues = self.run(fileStore)
+        finally:
+            self._fileStore = None
+            fileStore._stopDownloads()
+        if resultCache is None:
+            return returnValues, None
+        #Jobs that create successors are not cached, as we could not skip their run method
+        if (len(self._children) == 0 and len(self._followOns) == 0 and len(self._services) == 0
+            and len(self._releasedJobs) == 0):
+            resultCache.store(cacheKey, jobStore, 
+                              readFiles=fileStore.readJobStoreFileIDs - keyedFileIDs,
+                              writtenFiles=fileStore.writtenJobStoreFileIDs,
+                              deletedFiles=fileStore.deletedJobStoreFileIDs,
+                              returnValues=returnValues,
+                              loggingMessages=fileStore.loggingMessages)
+        return returnValues, "miss"
+
+    def _startProfiler(self, config):
+        """
+        Starts and returns a profiler if the job is to be profiled, that is if its name in the
+        stats, or the last component of the name, which is the name of the class or of the
+        wrapped function, is one of those given by the profileJobs option, or if it is picked
+        at the rate given by the profileRate option. Otherwise returns None.
+        """
+        jobName = self._jobName()
+        if ((config.profileJobs is not None and (jobName in config.profileJobs or
+                                                 jobName.split(".")[-1] in config.profileJobs))
+            or random.random() < config.profileRate):
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        return None
+
+    def _addStats(self, stats, startTime, startClock, cacheStatus, fileStore, profiler=None):
+        """
+        Adds an element recording the time and memory used to run the job to the given stats
+        element. If a profiler is given it is stopped and the profile is written to a file in
+        the job store, whose ID is recorded in the element, see toil.utils.toilStats.
+        """
+        if profiler is not None:
+            profiler.disable()
+            profiler.create_stats()
+            with fileStore.jobStore.writeFileStream() as (fileHandle, profileFileID):
+                fileHandle.write(marshal.dumps(profiler.stats))
+        stats = ET.SubElement(stats, "job")
+        stats.attrib["time"] = str(time.time() - startTime)
+        totalCpuTime, totalMemoryUsage = getTotalCpuTimeAndMemoryUsage()
+        stats.attrib["clock"] = str(totalCpuTime - startClock)
+        stats.attrib["class"] = self._jobName()
+        stats.attrib["memory"] = str(totalMemoryUsage)
+        if cacheStatus is not None:
+            stats.attrib["cache"] = cacheStatus
+        if fileStore.downloadedBytes > 0:
+            stats.attrib["downloaded_bytes"] = str(fileStore.downloadedBytes)
+            stats.attrib["download_time"] = str(fileStore.downloadTime)
+        if fileStore.compressionSavedBytes > 0:
+            stats.attrib["compression_saved_bytes"] = str(fileStore.compressionSavedBytes)
+        if profiler is not None:
+            stats.attrib["profile"] = profileFileID
+
     ####################################################
     #Method used to resolve the module in which an inherited job instances
     #class is defined
@@ -940,6 +1757,13 @@ class Job(object):
         """
         return self.__class__.__name__
 
+    def _isMemoisable(self):
+        """
+        :rtype : boolean, True if the results of the job may be stored in and
+        retrieved from the result cache (see toil.resultCache.ResultCache).
+        """
+        return True
+
 class JobGraphDeadlockException( Exception ):
     def __init__( self, string ):
         super( JobGraphDeadlockException, self ).__init__( string )
@@ -1000,6 +1824,302 @@ class JobFunctionWrappingJob(FunctionWrappingJob):
         rValue = userFunction(*((self,) + tuple(self._args)), **self._kwargs)
         return rValue
 
+class MapJob(Job):
+    """
+    Job that applies a function to each element of a list, see Job.map. A list longer than
+    the chunk size is split between up to arity child MapJobs, whose results are combined by
+    a GatherJob that is made a follow-on of the job, and whose return value becomes the
+    return value of the job. The functions are recorded by name, as in FunctionWrappingJob.
+    
+    The elements are given either as a list, or as a range of the elements written to the
+    job store by _writeElements, which is how they are passed to the children.
+    """
+    #The number of children of each job of the tree, unless given to MapJob.reduce
+    defaultArity = 10
+    
+    def __init__(self, fn, elements, chunkSize, memory=None, cores=None, disk=None):
+        Job.__init__(self, memory=memory, cores=cores, disk=disk)
+        if chunkSize < 1:
+            raise JobException("The chunk size must be at least 1")
+        self._fn = _describeFunction(fn) if fn is not None else None
+        self._elements = elements
+        #The IDs of the files holding the elements and their offsets, and the range of the
+        #elements to map, if the elements are not given as a list
+        self._elementFileIDs = None
+        self._start = None
+        self._end = None
+        self._chunkSize = chunkSize
+        self._reduceFn = None
+        self._arity = self.defaultArity
+
+    def reduce(self, fn, arity=2):
+        """
+        Combines the results of the map using the function fn, which is called with a list of
+        values and returns their combination, so the return value of the job is a single
+        value, or None if there are no elements. The values are the results of the map for
+        a chunk of elements or the combinations of up to arity such lists, so fn must be
+        associative. Each job of the tree has up to arity children. Must be called before
+        the job is run. Returns the job.
+        """
+        if arity < 2:
+            raise JobException("The arity of a reduction must be at least 2")
+        self._reduceFn = _describeFunction(fn)
+        self._arity = arity
+        return self
+
+    def run(self, fileStore):
+        fn = _loadFunction(self, self._fn)
+        if self._elements is not None:
+            if len(self._elements) <= self._chunkSize:
+                return GatherJob.combine(self, self._reduceFn, map(fn, self._elements),
+                                         isMapped=True)
+            self._writeElements(fileStore, self._elements)
+        n = self._end - self._start
+        if n <= self._chunkSize:
+            return GatherJob.combine(self, self._reduceFn, map(fn, self._readElements(fileStore)),
+                                     isMapped=True)
+        #Split the elements evenly between the children
+        parts = min(self._arity, (n + self._chunkSize - 1) // self._chunkSize)
+        promises = []
+        for i in xrange(parts):
+            child = MapJob(None, None, self._chunkSize,
+                           memory=self.memory, cores=self.cores, disk=self.disk)
+            child._fn = self._fn
+            child._elementFileIDs = self._elementFileIDs
+            child._start = self._start + n * i // parts
+            child._end = self._start + n * (i + 1) // parts
+            child._reduceFn = self._reduceFn
+            child._arity = self._arity
+            promises.append(self.addChild(child).rv())
+        gatherJob = GatherJob(self._reduceFn, promises,
+                              memory=self.memory, cores=self.cores, disk=self.disk)
+        return self.addFollowOn(gatherJob).rv()
+
+    def _writeElements(self, fileStore, elements):
+        """
+        Writes the elements to a global file, pickled one after another, and their offsets in
+        it to a second global file, so that a range of the elements can be read without reading
+        the others, see _readElements. The files are deleted with the job writing them, once
+        the jobs of the tree have been run.
+        """
+        with fileStore.writeGlobalFileStream(cleanup=True) as (dataHandle, dataFileID):
+            with fileStore.writeGlobalFileStream(cleanup=True) as (indexHandle, indexFileID):
+                n = 0
+                offset = 0
+                for element in elements:
+                    pickledElement = cPickle.dumps(element, cPickle.HIGHEST_PROTOCOL)
+                    indexHandle.write(struct.pack("<Q", offset))
+                    dataHandle.write(pickledElement)
+                    offset += len(pickledElement)
+                    n += 1
+                #The offset of the end of the last element
+                indexHandle.write(struct.pack("<Q", offset))
+        self._elements = None
+        self._elementFileIDs = (dataFileID, indexFileID)
+        self._start = 0
+        self._end = n
+
+    #The size in bytes of the offset of an element, see _writeElements
+    _offsetSize = struct.calcsize("<Q")
+
+    def _readElements(self, fileStore):
+        """
+        Returns the list of the elements in the range of the job, see _writeElements.
+        """
+        dataFileID, indexFileID = self._elementFileIDs
+        offsets = fileStore.readGlobalFileRange(indexFileID, self._start * self._offsetSize,
+                                                (self._end + 1) * self._offsetSize)
+        start, end = [ struct.unpack("<Q", offsets[i:i + self._offsetSize])[0]
+                       for i in (0, len(offsets) - self._offsetSize) ]
+        fileHandle = BytesIO(fileStore.readGlobalFileRange(dataFileID, start, end))
+        return [ cPickle.load(fileHandle) for i in xrange(self._end - self._start) ]
+
+    def getUserScript(self):
+        return self._fn[0]
+
+    def _jobName(self):
+        return ".".join((self.__class__.__name__, self._fn[0].name, self._fn[1]))
+
+class GatherJob(Job):
+    """
+    Job that combines the results of the children of a MapJob, given as promises, by
+    concatenating the lists of results or with the function given to MapJob.reduce.
+    """
+    def __init__(self, reduceFn, values, memory=None, cores=None, disk=None):
+        Job.__init__(self, memory=memory, cores=cores, disk=disk)
+        self._reduceFn = reduceFn
+        self._values = values
+
+    def run(self, fileStore):
+        return self.combine(self, self._reduceFn, self._values, isMapped=False)
+
+    @staticmethod
+    def combine(job, reduceFn, values, isMapped):
+        """
+        Combines the given values, which are the results of a map if isMapped is True and
+        otherwise are combinations returned by the children of a MapJob.
+        """
+        if reduceFn is None:
+            return values if isMapped else list(itertools.chain.from_iterable(values))
+        if not isMapped:
+            #Children without elements return None
+            values = [ value for value in values if value is not None ]
+        if len(values) == 0:
+            return None
+        return _loadFunction(job, reduceFn)(values)
+
+    def _jobName(self):
+        return ".".join((self.__class__.__name__, self._reduceFn[0].name, self._reduceFn[1])
+                        if self._reduceFn is not None else (self.__class__.__name__,))
+
+def _describeFunction(fn):
+    """
+    Returns a picklable description of the given module level function, see _loadFunction.
+    """
+    return ModuleDescriptor.forModule(fn.__module__).globalize(), str(fn.__name__)
+
+def _loadFunction(job, description):
+    """
+    Returns the function described by the given description, see _describeFunction.
+    """
+    userModuleDescriptor, name = description
+    return getattr(job._loadUserModule(userModuleDescriptor), name)
+
+class _Download(object):
+    """
+    The download of a global file by Job.FileStore.prefetchGlobalFiles.
+    """
+    def __init__(self, fileStoreID):
+        self.fileStoreID = fileStoreID
+        #The local path of the downloaded file, or the exception raised downloading it
+        self.path = None
+        self.error = None
+        self.done = threading.Event()
+        #Queues to put the download on once it is done, see notify
+        self.queues = []
+        self.lock = threading.Lock()
+
+    def notify(self, queue):
+        """
+        Puts the download on the given queue once it is done.
+        """
+        with self.lock:
+            if self.done.is_set():
+                queue.put(self)
+            else:
+                self.queues.append(queue)
+
+    def finish(self, path=None, error=None):
+        with self.lock:
+            self.path = path
+            self.error = error
+            self.done.set()
+            for queue in self.queues:
+                queue.put(self)
+
+    def getPath(self):
+        """
+        Returns the path of the downloaded file, waiting for the download to complete.
+        """
+        #Wait with a timeout, so that the wait can be interrupted
+        while not self.done.wait(1):
+            pass
+        if self.error is not None:
+            raise self.error
+        return self.path
+
+class _StreamWriter(object):
+    """
+    File handle writing the data of a stream to the socket connected to its reader, see
+    Job.FileStore.writeGlobalStream. The data is written in chunks, each preceded by its
+    length, and ended by an empty chunk once all of it has been written, so that the reader
+    can tell the end of the data from the writer failing, see _StreamReader.
+    """
+    def __init__(self, fileHandle):
+        self.fileHandle = fileHandle
+
+    def write(self, data):
+        if len(data) > 0:
+            self.fileHandle.write(struct.pack("<Q", len(data)))
+            self.fileHandle.write(data)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        self.fileHandle.flush()
+
+    def end(self):
+        """
+        Writes the empty chunk ending the data.
+        """
+        self.fileHandle.write(struct.pack("<Q", 0))
+        self.fileHandle.flush()
+
+class _StreamReader(object):
+    """
+    File handle reading the data of a stream written by a _StreamWriter, see
+    Job.FileStore.readGlobalStream. Raises a RuntimeError if the data ends before the chunk
+    ending it, the writer having failed.
+    """
+    def __init__(self, fileHandle, streamID):
+        self.fileHandle = fileHandle
+        self.streamID = streamID
+        #The data read from the socket but not yet from this
+        self.buffer = ""
+        self.ended = False
+
+    def _readChunk(self):
+        """
+        :rtype : string, the next chunk of the data, which is empty once the data has ended.
+        """
+        if self.ended:
+            return ""
+        header = self.fileHandle.read(8)
+        if len(header) == 8:
+            length, = struct.unpack("<Q", header)
+            chunk = self.fileHandle.read(length)
+            if len(chunk) == length:
+                self.ended = length == 0
+                return chunk
+        raise RuntimeError("The job writing stream %s failed before writing all the data" %
+                           self.streamID)
+
+    def read(self, size=-1):
+        chunks = [ self.buffer ]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            chunk = self._readChunk()
+            if len(chunk) == 0:
+                break
+            chunks.append(chunk)
+            length += len(chunk)
+        data = "".join(chunks)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+    def readline(self):
+        chunks = [ self.buffer ]
+        while "\n" not in chunks[-1]:
+            chunk = self._readChunk()
+            if len(chunk) == 0:
+                break
+            chunks.append(chunk)
+        data = "".join(chunks)
+        end = data.find("\n") + 1 or len(data)
+        self.buffer = data[end:]
+        return data[:end]
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+            yield line
+
 class ServiceJob(Job):
     """
     Job used to wrap a Job.Service instance. This constructor should not be called by a user.
@@ -1011,8 +2131,8 @@ class ServiceJob(Job):
         Job.__init__(self, memory=service.memory, cores=service.cores)
         # service.__module__ is the module defining the class service is an instance of.
         self.serviceModule = ModuleDescriptor.forModule(service.__module__).globalize()
-        #The service to run, pickled
-        self.pickledService = cPickle.dumps(service)
+        #The service to run, pickled along with the job, see __getstate__
+        self.service = service
         #An empty file in the jobStore which when deleted is used to signal
         #that the service should cease, is initialised in
         #Job._modifyJobGraphForServices
@@ -1021,6 +2141,14 @@ class ServiceJob(Job):
         #service is established
         self.startFileStoreID = None
 
+    def __getstate__(self):
+        #The service is pickled separately, so that it can be unpickled once its module has
+        #been loaded, but when the job is, so that the FileIDs it holds are collected with
+        #those of the job, see collectFileIDs
+        state = dict(self.__dict__)
+        state["pickledService"] = cPickle.dumps(state.pop("service"))
+        return state
+
     def run(self, fileStore):
         #Unpickle the service
         userModule = self._loadUserModule(self.serviceModule)
@@ -1041,14 +2169,21 @@ class ServiceJob(Job):
         #Now block until we are told to stop, which is indicated by the removal
         #of a file
         assert self.stopFileStoreID != None
-        while fileStore.jobStore.fileExists(self.stopFileStoreID):
-            time.sleep(1) #Avoid excessive polling
+        fileStore.jobStore.waitForDeletion([self.stopFileStoreID])
         #Now kill the service
         service.stop()
 
     def getUserScript(self):
         return self.serviceModule
 
+    def _isMemoisable(self):
+        #Services are run for their side effects
+        return False
+
+    def _isFusable(self):
+        #Services block until they are stopped, so must have a worker to themselves
+        return False
+
 class EncapsulatedJob(Job):
     """
     An convenience Job class used to make a job subgraph appear to
@@ -1100,6 +2235,145 @@ class EncapsulatedJob(Job):
     def rv(self, argIndex=0):
         return self.followOn.rv(argIndex)
 
+class FusedJob(Job):
+    """
+    Job used to run a chain of jobs sequentially within a single worker, see
+    Job._fuseJobChains. This saves creating, issuing, loading and updating a job wrapper for
+    every job of the chain but the first. The return values of the jobs of the chain are passed
+    in memory to the later jobs of the chain and the stats of each job of the chain are
+    reported separately. This constructor should not be called by a user.
+    
+    If a job of the chain other than the last creates successors then the remaining jobs of
+    the chain are moved to a new FusedJob, which is made a child of this job and inherits the
+    successors of the chain.
+    
+    The jobs of the chain are committed together, when the FusedJob completes, so if any of
+    them fails the FusedJob is retried from the first job of the chain, running again the
+    jobs that succeeded. Chains are only fused if the fuseJobs option is set.
+    """
+    def __init__(self, jobs, memory=None, cores=None, disk=None):
+        """
+        jobs is the chain of jobs to run, in order, each requiring the given resources.
+        """
+        Job.__init__(self, memory=memory, cores=cores, disk=disk)
+        self._jobs = jobs
+        #List of tuples of the module descriptor, the pickle and the FileIDs referred to by
+        #the pickle of each job of the chain, see FusedJob._serialiseJob
+        self._pickledJobs = None
+        #The number of levels of the job wrapper's stack that hold the successors of the chain
+        self._tailLength = 0
+        #The FusedJob running the jobs of the chain left when a job creates successors
+        self._remainder = None
+        #The last job of the chain to have been run
+        self._lastJob = None
+        #The stats element the stats of the jobs of the chain are added to, see FusedJob._execute
+        self._stats = None
+
+    def run(self, fileStore):
+        global promisedValues
+        promisedValues = {}
+        try:
+            for i, (userModule, pickledJob, _) in enumerate(self._pickledJobs):
+                job = self._unpickle(self._loadUserModule(userModule), BytesIO(pickledJob))
+                returnValues = self._runJob(job, fileStore)
+                isLastJob = i == len(self._pickledJobs) - 1
+                if (not isLastJob and len(job._children) == 0 and len(job._followOns) == 0
+                    and len(job._services) == 0 and len(job._releasedJobs) == 0):
+                    job._setReturnValuesForPromises(returnValues, fileStore.jobStore)
+                    continue
+                #The job is the last of the chain to be run by this job, so its successors
+                #become successors of this job
+                for child in job._children:
+                    child._directPredecessors.remove(job)
+                    Job.addChild(self, child)
+                for followOn in job._followOns:
+                    followOn._directPredecessors.remove(job)
+                    Job.addFollowOn(self, followOn)
+                self._services = job._services
+                self._releasedJobs = job._releasedJobs
+                self._releasedUpdateIDs = job._releasedUpdateIDs
+                job._children = []
+                job._followOns = []
+                job._services = []
+                if not isLastJob:
+                    self._remainder = FusedJob(None, memory=self.memory, cores=self.cores,
+                                               disk=self.disk)
+                    self._remainder._pickledJobs = self._pickledJobs[i+1:]
+                    Job.addChild(self, self._remainder)
+                self._lastJob = job
+                return returnValues
+        finally:
+            promisedValues = None
+
+    def _runJob(self, job, fileStore):
+        """
+        Runs a job of the chain with its own file store and local temporary directory,
+        returning the return values of its run method.
+        """
+        if self._stats != None:
+            startTime = time.time()
+            startClock = getTotalCpuTime()
+            profiler = job._startProfiler(fileStore.jobStore.config)
+        localTempDir = tempfile.mkdtemp(dir=fileStore.getLocalTempDir())
+        jobFileStore = Job.FileStore(fileStore.jobStore, fileStore.jobWrapper, localTempDir)
+        baseDir = os.getcwd()
+        returnValues, cacheStatus = job._runMemoised(jobFileStore)
+        if os.getcwd() != baseDir:
+            os.chdir(baseDir)
+        shutil.rmtree(localTempDir)
+        fileStore.loggingMessages += jobFileStore.loggingMessages
+        fileStore.deletedJobStoreFileIDs |= jobFileStore.deletedJobStoreFileIDs
+        fileStore.writtenFileSizes.update(jobFileStore.writtenFileSizes)
+        if self._stats != None:
+            job._addStats(self._stats, startTime, startClock, cacheStatus, jobFileStore,
+                          profiler)
+        return returnValues
+
+    def _execute(self, jobWrapper, stats, localTempDir, jobStore):
+        #The stats are recorded for each job of the chain, rather than for the fused job
+        self._stats = stats
+        return Job._execute(self, jobWrapper, None, localTempDir, jobStore)
+
+    def _setReturnValuesForPromises(self, returnValues, jobStore):
+        #The promises for the jobs of the chain run before the last were set by FusedJob.run
+        self._lastJob._setReturnValuesForPromises(returnValues, jobStore)
+
+    def _makeJobWrappers(self, jobWrapper, jobStore, jobsToUUIDs):
+        if self._remainder is None:
+            return Job._makeJobWrappers(self, jobWrapper, jobStore, jobsToUUIDs)
+        #The successors of the chain, at the top of the stack, must be run after the
+        #remaining jobs of the chain, so are moved to the stack of the remainder
+        i = len(jobWrapper.stack) - self._tailLength
+        tail = jobWrapper.stack[i:]
+        del jobWrapper.stack[i:]
+        jobsToJobWrappers = Job._makeJobWrappers(self, jobWrapper, jobStore, jobsToUUIDs)
+        jobsToJobWrappers[self._remainder].stack[:0] = tail
+        return jobsToJobWrappers
+
+    def _serialiseJob(self, jobStore, jobsToJobWrappers, rootJobWrapper):
+        if self._pickledJobs is None:
+            #The jobs are pickled last to first, so that any promises made by later jobs of the
+            #chain for the return values of earlier jobs are registered before the earlier
+            #jobs are pickled. The FileIDs referred to by each pickle are kept with it, so
+            #that they are referred to by the pickle of any FusedJob running the job.
+            self._pickledJobs = []
+            for job in reversed(self._jobs):
+                job._promiseJobStore = None
+                with collectFileIDs() as fileIDs:
+                    pickledJob = cPickle.dumps(job, cPickle.HIGHEST_PROTOCOL)
+                self._pickledJobs.insert(0, (job.userModule.globalize(), pickledJob,
+                                             list(fileIDs)))
+            self._jobs = None
+        self._tailLength = len(jobsToJobWrappers[self].stack)
+        Job._serialiseJob(self, jobStore, jobsToJobWrappers, rootJobWrapper)
+
+    def _isMemoisable(self):
+        #The jobs of the chain are memoised individually
+        return False
+
+    def _isFusable(self):
+        return False
+
 class PromisedJobReturnValue(object):
     """
     References a return value from a Job's run function. Let T be a job.
@@ -1129,6 +2403,8 @@ def promisedJobReturnValuePickleFunction(promise):
 promiseFilesToDelete = set()
 promisedJobReturnValueUnpickleFunction_jobStore = None #This is a jobStore instance
 #used to unpickle promises
+promisedValues = None #Map of promise jobStoreFileIDs to pickled values, used to pass
+#return values between the members of a FusedJob without reading them back from the jobStore
 
 def promisedJobReturnValueUnpickleFunction(jobStoreString, jobStoreFileID):
     """
@@ -1138,6 +2414,8 @@ def promisedJobReturnValueUnpickleFunction(jobStoreString, jobStoreFileID):
     if promisedJobReturnValueUnpickleFunction_jobStore == None:
         promisedJobReturnValueUnpickleFunction_jobStore = loadJobStore(jobStoreString)
     promiseFilesToDelete.add(jobStoreFileID)
+    if promisedValues is not None and jobStoreFileID in promisedValues:
+        return cPickle.loads(promisedValues[jobStoreFileID])
     with promisedJobReturnValueUnpickleFunction_jobStore.readFileStream(jobStoreFileID) as fileHandle:
         value = cPickle.load(fileHandle) #If this doesn't work then the file containing the promise may not exist or be corrupted.
         return value
@@ -1147,20 +2425,57 @@ copy_reg.pickle(PromisedJobReturnValue,
                 promisedJobReturnValuePickleFunction,
                 promisedJobReturnValueUnpickleFunction)
 
+class FileID(str):
+    """
+    The ID of a global file written by a FileStore. When the collectFiles option is set, the
+    pickled jobs and the promised return values that a FileID is pickled into are recorded as
+    holding the file, and the file is deleted by the leader once the jobs holding it have
+    completed and the promises holding it have been collected, see
+    toil.leader.FileCollector. The file must therefore only be referred to by the FileIDs
+    passed to jobs and returned by them, not by strings derived from the FileIDs.
+    """
+    pass
+
+def fileIDPickleFunction(fileID):
+    """
+    The FileID custom pickle function, which records the FileID as referred to by the object
+    being pickled, see collectFileIDs.
+    """
+    if collectedFileIDs is not None:
+        collectedFileIDs.add(fileID)
+    return FileID, (str(fileID),)
+
+copy_reg.pickle(FileID, fileIDPickleFunction)
+
+collectedFileIDs = None #The set of FileIDs pickled within collectFileIDs
+heldFileIDs = {} #Map of the jobStoreFileIDs of pickled jobs and promised return values to the
+#FileIDs they refer to, reported to the leader by Job._reportFileReferences
+
+@contextmanager
+def collectFileIDs(holder=None):
+    """
+    Collects the FileIDs pickled within the context into the yielded set. If holder is given
+    the FileIDs are recorded as held by the file with that jobStoreFileID, in heldFileIDs.
+    """
+    global collectedFileIDs
+    previousFileIDs = collectedFileIDs
+    collectedFileIDs = set()
+    try:
+        yield collectedFileIDs
+        if holder is not None and len(collectedFileIDs) > 0:
+            heldFileIDs.setdefault(holder, set()).update(collectedFileIDs)
+    finally:
+        collectedFileIDs = previousFileIDs
+
 def deleteFileStoreIDs(job, jobStoreFileIDsToDelete):
     """
     Job function that deletes a bunch of files using their jobStoreFileIDs
     """
-    map(lambda i : job.fileStore.jobStore.deleteFile(i), jobStoreFileIDsToDelete)
+    job.fileStore.jobStore.deleteFiles(jobStoreFileIDsToDelete)
 
 def blockUntilDeleted(job, jobStoreFileIDs):
     """
     Function will not terminate until all the fileStoreIDs in jobStoreFileIDs
     cease to exist.
     """
-    while True:
-        jobStoreFileIDs = [ i for i in jobStoreFileIDs
-                           if job.fileStore.jobStore.fileExists(i) ]
-        if len(jobStoreFileIDs) == 0:
-            break
-        time.sleep(1)
+    job.fileStore.jobStore.waitForDeletion(jobStoreFileIDs)
@@ -15,6 +15,15 @@ from __future__ import absolute_import
 from abc import ABCMeta, abstractmethod
 from contextlib import contextmanager
 import re
+import os
+import hashlib
+import time
+import shutil
+import tempfile
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from toil.jobWrapper import ChunkedSuccessors
 try:
     import cPickle 
 except ImportError:
@@ -37,6 +46,318 @@ class JobStoreCreationException( Exception ):
     def __init__( self, message ):
         super( JobStoreCreationException, self ).__init__( message )
 
+_blockSize = 1 << 16
+
+def _readBytes( fileHandle, size ):
+    """
+    Reads up to size bytes from the file handle, returning less only at the end of the file.
+    """
+    chunks = [ ]
+    while size > 0:
+        chunk = fileHandle.read( min( size, _blockSize ) )
+        if not chunk:
+            break
+        chunks.append( chunk )
+        size -= len( chunk )
+    return ''.join( chunks )
+
+def _readRange( fileHandle, start, end ):
+    """
+    Reads the bytes of the file handle between the offsets start (inclusive) and end
+    (exclusive), see AbstractJobStore.readFileRange.
+    """
+    _readBytes( fileHandle, start )
+    data = _readBytes( fileHandle, max( 0, end - start ) )
+    #Read to the end, as streams may be fed by a thread writing the whole file
+    while _readBytes( fileHandle, _blockSize ):
+        pass
+    return data
+
+def _readSize( fileHandle ):
+    """
+    Reads the file handle to the end, returning the number of bytes read.
+    """
+    size = 0
+    while True:
+        data = _readBytes( fileHandle, _blockSize )
+        if not data:
+            return size
+        size += len( data )
+
+#Files compressed by the job store start with the following, then a byte identifying the codec,
+#see AbstractJobStore.writeFileStream
+_compressedFileMagic = '\x89TOILZ\r\n'
+_compressedFileHeaderSize = len( _compressedFileMagic ) + 1
+
+#The codecs for compressing files, by the names taken by the fileCompression option, as their
+#identifying byte and a function returning a compressor. The fastest level of zlib is used.
+_fileCodecs = { 'zlib': ( '\x01', lambda: zlib.compressobj( 1 ) ) }
+
+#The functions returning a decompressor, by the identifying byte of the codec
+_fileDecompressors = { '\x01': zlib.decompressobj }
+
+def _isCompressed( header ):
+    """
+    :rtype : True if the given start of a file is the header of a compressed file.
+    """
+    return len( header ) == _compressedFileHeaderSize and header.startswith( _compressedFileMagic )
+
+def _compressesWell( codec, sample, maxRatio ):
+    """
+    :rtype : True if the sample, the start of a file, compresses to at most maxRatio of its
+    size with the codec. Files starting with the magic of compressed files are always
+    compressed, so that they are not taken for compressed files when read.
+    """
+    if sample.startswith( _compressedFileMagic ):
+        return True
+    compressor = _fileCodecs[ codec ][ 1 ]( )
+    return 0 < len( compressor.compress( sample ) + compressor.flush( ) ) <= maxRatio * len( sample )
+
+class _CompressingFileStream( object ):
+    """
+    A write-only file-like object compressing what is written to it into another file handle,
+    unless the first sampleSize bytes written compress to more than maxRatio of their size, in
+    which case what is written is passed through.
+    """
+    def __init__( self, fileHandle, codec, sampleSize, maxRatio ):
+        self.fileHandle = fileHandle
+        self.codec = codec
+        self.sampleSize = sampleSize
+        self.maxRatio = maxRatio
+        #What is written until it is decided whether to compress it, then None
+        self.sample = [ ]
+        self.sampleLength = 0
+        #The compressor, if compressing
+        self.compressor = None
+        #The numbers of bytes written to this and to the underlying file handle
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    def _decide( self ):
+        sample = ''.join( self.sample )
+        self.sample = None
+        if _compressesWell( self.codec, sample, self.maxRatio ):
+            codecByte, makeCompressor = _fileCodecs[ self.codec ]
+            self.compressor = makeCompressor( )
+            self._write( _compressedFileMagic + codecByte )
+            self._write( self.compressor.compress( sample ) )
+        else:
+            self._write( sample )
+
+    def _write( self, data ):
+        self.fileHandle.write( data )
+        self.bytesOut += len( data )
+
+    def write( self, data ):
+        self.bytesIn += len( data )
+        if self.sample is not None:
+            self.sample.append( data )
+            self.sampleLength += len( data )
+            if self.sampleLength >= self.sampleSize:
+                self._decide( )
+        elif self.compressor is not None:
+            self._write( self.compressor.compress( data ) )
+        else:
+            self._write( data )
+
+    def writelines( self, lines ):
+        for line in lines:
+            self.write( line )
+
+    def flush( self ):
+        self.fileHandle.flush( )
+
+    def tell( self ):
+        return self.bytesIn
+
+    def close( self ):
+        """
+        Writes what remains to the underlying file handle, which is not closed.
+        """
+        if self.sample is not None:
+            self._decide( )
+        if self.compressor is not None:
+            self._write( self.compressor.flush( ) )
+            self.compressor = None
+
+    @property
+    def savedBytes( self ):
+        return self.bytesIn - self.bytesOut
+
+def _hashFile( localFilePath ):
+    """
+    :rtype : string, the content hash of the local file, see _HashingFileStream.
+    """
+    contentHash = hashlib.sha256( )
+    with open( localFilePath, 'rb' ) as fileHandle:
+        while True:
+            data = fileHandle.read( _blockSize )
+            if len( data ) == 0:
+                return contentHash.hexdigest( )
+            contentHash.update( data )
+
+class _HashingFileStream( object ):
+    """
+    A write-only file-like object passing what is written to it to another file handle, while
+    computing its content hash, the hex digest of its SHA-256 hash.
+    """
+    def __init__( self, fileHandle ):
+        self.fileHandle = fileHandle
+        self.contentHash = hashlib.sha256( )
+        self.bytesIn = 0
+
+    def write( self, data ):
+        self.contentHash.update( data )
+        self.bytesIn += len( data )
+        self.fileHandle.write( data )
+
+    def writelines( self, lines ):
+        for line in lines:
+            self.write( line )
+
+    def flush( self ):
+        self.fileHandle.flush( )
+
+    def tell( self ):
+        return self.bytesIn
+
+    def hexdigest( self ):
+        return self.contentHash.hexdigest( )
+
+class _DecompressingFileStream( object ):
+    """
+    A read-only file-like object decompressing what is read from another file handle with the
+    given decompressor, or if that is None passing it through, after the given prefix.
+    """
+    def __init__( self, fileHandle, decompressor, prefix='' ):
+        self.fileHandle = fileHandle
+        self.decompressor = decompressor
+        #What has been decompressed but not read
+        self.buffer = prefix
+        self.position = 0
+        self.eof = False
+
+    def _next( self ):
+        """
+        :rtype : the next block of the decompressed content, or '' at the end of the file.
+        """
+        while not self.eof:
+            data = self.fileHandle.read( _blockSize )
+            if not data:
+                self.eof = True
+                return '' if self.decompressor is None else self.decompressor.flush( )
+            if self.decompressor is not None:
+                data = self.decompressor.decompress( data )
+            if data:
+                return data
+        return ''
+
+    def read( self, size=-1 ):
+        chunks = [ self.buffer ]
+        length = len( self.buffer )
+        while size < 0 or length < size:
+            data = self._next( )
+            if not data:
+                break
+            chunks.append( data )
+            length += len( data )
+        data = ''.join( chunks )
+        if size < 0:
+            self.buffer = ''
+        else:
+            data, self.buffer = data[ :size ], data[ size: ]
+        self.position += len( data )
+        return data
+
+    def readline( self ):
+        while True:
+            i = self.buffer.find( '\n' )
+            if i >= 0:
+                return self.read( i + 1 )
+            data = self._next( )
+            if not data:
+                return self.read( )
+            self.buffer += data
+
+    def __iter__( self ):
+        while True:
+            line = self.readline( )
+            if not line:
+                break
+            yield line
+
+    def tell( self ):
+        return self.position
+
+class SeekableFileStream( object ):
+    """
+    A read-only, seekable file-like object for a file in a job store, which reads blocks of
+    the file as they are needed with AbstractJobStore._readFileRange, so from files stored
+    uncompressed.
+    """
+    #The number of bytes read from the job store at a time
+    blockSize = 1 << 20
+
+    def __init__( self, jobStore, jobStoreFileID ):
+        self.jobStore = jobStore
+        self.jobStoreFileID = jobStoreFileID
+        #The offset in the file of the next byte to be read
+        self.position = 0
+        #The block of the file last read from the job store, and its offset
+        self.block = ''
+        self.blockStart = 0
+
+    def _fill( self ):
+        """
+        Reads the block of the file starting at the current position, if the position is not
+        within the current block. Returns False at the end of the file.
+        """
+        if not self.blockStart <= self.position < self.blockStart + len( self.block ):
+            self.block = self.jobStore._readFileRange( self.jobStoreFileID, self.position,
+                                                       self.position + self.blockSize )
+            self.blockStart = self.position
+        return len( self.block ) > 0
+
+    def read( self, size=-1 ):
+        chunks = [ ]
+        while size != 0 and self._fill( ):
+            i = self.position - self.blockStart
+            chunk = self.block[ i: ] if size < 0 else self.block[ i:i + size ]
+            chunks.append( chunk )
+            self.position += len( chunk )
+            if size > 0:
+                size -= len( chunk )
+        return ''.join( chunks )
+
+    def readline( self ):
+        chunks = [ ]
+        while self._fill( ):
+            i = self.position - self.blockStart
+            j = self.block.find( '\n', i )
+            chunk = self.block[ i: ] if j < 0 else self.block[ i:j + 1 ]
+            chunks.append( chunk )
+            self.position += len( chunk )
+            if j >= 0:
+                break
+        return ''.join( chunks )
+
+    def __iter__( self ):
+        while True:
+            line = self.readline( )
+            if not line:
+                break
+            yield line
+
+    def seek( self, offset, whence=0 ):
+        if whence == 1:
+            offset += self.position
+        elif whence != 0:
+            raise ValueError( "Seeking relative to the end of the file is not supported" )
+        self.position = offset
+
+    def tell( self ):
+        return self.position
+
 class AbstractJobStore( object ):
     """ 
     Represents the physical storage for the jobs and associated files in a toil.
@@ -51,11 +372,14 @@ class AbstractJobStore( object ):
         If this file already exists it will be overwritten. If config is None, 
         the shared file "config.pickle" is assumed to exist and is retrieved. See loadConfigFromStore.
         """
+        #The number of bytes saved by compressing the files written, see writeFileStream
+        self.compressionSavedBytes = 0
         #Now get on with reading or writing the config
         if config is None:
             with self.readSharedFileStream( "config.pickle", isProtected=False ) as fileHandle:
                 self.__config = cPickle.load(fileHandle)
         else:
+            self._checkConfig( config )
             self.__config = config
             self.writeConfigToStore()
             
@@ -63,7 +387,12 @@ class AbstractJobStore( object ):
         """
         Re-writes the config attribute to the jobStore, so that its values can be retrieved 
         if the jobStore is reloaded.
+        
+        If the fileCompression option is set the config records that files may have been
+        compressed, which it then does whatever the option is later set to, see _isCompressedFile.
         """
+        if self.__config.fileCompression != 'none':
+            self.__config.filesCompressed = True
         with self.writeSharedFileStream( "config.pickle", isProtected=False ) as fileHandle:
             cPickle.dump(self.__config, fileHandle, cPickle.HIGHEST_PROTOCOL)
     
@@ -92,6 +421,23 @@ class AbstractJobStore( object ):
             raise JobStoreCreationException("The job store '%s' does not exist, so there "
                                 "is nothing to restart." % jobStoreString)
     
+    #True for job stores that share the storage of files with the same content, see _linkBlob.
+    #The others reject the fileDeduplication option.
+    deduplicatesFiles = False
+    
+    @classmethod
+    def _checkConfig( cls, config ):
+        """
+        Checks that the job store supports the options of the config of a new job store. Job
+        stores call this before creating anything, if they create before calling __init__.
+        
+        :raise RuntimeError: Thrown if the fileDeduplication option is set and the job store
+                             does not deduplicate files.
+        """
+        if config is not None and config.fileDeduplication and not cls.deduplicatesFiles:
+            raise RuntimeError( "The fileDeduplication option is not supported by the %s" %
+                                cls.__name__ )
+    
     @abstractmethod
     def deleteJobStore( self ):
         """
@@ -101,28 +447,59 @@ class AbstractJobStore( object ):
     
     ##Cleanup functions
     
+    #The number of jobs deleted or updated together by clean, see batch, and the maximum
+    #number of threads used by clean to do so concurrently
+    cleanBatchSize = 100
+    maxCleanThreads = 16
+    
     def clean(self):
         """
         Function to cleanup the state of a jobStore after a restart.
         Fixes jobs that might have been partially updated.
         Resets the try counts.
+        
+        The jobs are read in a single pass, which gives the set of jobs that exist, and those
+        to delete or update are then deleted or updated concurrently, see _inBatches. Only the
+        IDs of the jobs are kept from the pass, with the jobs that are to be updated whichever
+        jobs exist. The others are loaded again if a successor at the top of their stack is
+        found not to exist.
         """
         #Collate any jobs that were in the process of being created/deleted
+        updateIDs = {} #jobStoreID -> updateID
         jobsToDelete = set()
+        jobs = [] #The jobs to update
+        topSuccessors = {} #jobStoreID -> jobStoreIDs at the top of the stack, for the others
         for job in self.jobs():
+            updateIDs[job.jobStoreID] = job.updateID
             for updateID in job.jobsToDelete:
                 jobsToDelete.add(updateID)
+            if (len(job.jobsToDelete) != 0 or
+                job.remainingRetryCount < self._defaultTryCount() or
+                job.logJobStoreFileID != None):
+                jobs.append(job)
+            elif len(job.stack) > 0:
+                topSuccessors[job.jobStoreID] = [ command[0] for command in job.stack[-1] ]
             
         #Delete the jobs that should be deleted
         if len(jobsToDelete) > 0:
-            for job in self.jobs():
-                if job.updateID in jobsToDelete:
-                    self.delete(job.jobStoreID)
+            self._inBatches(self.delete, [ jobStoreID for jobStoreID, updateID
+                                           in updateIDs.iteritems()
+                                           if updateID in jobsToDelete ])
+        jobStoreIDs = set(jobStoreID for jobStoreID, updateID in updateIDs.iteritems()
+                          if updateID not in jobsToDelete)
+        updateIDs = None
+        jobs = [ job for job in jobs if job.jobStoreID in jobStoreIDs ]
+        staleJobStoreIDs = [ jobStoreID for jobStoreID, successors in topSuccessors.iteritems()
+                             if jobStoreID in jobStoreIDs and
+                             not all(successor in jobStoreIDs for successor in successors) ]
+        topSuccessors = None
         
         #Cleanup the state of each job
-        for job in self.jobs():
+        def cleanJob(job):
             changed = False #Flag to indicate if we need to update the job
             #on disk
+            #The chunks of the successors removed from the stack, deleted once the job is updated
+            obsoleteChunkIDs = []
             
             if len(job.jobsToDelete) != 0:
                 job.jobsToDelete = set()
@@ -132,11 +509,14 @@ class AbstractJobStore( object ):
             #those jobs from the stack (this cleans up the case that the job
             #had successors to run, but had not been updated to reflect this)
             while len(job.stack) > 0:
-                jobs = [ command for command in job.stack[-1] if self.exists(command[0]) ]
-                if len(jobs) < len(job.stack[-1]):
+                successors = [ command for command in job.stack[-1] if command[0] in jobStoreIDs ]
+                if len(successors) < len(job.stack[-1]):
                     changed = True
-                    if len(jobs) > 0:
-                        job.stack[-1] = jobs
+                    if isinstance(job.stack[-1], ChunkedSuccessors):
+                        obsoleteChunkIDs.extend(job.stack[-1].chunkIDs)
+                    if len(successors) > 0:
+                        job.stack[-1] = successors
+                        ChunkedSuccessors.chunkStack(self, job)
                         break
                     else:
                         job.stack.pop()
@@ -156,10 +536,35 @@ class AbstractJobStore( object ):
             
             if changed: #Update, but only if a change has occurred
                 self.update(job)
+                if len(obsoleteChunkIDs) > 0:
+                    self.deleteFiles(obsoleteChunkIDs)
+        self._inBatches(cleanJob, jobs)
+        self._inBatches(lambda jobStoreID: cleanJob(self.load(jobStoreID)), staleJobStoreIDs)
         
         #Remove any crufty stats/logging files from the previous run
         self.readStatsAndLogging(lambda x : None)
     
+    def _inBatches(self, fn, jobs):
+        """
+        Calls fn on each of the jobs, or jobStoreIDs, for clean, in batches of cleanBatchSize
+        jobs, see batch, up to maxCleanThreads of which are made concurrently.
+        """
+        def processBatch(batchOfJobs):
+            with self.batch():
+                for job in batchOfJobs:
+                    fn(job)
+        batches = [ jobs[i:i + self.cleanBatchSize]
+                    for i in xrange(0, len(jobs), self.cleanBatchSize) ]
+        if len(batches) <= 1:
+            map(processBatch, batches)
+            return
+        pool = ThreadPool(min(len(batches), self.maxCleanThreads))
+        try:
+            pool.map(processBatch, batches)
+        finally:
+            pool.close()
+            pool.join()
+    
     ##########################################
     #The following methods deal with creating/loading/updating/writing/checking for the
     #existence of jobs
@@ -187,16 +592,32 @@ class AbstractJobStore( object ):
         """
         raise NotImplementedError( )
 
-    @abstractmethod
-    def getPublicUrl( self,  FileName):
+    def getPublicUrl( self,  jobStoreFileID):
         """
         Returns a publicly accessible URL to the given file in the job store.
         The returned URL starts with 'http:',  'https:' or 'file:'.
         The returned URL may expire as early as 1h after its been returned.
         Throw an exception if the file does not exist.
+        
+        The URL of a file that was compressed when written (see writeFileStream) is that of a
+        decompressed copy of it, a shared file written again by each call, which is kept until
+        the job store is deleted.
         :param jobStoreFileID:
         :return:
         """
+        if not self._isCompressedFile( jobStoreFileID ):
+            return self._getPublicUrl( jobStoreFileID )
+        sharedFileName = "decompressed-" + hashlib.sha1( jobStoreFileID ).hexdigest( )
+        with self.writeSharedFileStream( sharedFileName ) as sharedFileHandle:
+            with self.readFileStream( jobStoreFileID ) as fileHandle:
+                shutil.copyfileobj( fileHandle, sharedFileHandle, _blockSize )
+        return self.getSharedPublicUrl( sharedFileName )
+
+    @abstractmethod
+    def _getPublicUrl( self, jobStoreFileID ):
+        """
+        See getPublicUrl, the file being stored as it is to be given.
+        """
         raise NotImplementedError()
 
     @abstractmethod
@@ -248,12 +669,25 @@ class AbstractJobStore( object ):
         """
         raise NotImplementedError( )
 
+    @contextmanager
+    def batch( self ):
+        """
+        Returns a context manager within which the jobs created, updated and deleted are
+        committed to the store together when the outermost context manager exits, by job stores
+        able to do so. Other job stores make the changes as they are requested, which this
+        implementation does.
+        """
+        yield
+
     ##########################################
     #The following provide an way of creating/reading/writing/updating files 
-    #associated with a given job.
+    #associated with a given job. If the fileCompression option is set the files are
+    #compressed as they are written, unless they do not compress well, and decompressed as
+    #they are read, see writeFileStream. If the fileDeduplication option is set files with
+    #the same content share its storage, see writeFile. The files are stored by the methods
+    #following these, which job stores implement.
     ##########################################  
 
-    @abstractmethod
     def writeFile( self, localFilePath, jobStoreID=None ):
         """
         Takes a file (as a path) and places it in this job store. Returns an ID that can be used
@@ -262,10 +696,20 @@ class AbstractJobStore( object ):
         jobStoreID is the id of a job, or None. If specified, when delete(job) 
         is called all files written with the given job.jobStoreID will be 
         removed from the jobStore.
+        
+        If the fileDeduplication option is set the file is hashed first, and if the job store
+        holds a file with the same content the new file shares its storage, without the file
+        being copied into the job store, see _linkBlob.
         """
-        raise NotImplementedError( )
+        return self._deduplicateFile( localFilePath, jobStoreID, move=False )
     
-    @abstractmethod
+    def moveFile( self, localFilePath, jobStoreID=None ):
+        """
+        Like writeFile, but the local file is removed, which allows job stores on the same file
+        system as the file to move it rather than copy it.
+        """
+        return self._deduplicateFile( localFilePath, jobStoreID, move=True )
+
     @contextmanager
     def writeFileStream( self, jobStoreID=None ):
         """
@@ -273,8 +717,25 @@ class AbstractJobStore( object ):
         1) a file handle which can be written to and 2) the ID of the resulting 
         file in the job store. The yielded file handle does not need to and 
         should not be closed explicitly.
+        
+        If the fileCompression option is set what is written is compressed, unless the first
+        compressionSampleSize bytes written compress to more than maxCompressionRatio of their
+        size, in which case the file is stored as written. The bytes saved are added to
+        compressionSavedBytes. The yielded file handle then lacks fileno, as it does whenever
+        files may have been compressed, see _fileCodec. Otherwise it is the file handle of the
+        job store.
+        
+        If the fileDeduplication option is set what is written is hashed, and once the file is
+        written it shares the storage of any file with the same content, see _addBlob.
         """
-        raise NotImplementedError( )
+        hashingFileHandle = None
+        with self._writeFileStream( jobStoreID ) as ( fileHandle, jobStoreFileID ):
+            with self._compressingFileStream( fileHandle ) as fileHandle:
+                if self.config.fileDeduplication:
+                    fileHandle = hashingFileHandle = _HashingFileStream( fileHandle )
+                yield fileHandle, jobStoreFileID
+        if hashingFileHandle is not None:
+            self._addBlob( jobStoreFileID, hashingFileHandle.hexdigest( ) )
     
     @abstractmethod
     def getEmptyFileStoreID( self, jobStoreID=None ):
@@ -289,22 +750,81 @@ class AbstractJobStore( object ):
         """
         raise NotImplementedError( )
 
-    @abstractmethod
     def readFile( self, jobStoreFileID, localFilePath ):
         """
         Copies the file referenced by jobStoreFileID to the given local file path. The version
         will be consistent with the last copy of the file written/updated.
         """
-        raise NotImplementedError( )
+        if self._isCompressedFile( jobStoreFileID ):
+            self._decompressFile( jobStoreFileID, localFilePath )
+        else:
+            self._readFile( jobStoreFileID, localFilePath )
     
-    @abstractmethod
+    def linkFile( self, jobStoreFileID, localFilePath ):
+        """
+        Like readFile, but the local file may share its storage with the file in the job store,
+        so must not be modified, and may be read-only. Job stores on the same file system as the
+        local file can use this to avoid copying the file.
+        """
+        if self._isCompressedFile( jobStoreFileID ):
+            self._decompressFile( jobStoreFileID, localFilePath )
+        else:
+            self._linkFile( jobStoreFileID, localFilePath )
+
     @contextmanager
     def readFileStream( self, jobStoreFileID ):
         """
         Similar to readFile, but returns a context manager yielding a file handle which can be
         read from. The yielded file handle does not need to and should not be closed explicitly.
         """
-        raise NotImplementedError( )
+        with self._readFileStream( jobStoreFileID ) as fileHandle:
+            yield self._decompressingFileStream( fileHandle )
+
+    @contextmanager
+    def readFileMemoryMap( self, jobStoreFileID ):
+        """
+        Similar to readFileStream, but the yielded object need only support the read, readline,
+        seek and tell methods of a file. Job stores on a local file system yield a memory map
+        of the file, which allows random access to the file without copying it.
+        """
+        if self._isCompressedFile( jobStoreFileID ):
+            with self._decompressedTempFile( jobStoreFileID ) as fileHandle:
+                yield fileHandle
+        else:
+            with self._readFileMemoryMap( jobStoreFileID ) as fileHandle:
+                yield fileHandle
+
+    def readFileRange( self, jobStoreFileID, start, end ):
+        """
+        Returns the content of the file between the byte offsets start (inclusive) and end
+        (exclusive), which is shorter than end - start if the file ends before end.
+        """
+        if not self._isCompressedFile( jobStoreFileID ):
+            return self._readFileRange( jobStoreFileID, start, end )
+        with self.readFileStream( jobStoreFileID ) as fileHandle:
+            return _readRange( fileHandle, start, end )
+
+    def getFileSize( self, jobStoreFileID ):
+        """
+        Returns the size in bytes of the file with the given ID.
+        """
+        if not self._isCompressedFile( jobStoreFileID ):
+            return self._getFileSize( jobStoreFileID )
+        with self.readFileStream( jobStoreFileID ) as fileHandle:
+            return _readSize( fileHandle )
+
+    @contextmanager
+    def readSeekableFileStream( self, jobStoreFileID ):
+        """
+        Similar to readFileStream, but the yielded file handle supports seek and tell, which
+        allows parts of the file to be read without reading the whole file.
+        """
+        if self._isCompressedFile( jobStoreFileID ):
+            with self._decompressedTempFile( jobStoreFileID ) as fileHandle:
+                yield fileHandle
+        else:
+            with self._readSeekableFileStream( jobStoreFileID ) as fileHandle:
+                yield fileHandle
 
     @abstractmethod
     def deleteFile( self, jobStoreFileID ):
@@ -315,14 +835,65 @@ class AbstractJobStore( object ):
         """
         raise NotImplementedError( )
     
+    #The maximum number of threads used by deleteFiles
+    maxDeleteThreads = 16
+
+    def deleteFiles( self, jobStoreFileIDs ):
+        """
+        Deletes the files with the given IDs from this job store, as deleteFile does. This
+        implementation deletes up to maxDeleteThreads files concurrently, job stores able to
+        delete several files in a single request should override it.
+        """
+        jobStoreFileIDs = list( jobStoreFileIDs )
+        if len( jobStoreFileIDs ) <= 1:
+            map( self.deleteFile, jobStoreFileIDs )
+            return
+        pool = ThreadPool( min( len( jobStoreFileIDs ), self.maxDeleteThreads ) )
+        try:
+            pool.map( self.deleteFile, jobStoreFileIDs )
+        finally:
+            pool.close( )
+            pool.join( )
+
     @abstractmethod
     def fileExists(self, jobStoreFileID ):
         """
         :rtype : True if the jobStoreFileID exists in the jobStore, else False
         """
         raise NotImplementedError()
+
+    #Bounds, in seconds, of the interval between the checks made by waitForDeletion
+    minPollInterval = 0.05
+    maxPollInterval = 1
+
+    def waitForDeletion( self, jobStoreFileIDs ):
+        """
+        Blocks until none of the files with the given IDs exist. This is used to signal between
+        concurrently running jobs, see toil.job.ServiceJob. The files are checked for with
+        fileExists, with the interval between checks doubling from minPollInterval up to
+        maxPollInterval, unless the job store is notified of a change in the meantime,
+        see _watchFiles.
+        """
+        jobStoreFileIDs = list( jobStoreFileIDs )
+        with self._watchFiles( jobStoreFileIDs ) as waitForChange:
+            interval = self.minPollInterval
+            while True:
+                jobStoreFileIDs = [ i for i in jobStoreFileIDs if self.fileExists( i ) ]
+                if len( jobStoreFileIDs ) == 0:
+                    break
+                waitForChange( interval )
+                interval = min( 2 * interval, self.maxPollInterval )
+
+    @contextmanager
+    def _watchFiles( self, jobStoreFileIDs ):
+        """
+        Context manager used by waitForDeletion, returning a function that takes a timeout in
+        seconds and blocks until the timeout has expired or any of the given files may have
+        changed. Job stores that can be notified of changes to files should override this, the
+        default implementation simply sleeps for the timeout.
+        """
+        yield time.sleep
     
-    @abstractmethod
     def updateFile( self, jobStoreFileID, localFilePath ):
         """
         Replaces the existing version of a file in the jobStore. Throws an exception if the file
@@ -331,8 +902,310 @@ class AbstractJobStore( object ):
         :raises ConcurrentFileModificationException: if the file was modified concurrently during
         an invocation of this method
         """
+        if not self._compressesWell( localFilePath ):
+            self._updateFile( jobStoreFileID, localFilePath )
+        else:
+            with self._updateFileStream( jobStoreFileID ) as fileHandle:
+                self._compressFile( localFilePath, fileHandle )
+        #The file no longer shares the storage of the files it was written with
+        if self.config.fileDeduplication:
+            self._releaseBlob( jobStoreFileID )
+    
+    @contextmanager
+    def updateFileStream( self, jobStoreFileID ):
+        """
+        Similar to updateFile, but returns a context manager yielding a file handle to which the
+        new version of the file is written.
+        """
+        with self._updateFileStream( jobStoreFileID ) as fileHandle:
+            with self._compressingFileStream( fileHandle ) as fileHandle:
+                yield fileHandle
+        if self.config.fileDeduplication:
+            self._releaseBlob( jobStoreFileID )
+    
+    ##########################################
+    #The following store the files as they are given, for the methods above, which compress
+    #and deduplicate them. Job stores implement the abstract ones, and can override the others
+    #where they are able to do better.
+    ##########################################
+    
+    @abstractmethod
+    def _writeFile( self, localFilePath, jobStoreID=None ):
+        """
+        See writeFile.
+        """
+        raise NotImplementedError( )
+    
+    def _moveFile( self, localFilePath, jobStoreID=None ):
+        """
+        See moveFile. This implementation copies the file.
+        """
+        jobStoreFileID = self._writeFile( localFilePath, jobStoreID )
+        os.remove( localFilePath )
+        return jobStoreFileID
+    
+    @abstractmethod
+    @contextmanager
+    def _writeFileStream( self, jobStoreID=None ):
+        """
+        See writeFileStream.
+        """
+        raise NotImplementedError( )
+    
+    @abstractmethod
+    def _readFile( self, jobStoreFileID, localFilePath ):
+        """
+        See readFile.
+        """
+        raise NotImplementedError( )
+    
+    def _linkFile( self, jobStoreFileID, localFilePath ):
+        """
+        See linkFile. This implementation copies the file.
+        """
+        self._readFile( jobStoreFileID, localFilePath )
+    
+    @abstractmethod
+    @contextmanager
+    def _readFileStream( self, jobStoreFileID ):
+        """
+        See readFileStream.
+        """
+        raise NotImplementedError( )
+    
+    @contextmanager
+    def _readFileMemoryMap( self, jobStoreFileID ):
+        """
+        See readFileMemoryMap. This implementation yields the file handle of _readFileStream.
+        """
+        with self._readFileStream( jobStoreFileID ) as fileHandle:
+            yield fileHandle
+    
+    def _readFileRange( self, jobStoreFileID, start, end ):
+        """
+        See readFileRange. This implementation reads the whole file, job stores able to read
+        part of a file should override it.
+        """
+        with self._readFileStream( jobStoreFileID ) as fileHandle:
+            return _readRange( fileHandle, start, end )
+    
+    def _getFileSize( self, jobStoreFileID ):
+        """
+        See getFileSize. This implementation reads the whole file, job stores able to look up
+        the size of a file should override it.
+        """
+        with self._readFileStream( jobStoreFileID ) as fileHandle:
+            return _readSize( fileHandle )
+    
+    @contextmanager
+    def _readSeekableFileStream( self, jobStoreFileID ):
+        """
+        See readSeekableFileStream. This implementation yields a SeekableFileStream.
+        """
+        yield SeekableFileStream( self, jobStoreFileID )
+    
+    @abstractmethod
+    def _updateFile( self, jobStoreFileID, localFilePath ):
+        """
+        See updateFile.
+        """
+        raise NotImplementedError( )
+    
+    @abstractmethod
+    @contextmanager
+    def _updateFileStream( self, jobStoreFileID ):
+        """
+        See updateFileStream.
+        """
         raise NotImplementedError( )
     
+    def _linkBlob( self, contentHash, jobStoreID=None ):
+        """
+        Creates a file, as _writeFile does, sharing the storage of the files with the given
+        content hash, a blob, if the job store holds one, see _addBlob. 
+        
+        This implementation returns None, for job stores that do not deduplicate files.
+        
+        :rtype : string, the ID of the new file, or None if there is no blob with the hash.
+        """
+        return None
+    
+    def _addBlob( self, jobStoreFileID, contentHash ):
+        """
+        Records that the file, just written by _writeFile, _moveFile or _writeFileStream, has
+        the given content hash. If the job store holds a blob with the hash the file is made
+        to share its storage, otherwise the file becomes the blob. Job stores count the files
+        sharing each blob, removing it when the last of them is deleted or updated, see
+        _releaseBlob.
+        
+        This implementation does nothing, for job stores that do not deduplicate files.
+        """
+        pass
+    
+    def _releaseBlob( self, jobStoreFileID ):
+        """
+        Removes the file from the files sharing a blob, if any, as it is being deleted or has
+        been updated. Job stores that deduplicate files call this from deleteFile and delete.
+        
+        This implementation does nothing, for job stores that do not deduplicate files.
+        """
+        pass
+    
+    def _deduplicateFile( self, localFilePath, jobStoreID, move ):
+        """
+        Stores the local file, moving it if move is True, unless the fileDeduplication option
+        is set and the job store holds a blob with the same content, see writeFile.
+        
+        :rtype : string, the ID of the new file.
+        """
+        storeFile = self._storeMovedFile if move else self._storeFile
+        if not self.config.fileDeduplication:
+            return storeFile( localFilePath, jobStoreID )
+        contentHash = _hashFile( localFilePath )
+        jobStoreFileID = self._linkBlob( contentHash, jobStoreID )
+        if jobStoreFileID is not None:
+            if move:
+                os.remove( localFilePath )
+            return jobStoreFileID
+        jobStoreFileID = storeFile( localFilePath, jobStoreID )
+        self._addBlob( jobStoreFileID, contentHash )
+        return jobStoreFileID
+    
+    def _storeFile( self, localFilePath, jobStoreID ):
+        """
+        Stores the local file for writeFile, compressing it if it compresses well.
+        
+        :rtype : string, the ID of the new file.
+        """
+        if not self._compressesWell( localFilePath ):
+            return self._writeFile( localFilePath, jobStoreID )
+        with self._writeFileStream( jobStoreID ) as ( fileHandle, jobStoreFileID ):
+            self._compressFile( localFilePath, fileHandle )
+        return jobStoreFileID
+    
+    def _storeMovedFile( self, localFilePath, jobStoreID ):
+        """
+        Stores the local file for moveFile, see _storeFile.
+        
+        :rtype : string, the ID of the new file.
+        """
+        if not self._compressesWell( localFilePath ):
+            return self._moveFile( localFilePath, jobStoreID )
+        with self._writeFileStream( jobStoreID ) as ( fileHandle, jobStoreFileID ):
+            self._compressFile( localFilePath, fileHandle )
+        os.remove( localFilePath )
+        return jobStoreFileID
+    
+    #The number of bytes written to a file from which it is decided whether to compress it,
+    #and the ratio of the compressed to the uncompressed size of those bytes above which the
+    #file is stored uncompressed, see writeFileStream
+    compressionSampleSize = 1 << 16
+    maxCompressionRatio = 0.9
+    
+    def _fileCodec( self ):
+        """
+        :rtype : tuple of the codec used to compress files, the number of bytes written to a
+        file from which it is decided whether to compress it and the maximum compression ratio
+        of those bytes for the file to be compressed, or None if files are stored as written.
+        If the fileCompression option is not set but files may have been compressed, see
+        writeConfigToStore, only files whose content starts as that of a compressed file does
+        are compressed, so that they are not taken for compressed files when read.
+        """
+        if self.config.fileCompression != 'none':
+            return ( self.config.fileCompression, self.compressionSampleSize,
+                     self.maxCompressionRatio )
+        if self.config.filesCompressed:
+            return 'zlib', _compressedFileHeaderSize, 0
+        return None
+    
+    def _compressesWell( self, localFilePath ):
+        """
+        :rtype : True if the start of the local file compresses well enough for the file to be
+        compressed, see writeFileStream and _fileCodec.
+        """
+        fileCodec = self._fileCodec( )
+        if fileCodec is None:
+            return False
+        codec, sampleSize, maxRatio = fileCodec
+        with open( localFilePath, 'rb' ) as fileHandle:
+            sample = fileHandle.read( sampleSize )
+        return _compressesWell( codec, sample, maxRatio )
+    
+    def _compressFile( self, localFilePath, fileHandle ):
+        """
+        Writes the local file, compressed, to the file handle of _writeFileStream or
+        _updateFileStream.
+        """
+        with open( localFilePath, 'rb' ) as localFileHandle:
+            with self._compressingFileStream( fileHandle ) as fileHandle:
+                shutil.copyfileobj( localFileHandle, fileHandle, _blockSize )
+    
+    @contextmanager
+    def _compressingFileStream( self, fileHandle ):
+        """
+        Context manager yielding a file handle that compresses what is written to it into the
+        given file handle, if it compresses well enough, see writeFileStream and _fileCodec.
+        """
+        fileCodec = self._fileCodec( )
+        if fileCodec is None:
+            yield fileHandle
+            return
+        compressingFileHandle = _CompressingFileStream( fileHandle, *fileCodec )
+        yield compressingFileHandle
+        compressingFileHandle.close( )
+        self.compressionSavedBytes += compressingFileHandle.savedBytes
+    
+    def _isCompressedFile( self, jobStoreFileID ):
+        """
+        :rtype : True if the file was compressed when it was written, which is found by reading
+        the start of the file. Files are only read this way if they may have been compressed,
+        see writeConfigToStore, whatever the fileCompression option is now set to.
+        """
+        if not self.config.filesCompressed and self.config.fileCompression == 'none':
+            return False
+        return _isCompressed( self._readFileRange( jobStoreFileID, 0, _compressedFileHeaderSize ) )
+    
+    def _decompressingFileStream( self, fileHandle ):
+        """
+        :rtype : a file handle reading the content of the file read by the given file handle,
+        from _readFileStream, decompressing it if it was compressed when written.
+        """
+        if not self.config.filesCompressed and self.config.fileCompression == 'none':
+            return fileHandle
+        header = _readBytes( fileHandle, _compressedFileHeaderSize )
+        if _isCompressed( header ):
+            return _DecompressingFileStream( fileHandle, _fileDecompressors[ header[ -1 ] ]( ) )
+        try:
+            fileHandle.seek( 0 )
+            return fileHandle
+        except ( AttributeError, IOError ):
+            #Not seekable, so the header that was read is passed through
+            return _DecompressingFileStream( fileHandle, None, header )
+    
+    def _decompressFile( self, jobStoreFileID, localFilePath ):
+        """
+        Copies the content of the compressed file to the local file.
+        """
+        with self.readFileStream( jobStoreFileID ) as fileHandle:
+            with open( localFilePath, 'wb' ) as localFileHandle:
+                shutil.copyfileobj( fileHandle, localFileHandle, _blockSize )
+    
+    #The size in bytes above which the decompressed content of a file given to a seekable file
+    #handle is kept in a temporary file rather than in memory
+    maxSpooledFileSize = 1 << 24
+    
+    @contextmanager
+    def _decompressedTempFile( self, jobStoreFileID ):
+        """
+        Context manager yielding a temporary file, which is seekable, holding the content of
+        the compressed file.
+        """
+        with tempfile.SpooledTemporaryFile( max_size=self.maxSpooledFileSize ) as tempFile:
+            with self.readFileStream( jobStoreFileID ) as fileHandle:
+                shutil.copyfileobj( fileHandle, tempFile, _blockSize )
+            tempFile.seek( 0 )
+            yield tempFile
+    
     ##########################################
     #The following methods deal with shared files, i.e. files not associated 
     #with specific jobs.
@@ -380,8 +1253,12 @@ class AbstractJobStore( object ):
         For each stats/logging file calls the statsAndLoggingCallBackFn with 
         an open, readable file-handle that can be used to parse the stats.
         Returns the number of stat/logging strings processed. 
-        Stats/logging files are only read once and are removed from the 
+        Stats/logging files are only read once and are removed from the
         file store after being written to the given file handle.
+
+        This is called repeatedly by the leader, see toil.leader.statsAndLoggingAggregatorProcess,
+        so should be cheap when there is nothing to read. Job stores may keep the strings in
+        an append-only log, of which each call reads the records written since the last.
         """
         raise NotImplementedError( )
 
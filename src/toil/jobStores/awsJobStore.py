@@ -63,7 +63,7 @@ class AWSJobStore(AbstractJobStore):
     A job store that uses Amazon's S3 for file storage and SimpleDB for storing job info and enforcing strong
     consistency on the S3 file storage. There will be SDB domains for jobs and versions and versioned S3 buckets for
     files and stats. The content of files and stats are stored as keys on the respective bucket while the latest
-    version of a key is stored in the versions SDB domain. Job objects are pickled, compressed, partitioned into
+    version of a key is stored in the versions SDB domain. Job objects are encoded, compressed, partitioned into
     chunks of 1024 bytes and each chunk is stored as a an attribute of the SDB item representing the job. UUIDs are
     used to identify jobs and files.
     """
@@ -94,7 +94,7 @@ class AWSJobStore(AbstractJobStore):
         for attempt in retry_sdb():
             with attempt:
                 assert self.jobDomain.put_attributes(item_name=jobStoreID,
-                                                     attributes=job.toItem())
+                                                     attributes=job.toItem(self.config.jobCompression))
         return job
 
     def __init__(self, region, namePrefix, config=None):
@@ -110,6 +110,7 @@ class AWSJobStore(AbstractJobStore):
         """
         log.debug("Instantiating %s for region %s and name prefix '%s'",
                   self.__class__, region, namePrefix)
+        self._checkConfig(config)
         self.region = region
         self.namePrefix = namePrefix
         self.jobDomain = None
@@ -159,7 +160,7 @@ class AWSJobStore(AbstractJobStore):
                                                           attribute_name=[],
                                                           consistent_read=True))
 
-    def getPublicUrl(self, jobStoreFileID):
+    def _getPublicUrl(self, jobStoreFileID):
         """
         For Amazon SimpleDB requests, use HTTP GET requests that are URLs with query strings.
         http://awsdocs.s3.amazonaws.com/SDB/latest/sdb-dg.pdf
@@ -173,7 +174,7 @@ class AWSJobStore(AbstractJobStore):
 
     def getSharedPublicUrl(self, FileName):
         jobStoreFileID = self._newFileID(FileName)
-        return self.getPublicUrl(jobStoreFileID)
+        return self._getPublicUrl(jobStoreFileID)
 
     def load(self, jobStoreID):
         # TODO: check if mentioning individual attributes is faster than using *
@@ -199,7 +200,7 @@ class AWSJobStore(AbstractJobStore):
         for attempt in retry_sdb():
             with attempt:
                 assert self.jobDomain.put_attributes(item_name=job.jobStoreID,
-                                                     attributes=job.toItem())
+                                                     attributes=job.toItem(self.config.jobCompression))
 
     items_per_batch_delete = 25
 
@@ -219,20 +220,9 @@ class AWSJobStore(AbstractJobStore):
         assert items is not None
         if items:
             log.debug("Deleting %d file(s) associated with job %s", len(items), jobStoreID)
-            n = self.items_per_batch_delete
-            batches = [items[i:i + n] for i in range(0, len(items), n)]
-            for batch in batches:
-                for attempt in retry_sdb():
-                    with attempt:
-                        self.versions.batch_delete_attributes({item.name: None for item in batch})
-            for item in items:
-                if 'version' in item:
-                    self.files.delete_key(key_name=item.name,
-                                          version_id=item['version'])
-                else:
-                    self.files.delete_key(key_name=item.name)
+            self._deleteFileItems(items)
 
-    def writeFile(self, localFilePath, jobStoreID=None):
+    def _writeFile(self, localFilePath, jobStoreID=None):
         jobStoreFileID = self._newFileID()
         firstVersion = self._upload(jobStoreFileID, localFilePath)
         self._registerFile(jobStoreFileID, jobStoreID=jobStoreID, newVersion=firstVersion)
@@ -241,7 +231,7 @@ class AWSJobStore(AbstractJobStore):
         return jobStoreFileID
 
     @contextmanager
-    def writeFileStream(self, jobStoreID=None):
+    def _writeFileStream(self, jobStoreID=None):
         jobStoreFileID = self._newFileID()
         with self._uploadStream(jobStoreFileID, self.files) as (writable, key):
             yield writable, jobStoreFileID
@@ -270,7 +260,7 @@ class AWSJobStore(AbstractJobStore):
             log.debug("Wrote version %s of file %s (%s), replacing version %s",
                       newVersion, sharedFileName, jobStoreFileID, oldVersion)
 
-    def updateFile(self, jobStoreFileID, localFilePath):
+    def _updateFile(self, jobStoreFileID, localFilePath):
         oldVersion = self._getFileVersion(jobStoreFileID)
         newVersion = self._upload(jobStoreFileID, localFilePath)
         self._registerFile(jobStoreFileID, oldVersion=oldVersion, newVersion=newVersion)
@@ -278,7 +268,7 @@ class AWSJobStore(AbstractJobStore):
                   newVersion, jobStoreFileID, localFilePath, oldVersion)
 
     @contextmanager
-    def updateFileStream(self, jobStoreFileID):
+    def _updateFileStream(self, jobStoreFileID):
         oldVersion = self._getFileVersion(jobStoreFileID)
         with self._uploadStream(jobStoreFileID, self.files) as (writable, key):
             yield writable
@@ -287,7 +277,7 @@ class AWSJobStore(AbstractJobStore):
         log.debug("Wrote version %s of file %s, replacing version %s",
                   newVersion, jobStoreFileID, oldVersion)
 
-    def readFile(self, jobStoreFileID, localFilePath):
+    def _readFile(self, jobStoreFileID, localFilePath):
         version = self._getFileVersion(jobStoreFileID)
         if version is None: raise NoSuchFileException(jobStoreFileID)
         log.debug("Reading version %s of file %s to path '%s'",
@@ -295,13 +285,38 @@ class AWSJobStore(AbstractJobStore):
         self._download(jobStoreFileID, localFilePath, version)
 
     @contextmanager
-    def readFileStream(self, jobStoreFileID):
+    def _readFileStream(self, jobStoreFileID):
         version = self._getFileVersion(jobStoreFileID)
         if version is None: raise NoSuchFileException(jobStoreFileID)
         log.debug("Reading version %s of file %s", version, jobStoreFileID)
         with self._downloadStream(jobStoreFileID, version, self.files) as readable:
             yield readable
 
+    def _readFileRange(self, jobStoreFileID, start, end):
+        version = self._getFileVersion(jobStoreFileID)
+        if version is None: raise NoSuchFileException(jobStoreFileID)
+        log.debug("Reading bytes %i to %i of version %s of file %s",
+                  start, end, version, jobStoreFileID)
+        if end <= start:
+            return ''
+        headers = {}
+        self.__add_encryption_headers(headers)
+        key = self.files.get_key(jobStoreFileID, headers=headers)
+        headers['Range'] = 'bytes=%i-%i' % (start, end - 1)
+        try:
+            return key.get_contents_as_string(headers=headers, version_id=version)
+        except S3ResponseError as e:
+            if e.status == 416: #The range starts beyond the end of the file
+                return ''
+            raise
+
+    def _getFileSize(self, jobStoreFileID):
+        version = self._getFileVersion(jobStoreFileID)
+        if version is None: raise NoSuchFileException(jobStoreFileID)
+        headers = {}
+        self.__add_encryption_headers(headers)
+        return self.files.get_key(jobStoreFileID, headers=headers, version_id=version).size
+
     @contextmanager
     def readSharedFileStream(self, sharedFileName, isProtected=True):
         assert self._validateSharedFileName(sharedFileName)
@@ -333,6 +348,49 @@ class AWSJobStore(AbstractJobStore):
         else:
             log.debug("File %s does not exist", jobStoreFileID)
 
+    # The maximum number of comparisons in a SimpleDB select expression
+    items_per_select = 20
+
+    def deleteFiles(self, jobStoreFileIDs):
+        jobStoreFileIDs = list(jobStoreFileIDs)
+        items = []
+        n = self.items_per_select
+        for i in range(0, len(jobStoreFileIDs), n):
+            batch = None
+            for attempt in retry_sdb():
+                with attempt:
+                    batch = list(self.versions.select(
+                        query="select * from `%s` where itemName() in (%s)" % (
+                            self.versions.name,
+                            ", ".join("'%s'" % j for j in jobStoreFileIDs[i:i + n])),
+                        consistent_read=True))
+            assert batch is not None
+            items.extend(batch)
+        log.debug("Deleting %d of %d file(s)", len(items), len(jobStoreFileIDs))
+        self._deleteFileItems(items)
+
+    def _deleteFileItems(self, items):
+        """
+        Deletes the files registered by the given items of the versions domain, deleting the
+        items in batches and the S3 keys with multi-object deletes.
+        """
+        n = self.items_per_batch_delete
+        for i in range(0, len(items), n):
+            for attempt in retry_sdb():
+                with attempt:
+                    self.versions.batch_delete_attributes(
+                        {item.name: None for item in items[i:i + n]})
+        keys = {}
+        for item in items:
+            if 'version' in item:
+                keys.setdefault(item['bucketName'], []).append((item.name, item['version']))
+            elif 'bucketName' in item:
+                keys.setdefault(item['bucketName'], []).append(item.name)
+        for bucketName, bucketKeys in keys.iteritems():
+            result = getattr(self, bucketName).delete_keys(bucketKeys)
+            for error in result.errors:
+                log.warning("Failed to delete file %s: %s", error.key, error.message)
+
     def getEmptyFileStoreID(self, jobStoreID=None):
         jobStoreFileID = self._newFileID()
         self._registerFile(jobStoreFileID, jobStoreID=jobStoreID)
@@ -359,8 +417,8 @@ class AWSJobStore(AbstractJobStore):
         for item in items:
             with self._downloadStream(item.name, item['version'], self.stats) as readable:
                 statsCallBackFn(readable)
-            self.deleteFile(item.name)
             itemsProcessed += 1
+        self._deleteFileItems(items)
         return itemsProcessed
 
     # Dots in bucket names should be avoided because bucket names are used in HTTPS bucket
@@ -722,14 +780,21 @@ class AWSJob(JobWrapper):
             wholeJobString = chunkedJob[0][1]
         else:
             wholeJobString = ''.join(item[1] for item in chunkedJob)
-        return cPickle.loads(bz2.decompress(base64.b64decode(wholeJobString)))
+        wholeJobString = base64.b64decode(wholeJobString)
+        if cls.isEncoded(wholeJobString):
+            return cls.decode(wholeJobString)
+        # Jobs written by earlier versions are pickled and compressed with bz2
+        return cPickle.loads(bz2.decompress(wholeJobString))
 
-    def toItem(self):
+    def toItem(self, compression="zlib"):
         """
+        :param compression: the compression of the job, see JobWrapper.encode
+
         :rtype: Item
         """
         item = {}
-        serializedAndEncodedJob = base64.b64encode(bz2.compress(cPickle.dumps(self)))
+        # SDB attribute values are text, so the encoded job is base64 encoded
+        serializedAndEncodedJob = base64.b64encode(self.encode(compression))
         # this convoluted expression splits the string into chunks of 1024 - the max value for an attribute in SDB
         jobChunks = [serializedAndEncodedJob[i:i + 1024]
                      for i in range(0, len(serializedAndEncodedJob), 1024)]
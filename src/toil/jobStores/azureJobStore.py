@@ -72,6 +72,7 @@ class AzureJobStore(AbstractJobStore):
     Table Service to store job info with strong consistency."""
 
     def __init__(self, accountName, namePrefix, config=None, jobChunkSize=65535):
+        self._checkConfig(config)
         self.jobChunkSize = jobChunkSize
         self.keyPath = None
 
@@ -127,7 +128,7 @@ class AzureJobStore(AbstractJobStore):
                        command=command, memory=memory, cores=cores, disk=disk,
                        remainingRetryCount=self._defaultTryCount(), logJobStoreFileID=None,
                        updateID=updateID, predecessorNumber=predecessorNumber)
-        entity = job.toItem(chunkSize=self.jobChunkSize)
+        entity = job.toItem(chunkSize=self.jobChunkSize, compression=self.config.jobCompression)
         entity['RowKey'] = jobStoreID
         self.jobItems.insert_entity(entity=entity)
         return job
@@ -145,14 +146,14 @@ class AzureJobStore(AbstractJobStore):
 
     def update(self, job):
         self.jobItems.update_entity(row_key=job.jobStoreID,
-                                    entity=job.toItem(chunkSize=self.jobChunkSize))
+                                    entity=job.toItem(chunkSize=self.jobChunkSize,
+                                                      compression=self.config.jobCompression))
 
     def delete(self, jobStoreID):
         self.jobItems.delete_entity(row_key=jobStoreID)
         filterString = "PartitionKey eq '%s'" % jobStoreID
-        for fileEntity in self.jobFileIDs.query_entities(filter=filterString):
-            jobStoreFileID = fileEntity.RowKey
-            self.deleteFile(jobStoreFileID)
+        self.deleteFiles(fileEntity.RowKey
+                         for fileEntity in self.jobFileIDs.query_entities(filter=filterString))
 
     def deleteJobStore(self):
         self.registryTable.update_entity(row_key=self.namePrefix,
@@ -163,13 +164,13 @@ class AzureJobStore(AbstractJobStore):
         self.statsFiles.delete_container()
         self.statsFileIDs.delete_table()
 
-    def writeFile(self, localFilePath, jobStoreID=None):
+    def _writeFile(self, localFilePath, jobStoreID=None):
         jobStoreFileID = self._newFileID()
-        self.updateFile(jobStoreFileID, localFilePath)
+        self._updateFile(jobStoreFileID, localFilePath)
         self._associateFileWithJob(jobStoreFileID, jobStoreID)
         return jobStoreFileID
 
-    def updateFile(self, jobStoreFileID, localFilePath):
+    def _updateFile(self, jobStoreFileID, localFilePath):
         with open(localFilePath) as read_fd:
             with self._uploadStream(jobStoreFileID, self.files,
                                     encrypted=self.keyPath is not None) as write_fd:
@@ -179,7 +180,7 @@ class AzureJobStore(AbstractJobStore):
                     if len(buf) == 0:
                         break
 
-    def readFile(self, jobStoreFileID, localFilePath):
+    def _readFile(self, jobStoreFileID, localFilePath):
         try:
             with self._downloadStream(jobStoreFileID, self.files,
                                       encrypted=self.keyPath is not None) as read_fd:
@@ -206,7 +207,7 @@ class AzureJobStore(AbstractJobStore):
             return False
 
     @contextmanager
-    def writeFileStream(self, jobStoreID=None):
+    def _writeFileStream(self, jobStoreID=None):
         # TODO: this (and all stream methods) should probably use the
         # Append Blob type, but that is not currently supported by the
         # Azure Python API.
@@ -217,7 +218,7 @@ class AzureJobStore(AbstractJobStore):
         self._associateFileWithJob(jobStoreFileID, jobStoreID)
 
     @contextmanager
-    def updateFileStream(self, jobStoreFileID):
+    def _updateFileStream(self, jobStoreFileID):
         with self._uploadStream(jobStoreFileID, self.files, checkForModification=True,
                                 encrypted=self.keyPath is not None) as fd:
             yield fd
@@ -230,13 +231,38 @@ class AzureJobStore(AbstractJobStore):
         return jobStoreFileID
 
     @contextmanager
-    def readFileStream(self, jobStoreFileID):
+    def _readFileStream(self, jobStoreFileID):
         if not self.fileExists(jobStoreFileID):
             raise NoSuchFileException(jobStoreFileID)
         with self._downloadStream(jobStoreFileID, self.files,
                                   encrypted=self.keyPath is not None) as fd:
             yield fd
 
+    def _readFileRange(self, jobStoreFileID, start, end):
+        if self.keyPath is not None:
+            #Encrypted files are encrypted in blocks, see _uploadStream, so can not
+            #be read from an arbitrary offset
+            return super(AzureJobStore, self)._readFileRange(jobStoreFileID, start, end)
+        try:
+            blobProps = self.files.get_blob_properties(blob_name=jobStoreFileID)
+        except WindowsAzureMissingResourceError:
+            raise NoSuchFileException(jobStoreFileID)
+        end = min(end, int(blobProps['Content-Length']))
+        if end <= start:
+            return ''
+        return self.files.get_blob(blob_name=jobStoreFileID,
+                                   x_ms_range="bytes=%d-%d" % (start, end - 1))
+
+    def _getFileSize(self, jobStoreFileID):
+        if self.keyPath is not None:
+            #The size of an encrypted blob is not that of the file
+            return super(AzureJobStore, self)._getFileSize(jobStoreFileID)
+        try:
+            blobProps = self.files.get_blob_properties(blob_name=jobStoreFileID)
+        except WindowsAzureMissingResourceError:
+            raise NoSuchFileException(jobStoreFileID)
+        return int(blobProps['Content-Length'])
+
     @contextmanager
     def writeSharedFileStream(self, sharedFileName, isProtected=True):
         sharedFileID = self._newFileID(sharedFileName)
@@ -274,7 +300,7 @@ class AzureJobStore(AbstractJobStore):
 
     _azureTimeFormat = "%Y-%m-%dT%H:%M:%SZ"
 
-    def getPublicUrl(self, jobStoreFileID):
+    def _getPublicUrl(self, jobStoreFileID):
         # By default, we provide a link to the file which expires in one hour.
         startTimeStr = (datetime.utcnow() - timedelta(minutes=5)).strftime(self._azureTimeFormat)
         endTimeStr = (datetime.utcnow() + timedelta(hours=1)).strftime(self._azureTimeFormat)
@@ -286,7 +312,7 @@ class AzureJobStore(AbstractJobStore):
 
     def getSharedPublicUrl(self, fileName):
         jobStoreFileID = self._newFileID(fileName)
-        return self.getPublicUrl(jobStoreFileID)
+        return self._getPublicUrl(jobStoreFileID)
 
     def _newJobID(self):
         # raw UUIDs don't work for Azure property names because the '-' character is disallowed.
@@ -558,15 +584,21 @@ class AzureJob(JobWrapper):
             wholeJobString = chunkedJob[0][1]
         else:
             wholeJobString = ''.join(item[1] for item in chunkedJob)
-        return cPickle.loads(bz2.decompress(base64.b64decode(wholeJobString)))
+        wholeJobString = base64.b64decode(wholeJobString)
+        if cls.isEncoded(wholeJobString):
+            return cls.decode(wholeJobString)
+        # Jobs written by earlier versions are pickled and compressed with bz2
+        return cPickle.loads(bz2.decompress(wholeJobString))
 
     # Max size of a string value in Azure is 64K
-    def toItem(self, chunkSize=65535):
+    def toItem(self, chunkSize=65535, compression="zlib"):
         """
+        :param compression: the compression of the job, see JobWrapper.encode
+
         :rtype: dict
         """
         item = {}
-        serializedAndEncodedJob = base64.b64encode(bz2.compress(cPickle.dumps(self)))
+        serializedAndEncodedJob = base64.b64encode(self.encode(compression))
         jobChunks = [serializedAndEncodedJob[i:i + chunkSize]
                      for i in range(0, len(serializedAndEncodedJob), chunkSize)]
         for attributeOrder, chunk in enumerate(jobChunks):
@@ -19,10 +19,23 @@ import marshal as pickler
 #import pickle as pickler
 #import json as pickler    
 import random
+import itertools
+import hashlib
+import socket
 import shutil
 import os
 import tempfile
 import stat
+import select
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import mmap
+import uuid
+import threading
+from io import BytesIO
+from collections import OrderedDict
 from toil.lib.bioio import absSymPath
 from toil.jobStores.abstractJobStore import AbstractJobStore, NoSuchJobException, \
     NoSuchFileException
@@ -35,32 +48,67 @@ class FileJobStore(AbstractJobStore):
     of functions see AbstractJobStore.
     """
 
-    def __init__(self, jobStoreDir, config=None):
+    def __init__(self, jobStoreDir, config=None, volumes=()):
         """
         :param jobStoreDir: Place to create jobStore
         :param config: See jobStores.abstractJobStore.AbstractJobStore.__init__
+        :param volumes: Further directories to create, for example on other file systems, over
+        which the jobs and files are spread when the jobStore is created. They are recorded
+        in jobStoreDir, so are ignored when an existing jobStore is loaded.
         :raise RuntimeError: if config != None and the jobStore already exists or
         config == None and the jobStore does not already exists. 
         """
-        #This is root directory in which everything in the store is kept
+        #This is root directory in which everything in the store is kept, apart from the
+        #jobs and files placed on the other volumes
         self.jobStoreDir = absSymPath(jobStoreDir)
         logger.info("Jobstore directory is: %s", self.jobStoreDir)
         #Safety checks for existing jobStore
         self._checkJobStoreCreation(config != None, os.path.exists(self.jobStoreDir), self.jobStoreDir)
-        #Directory where temporary files go
-        self.tempFilesDir = os.path.join(self.jobStoreDir, "tmp")
-        #Creation of jobStore, if necessary
+        #The file listing the volumes, the first being self.jobStoreDir
+        self.volumesPath = os.path.join(self.jobStoreDir, "volumes")
         if config != None:
-            os.mkdir(self.jobStoreDir)
-            os.mkdir(self.tempFilesDir)  
+            self.volumes = [ self.jobStoreDir ] + map(absSymPath, volumes)
+            for volume in self.volumes[1:]:
+                self._checkJobStoreCreation(True, os.path.exists(volume), volume)
+        else:
+            self.volumes = self._readVolumes()
+        #Directories where temporary files go, one per volume
+        self.tempFilesDirs = [ os.path.join(volume, "tmp") for volume in self.volumes ]
+        #The indices in self.volumes of the volumes of keys, see _getVolume
+        self._volumeCache = {}
+        #Directory holding the segments of the stats log, see writeStatsAndLogging
+        self.statsDir = os.path.join(self.jobStoreDir, "stats")
+        #Whether the stats files left in the temporary directories by earlier versions have
+        #been read, see readStatsAndLogging
+        self._readOldStats = False
+        #The index of the jobs in the store, see jobs
+        self.jobIndexPath = os.path.join(self.jobStoreDir, "jobs")
         #Parameters for creating temporary files
         self.validDirs = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789"
         self.levels = 2
+        #Creation of jobStore, if necessary
+        if config != None:
+            for volume, tempFilesDir in zip(self.volumes, self.tempFilesDirs):
+                os.mkdir(volume)
+                os.mkdir(tempFilesDir)  
+                self._createTempSharedDirs(tempFilesDir)
+            with open(self.volumesPath, 'w') as f:
+                for volume in self.volumes:
+                    f.write(volume + "\n")
+        #The stats directory is also created for jobStores made by earlier versions
+        try:
+            os.mkdir(self.statsDir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            self._createStatsSegment(0)
         super( FileJobStore, self ).__init__( config=config )
         
     def deleteJobStore(self):
-        if os.path.exists(self.jobStoreDir):
-            shutil.rmtree(self.jobStoreDir)
+        for volume in self.volumes:
+            if os.path.exists(volume):
+                shutil.rmtree(volume)
     
     ##########################################
     #The following methods deal with creating/loading/updating/writing/checking for the
@@ -69,10 +117,9 @@ class FileJobStore(AbstractJobStore):
     
     def create(self, command, memory, cores, disk, updateID=None,
                predecessorNumber=0):
-        #The absolute path to the job directory.
-        absJobDir = tempfile.mkdtemp(prefix="job", dir=self._getTempSharedDir())
-        #Sub directory to put temporary files associated with the job in
-        os.mkdir(os.path.join(absJobDir, "g"))
+        #The absolute path to the job directory. The sub directory to put temporary files
+        #associated with the job in is made by the first such file, see _getTempFile
+        absJobDir = self._makeInTempSharedDir(tempfile.mkdtemp, prefix="job")
         #Make the job
         job = JobWrapper(command=command, memory=memory, cores=cores, disk=disk,
                   jobStoreID=self._getRelativePath(absJobDir), 
@@ -81,18 +128,15 @@ class FileJobStore(AbstractJobStore):
                   predecessorNumber=predecessorNumber)
         #Write job file to disk
         self.update(job)
+        self._updateJobIndex("+" + job.jobStoreID)
         return job
     
     def exists(self, jobStoreID):
         return os.path.exists(self._getJobFileName(jobStoreID))
     
-    def getPublicUrl( self,  jobStoreFileID):
+    def _getPublicUrl( self,  jobStoreFileID):
         self._checkJobStoreFileID(jobStoreFileID)
-        jobStorePath = self._getAbsPath(jobStoreFileID)
-        if os.path.exists(jobStorePath):
-            return 'file:'+jobStorePath
-        else:
-            raise NoSuchFileException(jobStoreFileID)
+        return 'file:'+self._getAbsPath(jobStoreFileID)
 
     def getSharedPublicUrl( self,  FileName):
         jobStorePath = self.jobStoreDir+'/'+FileName
@@ -102,11 +146,19 @@ class FileJobStore(AbstractJobStore):
             raise NoSuchFileException(FileName)
 
     def load(self, jobStoreID):
-        self._checkJobStoreId(jobStoreID)
         #Load a valid version of the job
         jobFile = self._getJobFileName(jobStoreID)
-        with open(jobFile, 'r') as fileHandle:
-            job = JobWrapper.fromDict(pickler.load(fileHandle))
+        try:
+            fileHandle = open(jobFile, 'r')
+        except IOError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            raise NoSuchJobException(jobStoreID)
+        with fileHandle:
+            data = fileHandle.read()
+        #Jobs written by earlier versions are marshalled dictionaries
+        job = JobWrapper.decode(data) if JobWrapper.isEncoded(data) \
+            else JobWrapper.fromDict(pickler.loads(data))
         #The following cleans up any issues resulting from the failure of the 
         #job during writing by the batch system.
         if os.path.isfile(jobFile + ".new"):
@@ -121,56 +173,113 @@ class FileJobStore(AbstractJobStore):
         #Atomicity guarantees use the fact the underlying file systems "move"
         #function is atomic. 
         with open(self._getJobFileName(job.jobStoreID) + ".new", 'w') as f:
-            pickler.dump(job.toDict(), f)
+            f.write(job.encode(self.config.jobCompression))
         #This should be atomic for the file system
         os.rename(self._getJobFileName(job.jobStoreID) + ".new", self._getJobFileName(job.jobStoreID))
     
     def delete(self, jobStoreID):
         #The jobStoreID is the relative path to the directory containing the job,
         #removing this directory deletes the job.
-        if self.exists(jobStoreID):
+        if self.config.fileDeduplication:
+            self._releaseJobBlobs(jobStoreID)
+        try:
             shutil.rmtree(self._getAbsPath(jobStoreID))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        self._updateJobIndex("-" + jobStoreID)
  
     def jobs(self):
-        #Walk through list of temporary directories searching for jobs
-        for tempDir in self._tempDirectories():
-            for i in os.listdir(tempDir):
-                if i.startswith( 'job' ):
-                    yield self.load(self._getRelativePath(os.path.join(tempDir, i)))
+        #The jobs are listed by the index, rather than by walking the directories
+        if not os.path.exists(self.jobIndexPath): #Created by an older version
+            self._validateJobIndex()
+        for jobStoreID in self._readJobIndex():
+            try:
+                yield self.load(jobStoreID)
+            except NoSuchJobException:
+                pass #Deleted since the index was read, or by an interrupted delete
+    
+    def clean(self):
+        #The index may be inconsistent with the jobs if the job store was interrupted
+        self._validateJobIndex()
+        super(FileJobStore, self).clean()
  
     ##########################################
     #Functions that deal with temporary files associated with jobs
     ##########################################    
     
-    def writeFile(self, localFilePath, jobStoreID=None):
+    def _writeFile(self, localFilePath, jobStoreID=None):
+        fd, absPath = self._getTempFile(jobStoreID)
+        with open(localFilePath, 'rb') as src:
+            with os.fdopen(fd, 'wb') as dst:
+                _copyFileObject(src, dst)
+        return self._getRelativePath(absPath)
+
+    def _moveFile(self, localFilePath, jobStoreID=None):
         fd, absPath = self._getTempFile(jobStoreID)
-        shutil.copyfile(localFilePath, absPath)
         os.close(fd)
+        try:
+            os.rename(localFilePath, absPath)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            #On a different file system to the job store
+            os.remove(absPath)
+            return super(FileJobStore, self)._moveFile(localFilePath, jobStoreID)
         return self._getRelativePath(absPath)
     
     @contextmanager
-    def writeFileStream(self, jobStoreID=None):
+    def _writeFileStream(self, jobStoreID=None):
         fd, absPath = self._getTempFile(jobStoreID)
-        with open(absPath, 'w') as f:
+        with os.fdopen(fd, 'w') as f:
             yield f, self._getRelativePath(absPath)
-        os.close(fd) #Close the os level file descriptor
         
     def getEmptyFileStoreID(self, jobStoreID=None):
-        with self.writeFileStream(jobStoreID) as ( fileHandle, jobStoreFileID ):
+        with self._writeFileStream(jobStoreID) as ( fileHandle, jobStoreFileID ):
             return jobStoreFileID
 
-    def updateFile(self, jobStoreFileID, localFilePath):
+    def _updateFile(self, jobStoreFileID, localFilePath):
+        #The rename would create a missing file, so unlike the other operations on files this
+        #one must check for the file first
         self._checkJobStoreFileID(jobStoreFileID)
-        shutil.copyfile(localFilePath, self._getAbsPath(jobStoreFileID))
+        #Files are replaced rather than modified in place, as they may be linked to by
+        #local copies, see _linkFile
+        absPath = self._getAbsPath(jobStoreFileID)
+        tempPath = _getSiblingPath(absPath)
+        _copyFile(localFilePath, tempPath)
+        os.rename(tempPath, absPath)
     
-    def readFile(self, jobStoreFileID, localFilePath):
-        self._checkJobStoreFileID(jobStoreFileID)
-        shutil.copyfile(self._getAbsPath(jobStoreFileID), localFilePath)
+    def _readFile(self, jobStoreFileID, localFilePath):
+        with self._openFile(jobStoreFileID) as src:
+            with open(localFilePath, 'wb') as dst:
+                _copyFileObject(src, dst)
+
+    def _linkFile(self, jobStoreFileID, localFilePath):
+        absPath = self._getAbsPath(jobStoreFileID)
+        #Hard link the file, which is safe as files in the job store are never modified
+        #in place, see _updateFile. The file is made read-only, so that the link is.
+        tempPath = _getSiblingPath(localFilePath)
+        try:
+            os.link(absPath, tempPath)
+        except OSError:
+            #Most likely on a different file system to the job store. Otherwise the file is
+            #missing, which readFile reports
+            self._readFile(jobStoreFileID, localFilePath)
+            return
+        os.chmod(tempPath, os.stat(tempPath).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        os.rename(tempPath, localFilePath)
     
     def deleteFile(self, jobStoreFileID):
-        if not self.fileExists(jobStoreFileID):
-            return
-        os.remove(self._getAbsPath(jobStoreFileID))
+        try:
+            os.remove(self._getAbsPath(jobStoreFileID))
+        except OSError as e:
+            if e.errno in (errno.EISDIR, errno.EPERM):
+                raise NoSuchFileException("Path %s is not a file in the jobStore" % jobStoreFileID)
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+        if self.config.fileDeduplication:
+            self._releaseBlob(jobStoreFileID)
         
     def fileExists(self, jobStoreFileID):
         absPath = self._getAbsPath(jobStoreFileID)
@@ -183,19 +292,228 @@ class FileJobStore(AbstractJobStore):
         return True
 
     @contextmanager
-    def updateFileStream(self, jobStoreFileID):
+    def _watchFiles(self, jobStoreFileIDs):
+        #Use inotify, where available, to be woken when a file is removed from any of the
+        #directories containing the files. The waits still time out, as deletions made on
+        #other hosts sharing the file system are not reported.
+        fd = _inotifyInit()
+        if fd is not None:
+            for directory in set(os.path.dirname(self._getAbsPath(jobStoreFileID))
+                                 for jobStoreFileID in jobStoreFileIDs):
+                #Fails if the directory has gone, in which case so has the file. Otherwise,
+                #for example if the limit on the number of watches has been reached, we poll.
+                if (_libc.inotify_add_watch(fd, directory, _inotifyDeletionMask) < 0
+                    and ctypes.get_errno() != errno.ENOENT):
+                    logger.debug("Failed to watch directory %s, polling instead", directory)
+                    os.close(fd)
+                    fd = None
+                    break
+        if fd is None:
+            with super(FileJobStore, self)._watchFiles(jobStoreFileIDs) as waitForChange:
+                yield waitForChange
+            return
+        try:
+            def waitForChange(timeout):
+                if len(select.select([fd], [], [], timeout)[0]) > 0:
+                    os.read(fd, 1 << 16) #Discard the events
+            yield waitForChange
+        finally:
+            os.close(fd)
+
+    @contextmanager
+    def _updateFileStream(self, jobStoreFileID):
+        #Checked first, see _updateFile
         self._checkJobStoreFileID(jobStoreFileID)
         # File objects are context managers (CM) so we could simply return what open returns.
         # However, it is better to wrap it in another CM so as to prevent users from accessing
         # the file object directly, without a with statement.
-        with open(self._getAbsPath(jobStoreFileID), 'w') as f:
-            yield f
+        absPath = self._getAbsPath(jobStoreFileID)
+        tempPath = _getSiblingPath(absPath)
+        try:
+            with open(tempPath, 'w') as f:
+                yield f
+        except:
+            os.remove(tempPath)
+            raise
+        #Replaced rather than modified in place, see _updateFile
+        os.rename(tempPath, absPath)
     
     @contextmanager
-    def readFileStream(self, jobStoreFileID):
-        self._checkJobStoreFileID(jobStoreFileID)
-        with open(self._getAbsPath(jobStoreFileID), 'r') as f:
+    def _readFileStream(self, jobStoreFileID):
+        with self._openFile(jobStoreFileID) as f:
             yield f
+
+    def _readFileRange(self, jobStoreFileID, start, end):
+        with self._openFile(jobStoreFileID) as f:
+            f.seek(start)
+            return f.read(max(0, end - start))
+
+    def _getFileSize(self, jobStoreFileID):
+        return self._statFile(jobStoreFileID).st_size
+
+    #Files are seekable
+    _readSeekableFileStream = _readFileStream
+
+    @contextmanager
+    def _readFileMemoryMap(self, jobStoreFileID):
+        with self._openFile(jobStoreFileID) as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                #Empty files can not be mapped
+                yield f
+            else:
+                m = _MemoryMap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    yield m
+                finally:
+                    m.close()
+    
+    #Files with the same content are hard links to a blob on the volume of the files, a
+    #directory named by the content hash holding the content, in "data", and an entry for each
+    #file sharing it, in "refs". The blob is removed by the remover of the directory of entries,
+    #which fails while it holds any entries. Each file sharing a blob has a symbolic link to its
+    #entry beside it, suffixed by ".blob". Files whose writing races with the removal of the
+    #blob are left unshared, their content being safe in their own links.
+    
+    deduplicatesFiles = True
+    
+    def _linkBlob(self, contentHash, jobStoreID=None):
+        fd, absPath = self._getTempFile(jobStoreID)
+        os.close(fd)
+        if self._shareBlob(absPath, contentHash):
+            return self._getRelativePath(absPath)
+        os.remove(absPath)
+        return None
+    
+    def _addBlob(self, jobStoreFileID, contentHash):
+        absPath = self._getAbsPath(jobStoreFileID)
+        blobDir = self._getBlobDir(absPath, contentHash)
+        try:
+            os.mkdir(blobDir)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                self._shareBlob(absPath, contentHash)
+                return
+            if e.errno != errno.ENOENT:
+                raise
+            #The first blob in its directory
+            try:
+                os.makedirs(blobDir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                self._shareBlob(absPath, contentHash)
+                return
+        #The file becomes the blob
+        try:
+            os.mkdir(os.path.join(blobDir, "refs"))
+        except OSError as e:
+            if e.errno != errno.ENOENT: #Removed by a file that failed to share it
+                raise
+            return
+        if self._addBlobRef(absPath, blobDir):
+            os.link(absPath, os.path.join(blobDir, "data"))
+    
+    def _releaseBlob(self, jobStoreFileID):
+        absPath = self._getAbsPath(jobStoreFileID)
+        try:
+            refPath = os.readlink(absPath + ".blob")
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return #Not sharing a blob
+        os.remove(absPath + ".blob")
+        self._removeBlobRef(os.path.join(os.path.dirname(absPath), refPath))
+    
+    def _releaseJobBlobs(self, jobStoreID):
+        """
+        Releases the blobs of the files of the job, see _releaseBlob.
+        """
+        filesDir = os.path.join(self._getAbsPath(jobStoreID), "g")
+        try:
+            fileNames = os.listdir(filesDir)
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return
+        for fileName in fileNames:
+            if fileName.endswith(".blob"):
+                self._releaseBlob(self._getRelativePath(os.path.join(filesDir, fileName[:-5])))
+    
+    def _getBlobDir(self, absPath, contentHash):
+        """
+        :rtype : string, the directory of the blob with the given content hash on the volume of
+        the file with the given absolute path.
+        """
+        for volume, tempFilesDir in zip(self.volumes, self.tempFilesDirs):
+            if absPath.startswith(tempFilesDir + "/"):
+                return os.path.join(volume, "blobs", contentHash[:2], contentHash)
+        raise RuntimeError("Path %s is not in the jobStore" % absPath)
+    
+    def _shareBlob(self, absPath, contentHash):
+        """
+        Replaces the file at the given absolute path by a link to the blob with the given
+        content hash, if it exists.
+        
+        :rtype : True if the file now shares the blob, else False.
+        """
+        blobDir = self._getBlobDir(absPath, contentHash)
+        if not self._addBlobRef(absPath, blobDir):
+            return False
+        tempPath = _getSiblingPath(absPath)
+        try:
+            os.link(os.path.join(blobDir, "data"), tempPath)
+        except OSError as e:
+            if e.errno != errno.ENOENT: 
+                raise
+            #Still being made by the file that becomes the blob
+            self._releaseBlob(self._getRelativePath(absPath))
+            return False
+        os.rename(tempPath, absPath)
+        return True
+    
+    def _addBlobRef(self, absPath, blobDir):
+        """
+        Adds an entry for the file at the given absolute path to the blob in blobDir, with the
+        symbolic link to it, see _linkBlob.
+        
+        :rtype : True if the entry was added, else False, as the blob is missing.
+        """
+        refPath = os.path.join(blobDir, "refs", uuid.uuid4().hex)
+        try:
+            os.close(os.open(refPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return False
+        os.symlink(os.path.relpath(refPath, os.path.dirname(absPath)), absPath + ".blob")
+        return True
+    
+    def _removeBlobRef(self, refPath):
+        """
+        Removes the entry at refPath from its blob, removing the blob if it was the last entry.
+        """
+        try:
+            os.remove(refPath)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        blobDir = os.path.dirname(os.path.dirname(refPath))
+        try:
+            os.rmdir(os.path.dirname(refPath))
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                raise
+            return #Shared by other files
+        try:
+            os.remove(os.path.join(blobDir, "data"))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        try:
+            os.rmdir(blobDir)
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                raise
             
     ##########################################
     #The following methods deal with shared files, i.e. files not associated 
@@ -206,36 +524,90 @@ class FileJobStore(AbstractJobStore):
     def writeSharedFileStream(self, sharedFileName, isProtected=True):
         # the isProtected parameter has no effect on the fileStore, but is needed on the awsJobStore
         assert self._validateSharedFileName( sharedFileName )
-        with open( os.path.join( self.jobStoreDir, sharedFileName ), 'w' ) as f:
+        path = os.path.join(self.jobStoreDir, sharedFileName)
+        with open(path, 'w') as f:
             yield f
+        #Copied to the other volumes, spreading the reads of shared files between them. Until
+        #this is done the readers of a copy see the previous version of the file.
+        for volume in self.volumes[1:]:
+            tempPath = _getSiblingPath(os.path.join(volume, sharedFileName))
+            _copyFile(path, tempPath)
+            os.rename(tempPath, os.path.join(volume, sharedFileName))
 
     @contextmanager
     def readSharedFileStream(self, sharedFileName, isProtected=True):
         # the isProtected parameter has no effect on the fileStore, but is needed on the awsJobStore
         assert self._validateSharedFileName( sharedFileName )
-        with open(os.path.join(self.jobStoreDir, sharedFileName), 'r') as f:
+        #Each host reads the copy on one volume, see writeSharedFileStream
+        volume = self.volumes[self._getVolume(socket.gethostname())]
+        try:
+            f = open(os.path.join(volume, sharedFileName), 'r')
+        except IOError as e:
+            if e.errno != errno.ENOENT or volume == self.jobStoreDir:
+                raise
+            f = open(os.path.join(self.jobStoreDir, sharedFileName), 'r') #Not yet copied
+        with f:
             yield f
              
+    #The size in bytes beyond which the stats log is continued in a new segment
+    statsSegmentSize = 1 << 24
+    
     def writeStatsAndLogging(self, statsAndLoggingString):
-        #Temporary files are placed in the set of temporary files/directoies
-        fd, tempStatsFile = tempfile.mkstemp(prefix="stats", suffix=".new", dir=self._getTempSharedDir())
-        with open(tempStatsFile, "w") as f:
-            f.write(statsAndLoggingString)
-        os.close(fd)
-        os.rename(tempStatsFile, tempStatsFile[:-4]) #This operation is atomic
+        #The stats are appended to a log, made of numbered segment files in self.statsDir, each
+        #record being the length of the string on a line followed by the string. Appends are
+        #made under a lock on the segment, so the records of concurrent writers do not
+        #interleave, and go to the last segment, which is never deleted by the reader
+        record = "%i\n%s" % (len(statsAndLoggingString), statsAndLoggingString)
+        while True:
+            segment = self._statsSegments()[-1]
+            try:
+                fd = os.open(self._getStatsSegmentPath(segment), os.O_WRONLY | os.O_APPEND)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue #The segment has been read and deleted, see readStatsAndLogging
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+                fileStat = os.fstat(fd)
+                if fileStat.st_nlink == 0:
+                    continue #Deleted while we waited for the lock
+                if fileStat.st_size >= self.statsSegmentSize:
+                    self._createStatsSegment(segment + 1)
+                    continue
+                while len(record) > 0:
+                    record = record[os.write(fd, record):]
+                return
+            finally:
+                os.close(fd) #Releasing the lock
         
     def readStatsAndLogging( self, statsAndLoggingCallBackFn):
-        numberOfFilesProcessed = 0
-        for tempDir in self._tempDirectories():
-            for tempFile in os.listdir(tempDir):
-                if tempFile.startswith( 'stats' ):
-                    absTempFile = os.path.join(tempDir, tempFile)
-                    if not tempFile.endswith( '.new' ):
-                        with open(absTempFile, 'r') as fH:
-                            statsAndLoggingCallBackFn(fH)
-                        numberOfFilesProcessed += 1
-                        os.remove(absTempFile)
-        return numberOfFilesProcessed
+        #The first call also reads any stats files written to the temporary directories by
+        #earlier versions, such as those left by a workflow being restarted
+        numberOfRecordsProcessed = 0
+        if not self._readOldStats:
+            numberOfRecordsProcessed += self._readOldStatsAndLogging(statsAndLoggingCallBackFn)
+            self._readOldStats = True
+        #Tails the stats log from the cursor saved by the previous call, deleting the segments
+        #that have been read once a later segment exists
+        segment, offset = self._readStatsCursor()
+        cursor = (segment, offset)
+        while True:
+            with open(self._getStatsSegmentPath(segment), 'rb') as fH:
+                offset, n = self._readStatsRecords(fH, offset, statsAndLoggingCallBackFn)
+                numberOfRecordsProcessed += n
+            if not os.path.exists(self._getStatsSegmentPath(segment + 1)):
+                break
+            #Writers that opened the segment before the next one was created may still be
+            #appending to it, so it is read to the end under the lock before being deleted
+            with open(self._getStatsSegmentPath(segment), 'r+b') as fH:
+                fcntl.lockf(fH.fileno(), fcntl.LOCK_EX)
+                offset, n = self._readStatsRecords(fH, offset, statsAndLoggingCallBackFn)
+                numberOfRecordsProcessed += n
+                os.remove(self._getStatsSegmentPath(segment))
+            segment, offset = segment + 1, 0
+        if (segment, offset) != cursor:
+            self._writeStatsCursor(segment, offset)
+        return numberOfRecordsProcessed
     
     ##########################################
     #Private methods
@@ -243,20 +615,57 @@ class FileJobStore(AbstractJobStore):
         
     def _getAbsPath(self, relativePath):
         """
+        The volume of a path is that of the directories at its top, in which the job or file
+        was placed at random, see _getTempSharedDir, so the jobs and files are spread over
+        the volumes.
+        
         :rtype : string, string is the absolute path to a file path relative
-        to the self.tempFilesDir.
+        to the self.tempFilesDirs.
         """
-        return os.path.join(self.tempFilesDir, relativePath)
+        volume = self._getVolume("/".join(relativePath.split("/", self.levels)[:self.levels]))
+        return os.path.join(self.tempFilesDirs[volume], relativePath)
     
     def _getRelativePath(self, absPath):
         """
         absPath  is the absolute path to a file in the store,.
         
         :rtype : string, string is the path to the absPath file relative to the 
-        self.tempFilesDir
+        self.tempFilesDirs
+        
+        """
+        for tempFilesDir in self.tempFilesDirs:
+            if absPath.startswith(tempFilesDir + "/"):
+                return absPath[len(tempFilesDir)+1:]
+        raise RuntimeError("Path %s is not in the jobStore" % absPath)
+    
+    def _getVolume(self, key):
+        """
+        Places the key on a volume by rendezvous hashing, a form of consistent hashing, so
+        adding a volume would move only the keys that it takes.
         
+        :rtype : int, the index in self.volumes of the volume of the key.
         """
-        return absPath[len(self.tempFilesDir)+1:]
+        if len(self.volumes) == 1:
+            return 0
+        try:
+            return self._volumeCache[key]
+        except KeyError:
+            volume = max(xrange(len(self.volumes)), 
+                         key=lambda i: hashlib.md5("%i %s" % (i, key)).digest())
+            self._volumeCache[key] = volume
+            return volume
+    
+    def _readVolumes(self):
+        """
+        :rtype : list of the volumes of the jobStore, see __init__.
+        """
+        try:
+            with open(self.volumesPath, 'r') as f:
+                return f.read().splitlines()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return [ self.jobStoreDir ] #Created by an earlier version
     
     def _getJobFileName(self, jobStoreID):
         """
@@ -265,13 +674,6 @@ class FileJobStore(AbstractJobStore):
         """
         return os.path.join(self._getAbsPath(jobStoreID), "job")
     
-    def _checkJobStoreId(self, jobStoreID):
-        """
-        Raises a NoSuchJobException if the jobStoreID does not exist.
-        """
-        if not self.exists(jobStoreID):
-            raise NoSuchJobException(jobStoreID)
-    
     def _checkJobStoreFileID(self, jobStoreFileID):
         """
         Raises NoSuchFileException if the jobStoreFileID does not exist or is not a file.
@@ -279,29 +681,89 @@ class FileJobStore(AbstractJobStore):
         if not self.fileExists(jobStoreFileID):
             raise NoSuchFileException("File %s does not exist in jobStore" % jobStoreFileID)
     
+    #The operations on files are attempted without first checking for the file, each check
+    #being a round trip to the server on a network file system, and the errors of the
+    #attempts are translated by the following methods
+    
+    def _openFile(self, jobStoreFileID):
+        """
+        Opens the file for reading.
+        
+        :rtype : file, raising NoSuchFileException if the jobStoreFileID does not exist or is
+        not a file.
+        """
+        try:
+            return open(self._getAbsPath(jobStoreFileID), 'rb')
+        except IOError as e:
+            if e.errno == errno.EISDIR:
+                raise NoSuchFileException("Path %s is not a file in the jobStore" % jobStoreFileID)
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            raise NoSuchFileException("File %s does not exist in jobStore" % jobStoreFileID)
+    
+    def _statFile(self, jobStoreFileID):
+        """
+        :rtype : the result of os.stat for the file, raising NoSuchFileException if the 
+        jobStoreFileID does not exist or is not a file.
+        """
+        try:
+            st = os.stat(self._getAbsPath(jobStoreFileID))
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            raise NoSuchFileException("File %s does not exist in jobStore" % jobStoreFileID)
+        if not stat.S_ISREG(st.st_mode):
+            raise NoSuchFileException("Path %s is not a file in the jobStore" % jobStoreFileID)
+        return st
+    
     def _getTempSharedDir(self):
         """
-        Gets a temporary directory in the hierarchy of directories in self.tempFilesDir.
-        This directory may contain multiple shared jobs/files.
+        Gets a temporary directory in the hierarchy of directories in self.tempFilesDirs.
+        This directory may contain multiple shared jobs/files. The directory is not checked
+        for, being made by the first file or directory placed in it, see _makeInTempSharedDir.
         
         :rtype : string, path to temporary directory in which to place files/directories.
         """
-        tempDir = self.tempFilesDir
-        for i in xrange(self.levels):
-            tempDir = os.path.join(tempDir, random.choice(self.validDirs))
-            if not os.path.exists(tempDir):
-                try:
-                    os.mkdir(tempDir)
-                except os.error:
-                    if not os.path.exists(tempDir): #In the case that a collision occurs and
-                        #it is created while we wait then we ignore
-                        raise
-        return tempDir
+        return self._getAbsPath(os.path.join(*(random.choice(self.validDirs) 
+                                               for i in xrange(self.levels))))
+    
+    def _createTempSharedDirs(self, tempFilesDir):
+        """
+        Makes the hierarchy of directories in tempFilesDir, see _getTempSharedDir, down
+        to the parents of the directories returned by _getTempSharedDir. Those are made as
+        they are used, there being too many to make in advance for small workflows.
+        """
+        for level in xrange(1, self.levels):
+            for path in itertools.product(self.validDirs, repeat=level):
+                os.mkdir(os.path.join(tempFilesDir, *path))
+    
+    def _makeInTempSharedDir(self, makeTemp, **kwargs):
+        """
+        Calls makeTemp, tempfile.mkstemp or tempfile.mkdtemp, to make a file or directory in a
+        directory from _getTempSharedDir, making the directory if that fails because it is
+        missing.
+        
+        :rtype : the result of makeTemp.
+        """
+        tempDir = self._getTempSharedDir()
+        try:
+            return makeTemp(dir=tempDir, **kwargs)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        try:
+            os.mkdir(tempDir)
+        except OSError as e:
+            if e.errno == errno.ENOENT: #So are its parents, in job stores made by earlier versions
+                os.makedirs(tempDir)
+            elif e.errno != errno.EEXIST: #Made by another process in the meantime
+                raise
+        return makeTemp(dir=tempDir, **kwargs)
      
     def _tempDirectories(self):
         """
         :rtype : an iterator to the temporary directories containing jobs/stats files
-        in the hierarchy of directories in self.tempFilesDir
+        in the hierarchy of directories in self.tempFilesDirs
         """
         def _dirs(path, levels):
             if levels > 0:
@@ -310,8 +772,184 @@ class FileJobStore(AbstractJobStore):
                         yield i
             else:
                 yield path
-        for tempDir in _dirs(self.tempFilesDir, self.levels):
-            yield tempDir
+        for tempFilesDir in self.tempFilesDirs:
+            for tempDir in _dirs(tempFilesDir, self.levels):
+                yield tempDir
+            
+    #The number of bytes by which the index of jobs grows between compactions
+    jobIndexCompactionSize = 1 << 20
+    
+    #Serialises the threads of the process changing the index of jobs, as the lock on the
+    #index, a lockf lock, is held by the process, see clean
+    _jobIndexLock = threading.Lock()
+    
+    def _updateJobIndex(self, record):
+        """
+        Appends the record, "+" for a created job or "-" for a deleted job followed by its
+        jobStoreID, to the index of jobs. The index is compacted, removing the deleted jobs,
+        each time it grows by another jobIndexCompactionSize bytes.
+        """
+        record += "\n"
+        with self._jobIndexLock:
+            while True:
+                fd = os.open(self.jobIndexPath, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX)
+                    fileStat = os.fstat(fd)
+                    if fileStat.st_nlink == 0:
+                        continue #Replaced by a compaction while we waited for the lock
+                    data = record
+                    while len(data) > 0:
+                        data = data[os.write(fd, data):]
+                    size = fileStat.st_size
+                    if size // self.jobIndexCompactionSize < (size + len(record)) // self.jobIndexCompactionSize:
+                        self._writeJobIndex(self._readJobIndex())
+                    return
+                finally:
+                    os.close(fd) #Releasing the lock
+    
+    def _readJobIndex(self):
+        """
+        :rtype : list of the jobStoreIDs of the jobs in the index, in the order of their creation.
+        """
+        jobStoreIDs = OrderedDict()
+        try:
+            with open(self.jobIndexPath, 'r') as fH:
+                for line in fH:
+                    if not line.endswith("\n"): #Still being written
+                        break
+                    if line[0] == "+":
+                        jobStoreIDs[line[1:-1]] = None
+                    else:
+                        jobStoreIDs.pop(line[1:-1], None)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return list(jobStoreIDs)
+    
+    def _writeJobIndex(self, jobStoreIDs):
+        """
+        Replaces the index of jobs with one listing the given jobStoreIDs. The caller must hold
+        the lock on the index.
+        """
+        tempPath = _getSiblingPath(self.jobIndexPath)
+        with open(tempPath, 'w') as fH:
+            for jobStoreID in jobStoreIDs:
+                fH.write("+%s\n" % jobStoreID)
+        os.rename(tempPath, self.jobIndexPath)
+    
+    def _validateJobIndex(self):
+        """
+        Rebuilds the index of jobs from the job directories. The index misses jobs whose
+        creation, or lists jobs whose deletion, was interrupted.
+        """
+        with self._jobIndexLock:
+            fd = os.open(self.jobIndexPath, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+                indexedJobStoreIDs = set(self._readJobIndex())
+                jobStoreIDs = []
+                for tempDir in self._tempDirectories():
+                    for i in os.listdir(tempDir):
+                        if i.startswith( 'job' ):
+                            jobStoreID = self._getRelativePath(os.path.join(tempDir, i))
+                            if self.exists(jobStoreID):
+                                jobStoreIDs.append(jobStoreID)
+                missing = len(set(jobStoreIDs) - indexedJobStoreIDs)
+                deleted = len(indexedJobStoreIDs - set(jobStoreIDs))
+                if missing > 0 or deleted > 0:
+                    logger.warn("The index of jobs missed %i jobs and listed %i deleted jobs, "
+                                "so has been rebuilt", missing, deleted)
+                self._writeJobIndex(jobStoreIDs)
+            finally:
+                os.close(fd)
+    
+    def _getStatsSegmentPath(self, segment):
+        """
+        :rtype : string, the path of the numbered segment of the stats log.
+        """
+        return os.path.join(self.statsDir, str(segment))
+    
+    def _statsSegments(self):
+        """
+        :rtype : list of the numbers of the segments of the stats log, in ascending order.
+        """
+        return sorted(int(i) for i in os.listdir(self.statsDir) if i.isdigit())
+    
+    def _createStatsSegment(self, segment):
+        """
+        Creates the numbered segment of the stats log, unless it exists.
+        """
+        try:
+            os.close(os.open(self._getStatsSegmentPath(segment), 
+                             os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    
+    def _readStatsRecords(self, fileHandle, offset, statsAndLoggingCallBackFn):
+        """
+        Calls statsAndLoggingCallBackFn for each complete record of the stats log segment
+        after the given offset.
+        
+        :rtype : int, int, the offset after the last complete record and the number of records.
+        """
+        fileHandle.seek(offset)
+        n = 0
+        while True:
+            header = fileHandle.readline()
+            if not header.endswith("\n"):
+                break
+            length = int(header)
+            statsAndLoggingString = fileHandle.read(length)
+            if len(statsAndLoggingString) < length: #Still being written
+                break
+            statsAndLoggingCallBackFn(BytesIO(statsAndLoggingString))
+            offset += len(header) + length
+            n += 1
+        return offset, n
+    
+    def _readOldStatsAndLogging(self, statsAndLoggingCallBackFn):
+        """
+        Calls statsAndLoggingCallBackFn for each stats file in the temporary directories, where
+        earlier versions wrote them one per file, deleting the files.
+        
+        :rtype : int, the number of files read.
+        """
+        numberOfFilesProcessed = 0
+        for tempDir in self._tempDirectories():
+            for tempFile in os.listdir(tempDir):
+                if tempFile.startswith('stats') and not tempFile.endswith('.new'):
+                    absTempFile = os.path.join(tempDir, tempFile)
+                    with open(absTempFile, 'r') as fH:
+                        statsAndLoggingCallBackFn(fH)
+                    numberOfFilesProcessed += 1
+                    os.remove(absTempFile)
+        return numberOfFilesProcessed
+    
+    def _readStatsCursor(self):
+        """
+        :rtype : int, int, the segment and offset in the stats log up to which the records
+        have been read, see readStatsAndLogging.
+        """
+        try:
+            with open(os.path.join(self.statsDir, "cursor"), 'r') as fH:
+                segment, offset = map(int, fH.read().split())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            segment, offset = self._statsSegments()[0], 0
+        if not os.path.exists(self._getStatsSegmentPath(segment)):
+            #Deleted by a reader that failed before saving the cursor
+            segment, offset = self._statsSegments()[0], 0
+        return segment, offset
+    
+    def _writeStatsCursor(self, segment, offset):
+        cursorPath = os.path.join(self.statsDir, "cursor")
+        tempPath = _getSiblingPath(cursorPath)
+        with open(tempPath, 'w') as fH:
+            fH.write("%i %i" % (segment, offset))
+        os.rename(tempPath, cursorPath)
             
     def _getTempFile(self, jobStoreID=None):
         """
@@ -321,10 +959,112 @@ class FileJobStore(AbstractJobStore):
         after writing some material to the file.
         """
         if jobStoreID != None:
-            #Make a temporary file within the job's directory
-            self._checkJobStoreId(jobStoreID)
-            return tempfile.mkstemp(suffix=".tmp", 
-                                dir=os.path.join(self._getAbsPath(jobStoreID), "g"))
+            #Make a temporary file within the job's directory, whose sub directory for files
+            #is made by the first file
+            tempDir = os.path.join(self._getAbsPath(jobStoreID), "g")
+            try:
+                return tempfile.mkstemp(suffix=".tmp", dir=tempDir)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            try:
+                os.mkdir(tempDir)
+            except OSError as e:
+                if e.errno in (errno.ENOENT, errno.ENOTDIR): #The job's directory is missing
+                    raise NoSuchJobException(jobStoreID)
+                if e.errno != errno.EEXIST:
+                    raise
+            return tempfile.mkstemp(suffix=".tmp", dir=tempDir)
         else:
             #Make a temporary file within the temporary file structure 
-            return tempfile.mkstemp(prefix="tmp", suffix=".tmp", dir=self._getTempSharedDir())
+            return self._makeInTempSharedDir(tempfile.mkstemp, prefix="tmp", suffix=".tmp")
+
+#The C library, for system calls not exposed by the os module, see _getLibc
+_libc = None
+
+def _getLibc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
+#IN_MOVED_FROM | IN_DELETE | IN_DELETE_SELF
+_inotifyDeletionMask = 0x40 | 0x200 | 0x400
+
+def _inotifyInit():
+    """
+    :rtype : file-descriptor of a new inotify instance, or None if inotify is not available.
+    """
+    try:
+        fd = _getLibc().inotify_init()
+    except (OSError, AttributeError):
+        return None
+    return fd if fd >= 0 else None
+
+class _MemoryMap(mmap.mmap):
+    """
+    A memory map whose read method, like that of a file, reads to the end by default.
+    """
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self) - self.tell()
+        return super(_MemoryMap, self).read(size)
+
+def _getSiblingPath(path):
+    """
+    :rtype : string, a unique path in the same directory as the given path.
+    """
+    return "%s.%s.tmp" % (path, uuid.uuid4().hex)
+
+#The ioctl to make a file share the data of another (a reflink), see linux/fs.h
+_FICLONE = 0x40049409
+
+#Errors indicating that copy_file_range is not supported for the files given
+_copyFileRangeErrors = set((errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP))
+
+def _copyFile(srcPath, dstPath):
+    """
+    Copies the file at srcPath to dstPath, see _copyFileObject.
+    """
+    with open(srcPath, 'rb') as src:
+        with open(dstPath, 'wb') as dst:
+            _copyFileObject(src, dst)
+
+def _copyFileObject(src, dst):
+    """
+    Copies the content of the file object src, open for reading, to the empty file object dst,
+    open for writing, without passing the content through user space where possible.
+    Copy-on-write file systems share the data between the two files.
+    """
+    try:
+        fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        return
+    except (IOError, OSError):
+        pass
+    if not _copyFileRange(src.fileno(), dst.fileno(), os.fstat(src.fileno()).st_size):
+        shutil.copyfileobj(src, dst, 1 << 20)
+
+def _copyFileRange(srcFD, dstFD, size):
+    """
+    Copies size bytes from the current offset of srcFD to dstFD using copy_file_range, returning
+    False if the system call is not supported.
+    """
+    try:
+        copyFileRange = _getLibc().copy_file_range
+    except (OSError, AttributeError):
+        return False
+    copyFileRange.restype = ctypes.c_ssize_t
+    copyFileRange.argtypes = [ ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+                               ctypes.c_size_t, ctypes.c_uint ]
+    copied = 0
+    while copied < size:
+        i = copyFileRange(srcFD, None, dstFD, None, min(size - copied, 1 << 30), 0)
+        if i < 0:
+            e = ctypes.get_errno()
+            if copied == 0 and e in _copyFileRangeErrors:
+                return False
+            raise OSError(e, os.strerror(e))
+        if i == 0: #The file has been truncated
+            break
+        copied += i
+    return True
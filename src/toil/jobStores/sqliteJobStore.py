@@ -0,0 +1,462 @@
+# Copyright (C) 2015 UCSC Computational Genomics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from contextlib import contextmanager
+import logging
+import marshal as pickler
+import shutil
+import os
+import stat
+import errno
+import sqlite3
+import threading
+import uuid
+from io import BytesIO
+from toil.lib.bioio import absSymPath
+from toil.jobStores.abstractJobStore import AbstractJobStore, NoSuchJobException, \
+    NoSuchFileException
+from toil.jobStores.fileJobStore import _copyFile, _getSiblingPath
+from toil.jobWrapper import JobWrapper
+
+logger = logging.getLogger( __name__ )
+
+class SQLiteJobStore(AbstractJobStore):
+    """
+    Represents the toil using an SQLite database, holding the jobs and the metadata of the
+    files, in a directory that also holds the contents of the files. Creating, loading and
+    updating a job is a single statement on the database, rather than several operations on
+    the file system. The database is in write-ahead logging mode, so readers do not block
+    the writer, which requires the processes using the job store to be on the same host. For
+    doc-strings of functions see AbstractJobStore.
+
+    Files with the same content, if the fileDeduplication option is set, are hard links to a
+    blob, named by the content hash in the directory of the files, and counted in the database,
+    so the blob is removed with the last of them.
+    """
+
+    def __init__(self, jobStoreDir, config=None):
+        """
+        :param jobStoreDir: Place to create jobStore
+        :param config: See jobStores.abstractJobStore.AbstractJobStore.__init__
+        :raise RuntimeError: if config != None and the jobStore already exists or
+        config == None and the jobStore does not already exists.
+        """
+        self.jobStoreDir = absSymPath(jobStoreDir)
+        logger.info("Jobstore directory is: %s", self.jobStoreDir)
+        self._checkJobStoreCreation(config != None, os.path.exists(self.jobStoreDir), self.jobStoreDir)
+        self.databasePath = os.path.join(self.jobStoreDir, "jobStore.db")
+        #Directory holding the contents of the files, in subdirectories named by the first
+        #two characters of the file IDs
+        self.filesDir = os.path.join(self.jobStoreDir, "files")
+        self.sharedFilesDir = os.path.join(self.jobStoreDir, "shared")
+        #The connections to the database, one per thread, see _getConnection
+        self._local = threading.local()
+        if config != None:
+            os.mkdir(self.jobStoreDir)
+            os.mkdir(self.filesDir)
+            for i in xrange(256):
+                os.mkdir(os.path.join(self.filesDir, "%02x" % i))
+            os.mkdir(self.sharedFilesDir)
+            with self.batch() as connection:
+                connection.execute("CREATE TABLE jobs (id TEXT PRIMARY KEY, job BLOB)")
+                connection.execute("CREATE TABLE files (id TEXT PRIMARY KEY, job TEXT, blob TEXT)")
+                connection.execute("CREATE INDEX filesByJob ON files (job)")
+                connection.execute("CREATE TABLE blobs (hash TEXT PRIMARY KEY, refs INTEGER)")
+                connection.execute("CREATE TABLE stats (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                   "stats BLOB)")
+        super(SQLiteJobStore, self).__init__(config=config)
+
+    def deleteJobStore(self):
+        if os.path.exists(self.jobStoreDir):
+            shutil.rmtree(self.jobStoreDir)
+
+    #The number of seconds to wait for another process writing to the database
+    busyTimeout = 600
+
+    def _getConnection(self):
+        """
+        :rtype : sqlite3.Connection, the connection to the database of the current thread,
+        opened by the current process.
+        """
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.databasePath, timeout=self.busyTimeout,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            #Transactions are durable once the log is checkpointed, but are atomic regardless
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.text_factory = str
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+            self._local.batchDepth = 0
+        return self._local.connection
+
+    @contextmanager
+    def batch(self):
+        connection = self._getConnection()
+        if self._local.batchDepth == 0:
+            connection.execute("BEGIN IMMEDIATE")
+        self._local.batchDepth += 1
+        try:
+            yield connection
+        except:
+            self._local.batchDepth -= 1
+            if self._local.batchDepth == 0:
+                connection.execute("ROLLBACK")
+            raise
+        self._local.batchDepth -= 1
+        if self._local.batchDepth == 0:
+            connection.execute("COMMIT")
+
+    def _query(self, sql, *args):
+        """
+        :rtype : list of the rows returned by the query.
+        """
+        return self._getConnection().execute(sql, args).fetchall()
+
+    ##########################################
+    #The following methods deal with creating/loading/updating/writing/checking for the
+    #existence of jobs
+    ##########################################
+
+    def create(self, command, memory, cores, disk, updateID=None,
+               predecessorNumber=0):
+        job = JobWrapper(command=command, memory=memory, cores=cores, disk=disk,
+                  jobStoreID=uuid.uuid4().hex,
+                  remainingRetryCount=self._defaultTryCount( ),
+                  updateID=updateID,
+                  predecessorNumber=predecessorNumber)
+        with self.batch() as connection:
+            connection.execute("INSERT INTO jobs VALUES (?, ?)",
+                               (job.jobStoreID, self._serialiseJob(job)))
+        return job
+
+    def exists(self, jobStoreID):
+        return len(self._query("SELECT 1 FROM jobs WHERE id = ?", jobStoreID)) > 0
+
+    def _getPublicUrl(self, jobStoreFileID):
+        self._checkJobStoreFileID(jobStoreFileID)
+        return 'file:' + self._getFilePath(jobStoreFileID)
+
+    def getSharedPublicUrl(self, sharedFileName):
+        sharedFilePath = os.path.join(self.sharedFilesDir, sharedFileName)
+        if os.path.exists(sharedFilePath):
+            return 'file:' + sharedFilePath
+        else:
+            raise NoSuchFileException(sharedFileName)
+
+    def load(self, jobStoreID):
+        rows = self._query("SELECT job FROM jobs WHERE id = ?", jobStoreID)
+        if len(rows) == 0:
+            raise NoSuchJobException(jobStoreID)
+        return self._deserialiseJob(rows[0][0])
+
+    def update(self, job):
+        with self.batch() as connection:
+            connection.execute("UPDATE jobs SET job = ? WHERE id = ?",
+                               (self._serialiseJob(job), job.jobStoreID))
+
+    def delete(self, jobStoreID):
+        #The files of the job are removed from the database with the job, and then deleted
+        with self.batch() as connection:
+            jobStoreFileIDs = [ row[0] for row in connection.execute(
+                "SELECT id FROM files WHERE job = ?", (jobStoreID,)) ]
+            if self.config.fileDeduplication:
+                self._releaseBlobs(connection, [ row[0] for row in connection.execute(
+                    "SELECT blob FROM files WHERE job = ? AND blob IS NOT NULL", (jobStoreID,)) ])
+            connection.execute("DELETE FROM files WHERE job = ?", (jobStoreID,))
+            connection.execute("DELETE FROM jobs WHERE id = ?", (jobStoreID,))
+        map(self._removeFile, jobStoreFileIDs)
+
+    def jobs(self):
+        for row in self._query("SELECT job FROM jobs"):
+            yield self._deserialiseJob(row[0])
+
+    ##########################################
+    #Functions that deal with temporary files associated with jobs
+    ##########################################
+
+    def _writeFile(self, localFilePath, jobStoreID=None):
+        jobStoreFileID = self._newFile(jobStoreID)
+        _copyFile(localFilePath, self._getFilePath(jobStoreFileID))
+        return jobStoreFileID
+
+    def _moveFile(self, localFilePath, jobStoreID=None):
+        jobStoreFileID = self._newFile(jobStoreID)
+        try:
+            os.rename(localFilePath, self._getFilePath(jobStoreFileID))
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            #On a different file system to the job store
+            _copyFile(localFilePath, self._getFilePath(jobStoreFileID))
+            os.remove(localFilePath)
+        return jobStoreFileID
+
+    @contextmanager
+    def _writeFileStream(self, jobStoreID=None):
+        jobStoreFileID = self._newFile(jobStoreID)
+        with open(self._getFilePath(jobStoreFileID), 'w') as f:
+            yield f, jobStoreFileID
+
+    def getEmptyFileStoreID(self, jobStoreID=None):
+        return self._newFile(jobStoreID)
+
+    def _updateFile(self, jobStoreFileID, localFilePath):
+        self._checkJobStoreFileID(jobStoreFileID)
+        #Files are replaced rather than modified in place, as they may be linked to by
+        #local copies, see _linkFile
+        absPath = self._getFilePath(jobStoreFileID)
+        tempPath = _getSiblingPath(absPath)
+        _copyFile(localFilePath, tempPath)
+        os.rename(tempPath, absPath)
+
+    @contextmanager
+    def _updateFileStream(self, jobStoreFileID):
+        self._checkJobStoreFileID(jobStoreFileID)
+        absPath = self._getFilePath(jobStoreFileID)
+        tempPath = _getSiblingPath(absPath)
+        try:
+            with open(tempPath, 'w') as f:
+                yield f
+        except:
+            os.remove(tempPath)
+            raise
+        os.rename(tempPath, absPath)
+
+    def _readFile(self, jobStoreFileID, localFilePath):
+        self._checkJobStoreFileID(jobStoreFileID)
+        _copyFile(self._getFilePath(jobStoreFileID), localFilePath)
+
+    def _linkFile(self, jobStoreFileID, localFilePath):
+        self._checkJobStoreFileID(jobStoreFileID)
+        #Hard link the file, which is safe as files in the job store are never modified
+        #in place, see _updateFile. The file is made read-only, so that the link is.
+        tempPath = _getSiblingPath(localFilePath)
+        try:
+            os.link(self._getFilePath(jobStoreFileID), tempPath)
+        except OSError:
+            #Most likely on a different file system to the job store
+            self._readFile(jobStoreFileID, localFilePath)
+            return
+        os.chmod(tempPath, os.stat(tempPath).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        os.rename(tempPath, localFilePath)
+
+    @contextmanager
+    def _readFileStream(self, jobStoreFileID):
+        self._checkJobStoreFileID(jobStoreFileID)
+        with open(self._getFilePath(jobStoreFileID), 'r') as f:
+            yield f
+
+    def _readFileRange(self, jobStoreFileID, start, end):
+        self._checkJobStoreFileID(jobStoreFileID)
+        with open(self._getFilePath(jobStoreFileID), 'r') as f:
+            f.seek(start)
+            return f.read(max(0, end - start))
+
+    def _getFileSize(self, jobStoreFileID):
+        self._checkJobStoreFileID(jobStoreFileID)
+        return os.path.getsize(self._getFilePath(jobStoreFileID))
+
+    #Files are seekable
+    _readSeekableFileStream = _readFileStream
+
+    def deleteFile(self, jobStoreFileID):
+        self.deleteFiles([jobStoreFileID])
+
+    def deleteFiles(self, jobStoreFileIDs):
+        jobStoreFileIDs = list(jobStoreFileIDs)
+        with self.batch() as connection:
+            if self.config.fileDeduplication:
+                self._releaseBlobs(connection, [ row[0] for i in jobStoreFileIDs
+                    for row in connection.execute(
+                        "SELECT blob FROM files WHERE id = ? AND blob IS NOT NULL", (i,)) ])
+            connection.executemany("DELETE FROM files WHERE id = ?",
+                                   [ (i,) for i in jobStoreFileIDs ])
+        map(self._removeFile, jobStoreFileIDs)
+
+    def fileExists(self, jobStoreFileID):
+        return len(self._query("SELECT 1 FROM files WHERE id = ?", jobStoreFileID)) > 0
+
+    deduplicatesFiles = True
+
+    def _linkBlob(self, contentHash, jobStoreID=None):
+        with self.batch() as connection:
+            if len(connection.execute("SELECT 1 FROM blobs WHERE hash = ?",
+                                      (contentHash,)).fetchall()) == 0:
+                return None
+            jobStoreFileID = self._newFile(jobStoreID)
+            if not self._shareBlob(connection, jobStoreFileID, contentHash):
+                connection.execute("DELETE FROM files WHERE id = ?", (jobStoreFileID,))
+                self._removeFile(jobStoreFileID)
+                return None
+        return jobStoreFileID
+
+    def _addBlob(self, jobStoreFileID, contentHash):
+        with self.batch() as connection:
+            if len(connection.execute("SELECT 1 FROM blobs WHERE hash = ?",
+                                      (contentHash,)).fetchall()) > 0 \
+                    and self._shareBlob(connection, jobStoreFileID, contentHash):
+                return
+            if connection.execute("UPDATE files SET blob = ? WHERE id = ?",
+                                  (contentHash, jobStoreFileID)).rowcount == 0:
+                return #Deleted since it was written
+            #The file becomes the blob, replacing any left by a failed transaction
+            blobPath = self._getBlobPath(contentHash)
+            tempPath = _getSiblingPath(blobPath)
+            os.link(self._getFilePath(jobStoreFileID), tempPath)
+            os.rename(tempPath, blobPath)
+            connection.execute("INSERT INTO blobs VALUES (?, 1)", (contentHash,))
+
+    def _releaseBlob(self, jobStoreFileID):
+        with self.batch() as connection:
+            contentHashes = [ row[0] for row in connection.execute(
+                "SELECT blob FROM files WHERE id = ? AND blob IS NOT NULL", (jobStoreFileID,)) ]
+            connection.execute("UPDATE files SET blob = NULL WHERE id = ?", (jobStoreFileID,))
+            self._releaseBlobs(connection, contentHashes)
+
+    ##########################################
+    #The following methods deal with shared files, i.e. files not associated
+    #with specific jobs.
+    ##########################################
+
+    @contextmanager
+    def writeSharedFileStream(self, sharedFileName, isProtected=True):
+        # the isProtected parameter has no effect on the fileStore, but is needed on the awsJobStore
+        assert self._validateSharedFileName( sharedFileName )
+        sharedFilePath = os.path.join(self.sharedFilesDir, sharedFileName)
+        tempPath = _getSiblingPath(sharedFilePath)
+        with open(tempPath, 'w') as f:
+            yield f
+        os.rename(tempPath, sharedFilePath)
+
+    @contextmanager
+    def readSharedFileStream(self, sharedFileName, isProtected=True):
+        # the isProtected parameter has no effect on the fileStore, but is needed on the awsJobStore
+        assert self._validateSharedFileName( sharedFileName )
+        with open(os.path.join(self.sharedFilesDir, sharedFileName), 'r') as f:
+            yield f
+
+    def writeStatsAndLogging(self, statsAndLoggingString):
+        with self.batch() as connection:
+            connection.execute("INSERT INTO stats (stats) VALUES (?)",
+                               (sqlite3.Binary(statsAndLoggingString),))
+
+    def readStatsAndLogging(self, statsAndLoggingCallBackFn):
+        #The stats are read in the order they were written, and deleted once read
+        rows = self._query("SELECT id, stats FROM stats ORDER BY id")
+        for row in rows:
+            statsAndLoggingCallBackFn(BytesIO(str(row[1])))
+        if len(rows) > 0:
+            with self.batch() as connection:
+                connection.execute("DELETE FROM stats WHERE id <= ?", (rows[-1][0],))
+        return len(rows)
+
+    ##########################################
+    #Private methods
+    ##########################################
+
+    def _serialiseJob(self, job):
+        return sqlite3.Binary(job.encode(self.config.jobCompression))
+
+    def _deserialiseJob(self, data):
+        data = str(data)
+        #Jobs written by earlier versions are marshalled dictionaries
+        return JobWrapper.decode(data) if JobWrapper.isEncoded(data) \
+            else JobWrapper.fromDict(pickler.loads(data))
+
+    def _getFilePath(self, jobStoreFileID):
+        """
+        :rtype : string, the path of the content of the file with the given ID.
+        """
+        return os.path.join(self.filesDir, jobStoreFileID[:2], jobStoreFileID)
+
+    def _getBlobPath(self, contentHash):
+        """
+        :rtype : string, the path of the blob with the given content hash, see _addBlob.
+        """
+        return os.path.join(self.filesDir, contentHash[:2], contentHash)
+
+    def _shareBlob(self, connection, jobStoreFileID, contentHash):
+        """
+        Replaces the content of the file by a link to the blob with the given content hash,
+        in the transaction of the given connection.
+
+        :rtype : True if the file now shares the blob, else False, as the file has been deleted
+        or the blob was removed by a failed transaction.
+        """
+        if connection.execute("UPDATE files SET blob = ? WHERE id = ?",
+                              (contentHash, jobStoreFileID)).rowcount == 0:
+            return False
+        absPath = self._getFilePath(jobStoreFileID)
+        tempPath = _getSiblingPath(absPath)
+        try:
+            os.link(self._getBlobPath(contentHash), tempPath)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            connection.execute("DELETE FROM blobs WHERE hash = ?", (contentHash,))
+            connection.execute("UPDATE files SET blob = NULL WHERE id = ?", (jobStoreFileID,))
+            return False
+        os.rename(tempPath, absPath)
+        connection.execute("UPDATE blobs SET refs = refs + 1 WHERE hash = ?", (contentHash,))
+        return True
+
+    def _releaseBlobs(self, connection, contentHashes):
+        """
+        Removes a file from the count of each of the blobs with the given content hashes, in
+        the transaction of the given connection removing or updating the files, removing the
+        blobs that are no longer shared by any file.
+        """
+        for contentHash in contentHashes:
+            connection.execute("UPDATE blobs SET refs = refs - 1 WHERE hash = ?", (contentHash,))
+            if connection.execute("DELETE FROM blobs WHERE hash = ? AND refs <= 0",
+                                  (contentHash,)).rowcount > 0:
+                try:
+                    os.remove(self._getBlobPath(contentHash))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+
+    def _newFile(self, jobStoreID):
+        """
+        Adds a new, empty file, owned by the job with the given jobStoreID if it is not None,
+        to the store.
+
+        :rtype : string, the ID of the file.
+        """
+        jobStoreFileID = uuid.uuid4().hex
+        with self.batch() as connection:
+            if jobStoreID is not None and not self.exists(jobStoreID):
+                raise NoSuchJobException(jobStoreID)
+            connection.execute("INSERT INTO files (id, job) VALUES (?, ?)",
+                               (jobStoreFileID, jobStoreID))
+            open(self._getFilePath(jobStoreFileID), 'w').close()
+        return jobStoreFileID
+
+    def _removeFile(self, jobStoreFileID):
+        """
+        Removes the content of a file removed from the database.
+        """
+        try:
+            os.remove(self._getFilePath(jobStoreFileID))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _checkJobStoreFileID(self, jobStoreFileID):
+        """
+        Raises NoSuchFileException if the jobStoreFileID does not exist.
+        """
+        if not self.fileExists(jobStoreFileID):
+            raise NoSuchFileException(jobStoreFileID)
@@ -13,6 +13,10 @@
 # limitations under the License.
 from __future__ import absolute_import
 import logging
+import marshal
+import itertools
+import zlib
+import bz2
 
 logger = logging.getLogger( __name__ )
 
@@ -27,12 +31,16 @@ class JobWrapper( object ):
                   jobStoreID, remainingRetryCount, 
                   updateID, predecessorNumber,
                   jobsToDelete=None, predecessorsFinished=None, 
-                  stack=None, logJobStoreFileID=None): 
+                  stack=None, logJobStoreFileID=None, requirementsFileID=None): 
         #The command to be executed and its memory and cores requirements.
         self.command = command
         self.memory = memory #Max number of bytes used by the job
         self.cores = cores #Number of cores to be used by the job
         self.disk = disk #Max number of bytes on disk space used by the job
+        #The requirements are None if they are computed when the job is issued, from the
+        #expressions in the file with the jobStoreFileID requirementsFileID, see
+        #toil.job.Job._evaluateRequirements
+        self.requirementsFileID = requirementsFileID
         
         #The jobStoreID of the job. JobStore.load(jobStoreID) will return
         #the job
@@ -67,8 +75,11 @@ class JobWrapper( object ):
         self.predecessorsFinished = predecessorsFinished or set()
         
         #The list of successor jobs to run. Successor jobs are stored
-        #as 5-tuples of the form (jobStoreId, memory, cores, disk, predecessorNumber).
-        #Successor jobs are run in reverse order from the stack.
+        #as 5-tuples of the form (jobStoreId, memory, cores, disk, predecessorNumber), where the
+        #requirements computed when the job is issued are None.
+        #Successor jobs are run in reverse order from the stack. Each entry
+        #of the stack is a list of successors or, for large numbers of successors,
+        #a ChunkedSuccessors instance.
         self.stack = stack or []
         
         #A jobStoreFileID of the log file for a job.
@@ -88,7 +99,7 @@ class JobWrapper( object ):
         # Set the default memory to be at least as large as the default, in
         # case this was a malloc failure (we do this because of the combined
         # batch system)
-        if self.memory < config.defaultMemory:
+        if self.memory is not None and self.memory < config.defaultMemory:
             self.memory = config.defaultMemory
             logger.warn("We have increased the default memory of the failed job to %s bytes",
                         self.memory)
@@ -119,12 +130,80 @@ class JobWrapper( object ):
     # Serialization support methods
 
     def toDict( self ):
-        return self.__dict__.copy( )
+        d = self.__dict__.copy( )
+        d[ 'stack' ] = [ successors.toDict( ) if isinstance( successors, ChunkedSuccessors )
+                         else successors for successors in self.stack ]
+        return d
 
     @classmethod
     def fromDict( cls, d ):
+        d = d.copy( )
+        d[ 'stack' ] = [ ChunkedSuccessors.fromDict( successors ) if isinstance( successors, dict )
+                         else successors for successors in d[ 'stack' ] ]
         return cls( **d )
 
+    #The prefix of the encodings made by encode, which is followed by the version of the
+    #encoding and the index of the compressor in _compressors
+    encodingPrefix = "TJW"
+    encodingVersion = 1
+
+    def encode( self, compression="none" ):
+        """
+        Returns a compact binary encoding of the JobWrapper, read by decode. The fields are
+        encoded by position rather than by name, the successors in each entry of the stack,
+        a list or tuple, being packed into a single tuple. The encoding is compressed with the given
+        compression, one of "none", "zlib", which is fast, or "bz2", which is small.
+
+        :rtype : string
+        """
+        stack = [ ( 1, successors.jobStoreString, successors.chunkIDs, successors.length,
+                    successors.successorsPerChunk )
+                  if isinstance( successors, ChunkedSuccessors )
+                  else ( 2 if isinstance( successors, tuple ) else 0, )
+                       + tuple( itertools.chain.from_iterable( successors ) )
+                  for successors in self.stack ]
+        fields = ( self.command, self.memory, self.cores, self.disk, self.requirementsFileID,
+                   self.jobStoreID, self.remainingRetryCount, self.updateID, self.jobsToDelete,
+                   self.predecessorNumber, self.predecessorsFinished, stack,
+                   self.logJobStoreFileID )
+        compressor = _compressorNames.index( compression )
+        return "%s%c%c%s" % ( self.encodingPrefix, self.encodingVersion, compressor,
+                              _compressors[ compressor ][ 1 ]( marshal.dumps( fields ) ) )
+
+    @classmethod
+    def isEncoded( cls, data ):
+        """
+        Returns True if the given string was made by encode, rather than being one of the
+        serialisations of JobWrapper used by earlier versions of the job stores.
+        """
+        return data.startswith( cls.encodingPrefix )
+
+    @classmethod
+    def decode( cls, data ):
+        """
+        Returns the JobWrapper encoded in the given string by encode.
+
+        :rtype : JobWrapper
+        """
+        prefixLength = len( cls.encodingPrefix )
+        if not cls.isEncoded( data ) or ord( data[ prefixLength ] ) != cls.encodingVersion:
+            raise ValueError( "Not an encoding of a JobWrapper of version %i" % cls.encodingVersion )
+        compressor = ord( data[ prefixLength + 1 ] )
+        ( command, memory, cores, disk, requirementsFileID, jobStoreID, remainingRetryCount,
+          updateID, jobsToDelete, predecessorNumber, predecessorsFinished, stack,
+          logJobStoreFileID ) = marshal.loads(
+            _compressors[ compressor ][ 2 ]( data[ prefixLength + 2: ] ) )
+        stack = [ ChunkedSuccessors( *successors[ 1: ] ) if successors[ 0 ] == 1
+                  else ( tuple if successors[ 0 ] == 2 else list )(
+                      successors[ i:i + 5 ] for i in xrange( 1, len( successors ), 5 ) )
+                  for successors in stack ]
+        return cls( command=command, memory=memory, cores=cores, disk=disk,
+                    jobStoreID=jobStoreID, remainingRetryCount=remainingRetryCount,
+                    updateID=updateID, predecessorNumber=predecessorNumber,
+                    jobsToDelete=jobsToDelete, predecessorsFinished=predecessorsFinished,
+                    stack=stack, logJobStoreFileID=logJobStoreFileID,
+                    requirementsFileID=requirementsFileID )
+
     def copy(self):
         """
         :rtype: JobWrapper
@@ -154,3 +233,116 @@ class JobWrapper( object ):
     
     def __str__(self):
         return str(self.toDict())
+
+class ChunkedSuccessors( object ):
+    """
+    An entry of the stack of a JobWrapper, i.e. a sequence of successor tuples, that is kept in
+    the job store as a series of files, each holding a chunk of the successors. This keeps the
+    JobWrapper of a job with very many successors small, so that loading and updating it does
+    not require reading and writing all its successors. The chunks are read lazily, as the
+    successors are accessed, and are never modified once written. The chunks are files
+    associated with the JobWrapper, so are deleted with it.
+    """
+    #The number of successors in a chunk. A list of successors is only stored as a
+    #ChunkedSuccessors instance if it is longer than this.
+    chunkSize = 1000
+
+    def __init__( self, jobStoreString, chunkIDs, length, successorsPerChunk ):
+        #The string used to load the job store holding the chunks, see toil.common.loadJobStore
+        self.jobStoreString = jobStoreString
+        #The jobStoreFileIDs of the chunks
+        self.chunkIDs = chunkIDs
+        #The total number of successors
+        self.length = length
+        #The number of successors in each chunk but the last
+        self.successorsPerChunk = successorsPerChunk
+        #The chunk most recently read, as a tuple of its index and content
+        self._chunk = None
+
+    @classmethod
+    def create( cls, jobStore, jobStoreID, successors ):
+        """
+        Writes the given successors to the job store in chunks associated with the job
+        referenced by jobStoreID, returning the ChunkedSuccessors instance referencing them.
+        """
+        successors = list( successors )
+        chunkIDs = [ ]
+        for i in xrange( 0, len( successors ), cls.chunkSize ):
+            with jobStore.writeFileStream( jobStoreID ) as ( fileHandle, chunkID ):
+                fileHandle.write( marshal.dumps( successors[ i:i + cls.chunkSize ] ) )
+            chunkIDs.append( chunkID )
+        return cls( jobStore.config.jobStore, chunkIDs, len( successors ), cls.chunkSize )
+
+    @classmethod
+    def chunkStack( cls, jobStore, jobWrapper ):
+        """
+        Replaces the lists of successors in the stack of the given JobWrapper that are longer
+        than ChunkedSuccessors.chunkSize with ChunkedSuccessors instances. The JobWrapper must
+        subsequently be updated.
+        """
+        for i, successors in enumerate( jobWrapper.stack ):
+            if not isinstance( successors, ChunkedSuccessors ) and len( successors ) > cls.chunkSize:
+                jobWrapper.stack[ i ] = cls.create( jobStore, jobWrapper.jobStoreID, successors )
+
+    def _getChunk( self, chunkIndex ):
+        if self._chunk is None or self._chunk[ 0 ] != chunkIndex:
+            with _getJobStore( self.jobStoreString ).readFileStream(
+                    self.chunkIDs[ chunkIndex ] ) as fileHandle:
+                self._chunk = ( chunkIndex, marshal.loads( fileHandle.read( ) ) )
+        return self._chunk[ 1 ]
+
+    def __len__( self ):
+        return self.length
+
+    def __getitem__( self, i ):
+        if i < 0:
+            i += self.length
+        if i < 0 or i >= self.length:
+            raise IndexError( i )
+        return self._getChunk( i // self.successorsPerChunk )[ i % self.successorsPerChunk ]
+
+    def __iter__( self ):
+        for chunkIndex in xrange( len( self.chunkIDs ) ):
+            for successor in self._getChunk( chunkIndex ):
+                yield successor
+
+    def __eq__( self, other ):
+        if isinstance( other, ChunkedSuccessors ):
+            return self.chunkIDs == other.chunkIDs
+        return list( self ) == other
+
+    def __ne__( self, other ):
+        return not self.__eq__( other )
+
+    def __getstate__( self ):
+        return self.toDict( )
+
+    def __setstate__( self, d ):
+        self.__init__( **d )
+
+    def toDict( self ):
+        return dict( jobStoreString=self.jobStoreString, chunkIDs=self.chunkIDs,
+                     length=self.length, successorsPerChunk=self.successorsPerChunk )
+
+    @classmethod
+    def fromDict( cls, d ):
+        return cls( **d )
+
+    def __repr__( self ):
+        return '%s( **%r )' % ( self.__class__.__name__, self.toDict( ) )
+
+#The compressions of JobWrapper.encode, as tuples of the name of the compression and its
+#compression and decompression functions. New compressions must be added to the end.
+_compressors = [ ( "none", str, str ),
+                 ( "zlib", lambda data: zlib.compress( data, 1 ), zlib.decompress ),
+                 ( "bz2", bz2.compress, bz2.decompress ) ]
+_compressorNames = [ compressor[ 0 ] for compressor in _compressors ]
+
+#Job stores used to read chunks of successors, by job store string
+_jobStores = { }
+
+def _getJobStore( jobStoreString ):
+    if jobStoreString not in _jobStores:
+        from toil.common import loadJobStore
+        _jobStores[ jobStoreString ] = loadJobStore( jobStoreString )
+    return _jobStores[ jobStoreString ]
@@ -23,10 +23,12 @@ import sys
 import os.path
 import time
 import xml.etree.cElementTree as ET
+from Queue import Empty
 
 from toil import Process, Queue
 from toil.lib.bioio import getTotalCpuTime, logStream
 from toil.common import toilPackageDirPath
+from toil.jobStores.abstractJobStore import NoSuchJobException
 
 logger = logging.getLogger( __name__ )
 
@@ -34,14 +36,107 @@ logger = logging.getLogger( __name__ )
 ##Stats/logging aggregation
 ####################################################
 
-def statsAndLoggingAggregatorProcess(jobStore, stop):
+class FileCollector(object):
+    """
+    Deletes the global files written by jobs once nothing can refer to them, when the
+    collectFiles option is set, and records the storage used by the files over time.
+    
+    A file is held by the pickled jobs and the promised return values whose pickles include
+    its FileID (see toil.job.FileID), each identified by the jobStoreFileID of its pickle. Once
+    committed, each job reports the files it wrote, the files held by the jobs and promised
+    return values it created and the pickled job and promised return values it has finished
+    with, which are released (see toil.job.Job._reportFileReferences). A file is deleted once
+    its writer's report has been seen and all its holders have been released. As the reports
+    of different jobs may be read in any order, holders released before being reported as
+    holding a file are remembered, and not added.
+    
+    The state is not kept when the workflow is restarted, so files written before a restart
+    are not deleted until the end of the workflow.
+    """
+    def __init__(self, jobStore, startTime):
+        self.jobStore = jobStore
+        self.startTime = startTime
+        #The sizes of the files whose writers have reported them, that have not been deleted
+        self.fileSizes = {}
+        #The holders of each file, and the files held by each holder
+        self.fileHolders = {}
+        self.heldFiles = {}
+        self.releasedHolders = set()
+        #The total size of the files, its maximum and the time it was last recorded
+        self.storedBytes = 0
+        self.peakStoredBytes = 0
+        self.sampleTime = None
+    
+    #The minimum interval in seconds between records of the storage used, see sampleStorage
+    sampleInterval = 10
+    
+    def processReferences(self, node):
+        """
+        Processes a references element reported by a job, deleting the files it makes
+        unreferenced.
+        """
+        changedFiles = set()
+        for hold in node.findall("hold"):
+            holder, fileID = hold.attrib["holder"], hold.attrib["file"]
+            if holder not in self.releasedHolders:
+                self.fileHolders.setdefault(fileID, set()).add(holder)
+                self.heldFiles.setdefault(holder, set()).add(fileID)
+        for write in node.findall("write"):
+            fileID = write.attrib["file"]
+            size = int(write.attrib.get("size", 0))
+            self.storedBytes += size - self.fileSizes.get(fileID, 0)
+            self.fileSizes[fileID] = size
+            changedFiles.add(fileID)
+        self.peakStoredBytes = max(self.peakStoredBytes, self.storedBytes)
+        for release in node.findall("release"):
+            holder = release.attrib["holder"]
+            self.releasedHolders.add(holder)
+            for fileID in self.heldFiles.pop(holder, ()):
+                self.fileHolders[fileID].discard(holder)
+                changedFiles.add(fileID)
+        for delete in node.findall("delete"):
+            self._forget(delete.attrib["file"])
+        garbage = [ fileID for fileID in changedFiles if fileID in self.fileSizes
+                    and len(self.fileHolders.get(fileID, ())) == 0 ]
+        for fileID in garbage:
+            self._forget(fileID)
+        if len(garbage) > 0:
+            logger.debug("Deleting %i global files that are no longer referred to", len(garbage))
+            self.jobStore.deleteFiles(garbage)
+    
+    def _forget(self, fileID):
+        self.storedBytes -= self.fileSizes.pop(fileID, 0)
+        self.fileHolders.pop(fileID, None)
+    
+    def sampleStorage(self, fileHandle, force=False):
+        """
+        Writes a storage element recording the time, the total size of the files and its
+        maximum so far to the stats file, if sampleInterval has passed since the last one or
+        force is True.
+        """
+        now = time.time()
+        if self.sampleTime is None or now - self.sampleTime >= self.sampleInterval or force:
+            storage = ET.Element("storage")
+            storage.attrib["time"] = str(now - self.startTime)
+            storage.attrib["bytes"] = str(self.storedBytes)
+            storage.attrib["peak_bytes"] = str(self.peakStoredBytes)
+            storage.attrib["files"] = str(len(self.fileSizes))
+            ET.ElementTree(storage).write(fileHandle)
+            self.sampleTime = now
+
+def statsAndLoggingAggregatorProcess(jobStore, stop, releasedJobs):
     """
     The following function is used for collating stats/reporting log messages from the workers.
     Works inside of a separate process, collates as long as the stop flag is not True.
+    Notices of jobs released by running jobs (see toil.job.Job.releaseChildren) are passed
+    on to the leader as tuples of the predecessor's jobStoreID and the released job's
+    jobStoreID, using the releasedJobs queue. The references to global files reported by
+    jobs are passed to a FileCollector.
     """
     #Overall timing
     startTime = time.time()
     startClock = getTotalCpuTime()
+    fileCollector = FileCollector(jobStore, startTime) if jobStore.config.collectFiles else None
 
     #Start off the stats file
     with jobStore.writeSharedFileStream("statsAndLogging.xml") as fileHandle:
@@ -50,6 +145,12 @@ def statsAndLoggingAggregatorProcess(jobStore, stop):
         #Call back function
         def statsAndLoggingCallBackFn(fileHandle2):
             node = ET.parse(fileHandle2).getroot()
+            if node.tag == "release":
+                releasedJobs.put((node.attrib["predecessor"], node.attrib["job"]))
+                return
+            if node.tag == "references":
+                fileCollector.processReferences(node)
+                return
             nodesNamed = node.find("messages").findall
             for message in nodesNamed("message"):
                 logger.warn("Got message from job at time: %s : %s",
@@ -72,8 +173,12 @@ def statsAndLoggingAggregatorProcess(jobStore, stop):
                 #results file every minute
                 fileHandle.flush()
                 timeSinceOutFileLastFlushed = time.time()
+            if fileCollector is not None:
+                fileCollector.sampleStorage(fileHandle)
         
         #Finish the stats file
+        if fileCollector is not None:
+            fileCollector.sampleStorage(fileHandle, force=True)
         fileHandle.write("<total_time time='%s' clock='%s'/></stats>" % \
                          (str(time.time() - startTime), str(getTotalCpuTime() - startClock)))
 
@@ -98,8 +203,20 @@ class JobBatcher:
 
     def issueJob(self, jobStoreID, memory, cores, disk):
         """
-        Add a job to the queue of jobs
+        Add a job to the queue of jobs. Requirements that are None are computed first, see
+        toil.job.Job._evaluateRequirements. If they can not be computed the job is treated as
+        having failed, and is processed again, see ToilState.unissuedJobs.
         """
+        if memory is None or cores is None or disk is None:
+            try:
+                memory, cores, disk = self._evaluateRequirements(jobStoreID)
+            except Exception:
+                logger.exception("Failed to compute the requirements of job: %s", jobStoreID)
+                job = self.jobStore.load(jobStoreID)
+                job.setupJobAfterFailure(self.config)
+                self.jobStore.update(job)
+                self.toilState.unissuedJobs.add(job)
+                return
         self.jobsIssued += 1
         jobCommand = "%s -E %s %s %s" % (sys.executable, self.workerPath, self.jobStoreString, jobStoreID)
         jobBatchSystemID = self.batchSystem.issueBatchJob(jobCommand, memory, cores, disk)
@@ -108,6 +225,21 @@ class JobBatcher:
                      "%s and cores: %i, disk: %i, and memory: %i",
                      jobStoreID, str(jobBatchSystemID), cores, disk, memory)
 
+    def _evaluateRequirements(self, jobStoreID):
+        """
+        Computes the requirements of the job that are computed when it is issued, recording
+        them in the job store so that they are not computed again if the job is retried. The
+        promise files read are only deleted once the requirements have been recorded.
+        Returns the requirements of the job as a tuple of (memory, cores, disk).
+        """
+        from toil.job import Job #Imported here as toil.job imports this module
+        job = self.jobStore.load(jobStoreID)
+        if job.memory is None or job.cores is None or job.disk is None:
+            promiseFiles = Job._evaluateRequirements(job, self.jobStore)
+            self.jobStore.update(job)
+            self.jobStore.deleteFiles(promiseFiles)
+        return job.memory, job.cores, job.disk
+
     def issueJobs(self, jobs):
         """
         Add a list of jobs, each represented as a tuple of
@@ -151,6 +283,62 @@ class JobBatcher:
         jobStoreID = self.jobBatchSystemIDToJobStoreIDHash.pop(jobBatchSystemID)
         return jobStoreID
     
+    def withdrawJobs(self, job):
+        """
+        Deletes the jobs created by the finished job that were not committed to the job store
+        with it, as it failed, those whose updateIDs are in its jobsToDelete, which includes the jobs it
+        released (see toil.job.Job.releaseChildren), and their successors. Those issued are
+        killed and no longer scheduled. As finding the jobs by their updateIDs lists the
+        jobs in the job store, this is only done for failed jobs with jobsToDelete. The job
+        is updated in the job store once they have been deleted.
+        """
+        if len(job.jobsToDelete) == 0:
+            return
+        updateIDs = set(job.jobsToDelete)
+        jobStoreIDsToVisit = [ job2.jobStoreID for job2 in self.jobStore.jobs()
+                               if job2.updateID in updateIDs ]
+        jobStoreIDs = set()
+        while len(jobStoreIDsToVisit) > 0:
+            jobStoreID = jobStoreIDsToVisit.pop()
+            if jobStoreID in jobStoreIDs:
+                continue
+            try:
+                job2 = self.jobStore.load(jobStoreID)
+            except NoSuchJobException:
+                continue #The job has been run
+            jobStoreIDs.add(jobStoreID)
+            for successors in job2.stack:
+                jobStoreIDsToVisit.extend(successor[0] for successor in successors)
+        if len(jobStoreIDs) > 0:
+            logger.warn("Withdrawing %i jobs created by the failed job %s", len(jobStoreIDs),
+                        job.jobStoreID)
+        self._stopJobs(jobStoreIDs)
+        with self.jobStore.batch():
+            for jobStoreID in jobStoreIDs:
+                self.jobStore.delete(jobStoreID)
+        job.jobsToDelete = []
+        self.jobStore.update(job)
+    
+    def _stopJobs(self, jobStoreIDs):
+        """
+        Stops scheduling the given set of jobs, killing any that are issued.
+        """
+        jobsToKill = [ jobBatchSystemID for jobBatchSystemID, jobStoreID in
+                       self.jobBatchSystemIDToJobStoreIDHash.iteritems() if jobStoreID in jobStoreIDs ]
+        if len(jobsToKill) > 0:
+            self.batchSystem.killBatchJobs(jobsToKill)
+            for jobBatchSystemID in jobsToKill:
+                self.removeJobID(jobBatchSystemID)
+        self.toilState.releasedJobStoreIDs -= jobStoreIDs
+        self.toilState.finishedReleasedJobStoreIDs -= jobStoreIDs
+        for jobStoreID in jobStoreIDs:
+            self.toilState.successorJobStoreIDToPredecessorJobs.pop(jobStoreID, None)
+        for job in self.toilState.successorCounts.keys():
+            if job.jobStoreID in jobStoreIDs:
+                self.toilState.successorCounts.pop(job)
+        self.toilState.updatedJobs = set(job for job in self.toilState.updatedJobs
+                                         if job.jobStoreID not in jobStoreIDs)
+    
     def killJobs(self, jobsToKill):
         """
         Kills the given set of jobs and then sends them for processing
@@ -158,7 +346,9 @@ class JobBatcher:
         if len(jobsToKill) > 0:
             self.batchSystem.killBatchJobs(jobsToKill)
             for jobBatchSystemID in jobsToKill:
-                self.processFinishedJob(jobBatchSystemID, 1)
+                #Unless withdrawn as a job processed before it failed, see withdrawJobs
+                if self.hasJob(jobBatchSystemID):
+                    self.processFinishedJob(jobBatchSystemID, 1)
     
     #Following functions handle error cases for when jobs have gone awry with the batch system.
 
@@ -233,6 +423,9 @@ class JobBatcher:
                 if job.logJobStoreFileID is None:
                     logger.warn("No log file is present, despite job failing: %s", jobStoreID)
                 job.setupJobAfterFailure(self.config)
+            #The jobs it created, or released, are deleted if it failed, or was lost, before
+            #committing them, which leaves jobsToDelete, whatever the batch system reports
+            self.withdrawJobs(job)
             self.toilState.updatedJobs.add(job) #Now we know the
             #job is done we can add it to the list of updated job files
             logger.debug("Added job: %s to active jobs", jobStoreID)
@@ -247,6 +440,12 @@ class JobBatcher:
         Update status of a predecessor for finished successor job.
         """
         if jobStoreID not in self.toilState.successorJobStoreIDToPredecessorJobs:
+            if jobStoreID in self.toilState.releasedJobStoreIDs:
+                #The job was released by a predecessor that has not yet been processed
+                #as having finished, see toil.job.Job.releaseChildren
+                self.toilState.releasedJobStoreIDs.remove(jobStoreID)
+                self.toilState.finishedReleasedJobStoreIDs.add(jobStoreID)
+                return
             #We have reach the root job
             assert len(self.toilState.updatedJobs) == 0
             assert len(self.toilState.successorJobStoreIDToPredecessorJobs) == 0
@@ -282,6 +481,14 @@ class ToilState( object ):
         self.successorCounts = { }
         # Jobs that are ready to be processed
         self.updatedJobs = set( )
+        # Jobs released by running predecessors (see toil.job.Job.releaseChildren),
+        # referenced by jobStoreID, that have been scheduled but are yet to be found
+        # in the stack of a finished predecessor, and the subset of those that have finished.
+        self.releasedJobStoreIDs = set( )
+        self.finishedReleasedJobStoreIDs = set( )
+        # Jobs that failed as they were issued, as their requirements could not be computed,
+        # which are processed again
+        self.unissuedJobs = set( )
         ##Algorithm to build this information
         self._buildToilState(rootJob, jobStore)
 
@@ -345,8 +552,9 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
     ##########################################
 
     stopStatsAndLoggingAggregatorProcess = Queue() #When this is s
+    releasedJobs = Queue() #Jobs released by running jobs, see Job.releaseChildren
     worker = Process(target=statsAndLoggingAggregatorProcess,
-                     args=(jobStore, stopStatsAndLoggingAggregatorProcess))
+                     args=(jobStore, stopStatsAndLoggingAggregatorProcess, releasedJobs))
     worker.start() 
 
     ##########################################
@@ -360,6 +568,25 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
     logger.info("Starting the main loop")
     while True:
 
+        ##########################################
+        #Add the jobs released by running jobs to the jobs to process
+        ##########################################
+
+        while True:
+            try:
+                predecessorJobStoreID, jobStoreID = releasedJobs.get_nowait()
+            except Empty:
+                break
+            #Ignore the notice if the predecessor has already been processed as
+            #having finished, in which case the job has been scheduled as a successor,
+            #or if the job has been withdrawn, see JobBatcher.withdrawJobs
+            if (jobStoreID not in toilState.successorJobStoreIDToPredecessorJobs
+                and jobStore.exists(jobStoreID)):
+                logger.debug("Job: %s has been released by job: %s",
+                             jobStoreID, predecessorJobStoreID)
+                toilState.releasedJobStoreIDs.add(jobStoreID)
+                toilState.updatedJobs.add(jobStore.load(jobStoreID))
+
         ##########################################
         #Process jobs that are ready to be scheduled/have successors to schedule
         ##########################################
@@ -367,6 +594,8 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
         if len(toilState.updatedJobs) > 0:
             logger.debug("Built the jobs list, currently have %i jobs to update and %i jobs issued",
                          len(toilState.updatedJobs), jobBatcher.getNumberOfJobsIssued())
+            #Jobs whose successors turn out to have all finished, which are processed again
+            jobsWithFinishedSuccessors = set()
 
             for job in toilState.updatedJobs:
                 #If the job has a command it must be run before any successors
@@ -391,10 +620,20 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
                     #For each successor schedule if all predecessors have been
                     #completed
                     for successorJobStoreID, memory, cores, disk, predecessorID in job.stack.pop():
+                        #A successor released while the job was running that has finished
+                        if successorJobStoreID in toilState.finishedReleasedJobStoreIDs:
+                            toilState.finishedReleasedJobStoreIDs.remove(successorJobStoreID)
+                            toilState.successorCounts[job] -= 1
+                            continue
                         #Build map from successor to predecessors.
                         if successorJobStoreID not in toilState.successorJobStoreIDToPredecessorJobs:
                             toilState.successorJobStoreIDToPredecessorJobs[successorJobStoreID] = []
                         toilState.successorJobStoreIDToPredecessorJobs[successorJobStoreID].append(job)
+                        #A successor released while the job was running, which is
+                        #already scheduled
+                        if successorJobStoreID in toilState.releasedJobStoreIDs:
+                            toilState.releasedJobStoreIDs.remove(successorJobStoreID)
+                            continue
                         #Case that the job has multiple predecessors
                         if predecessorID != None:
                             #Load the wrapped job
@@ -411,6 +650,9 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
                                 continue
                         successors.append((successorJobStoreID, memory, cores, disk))
                     jobBatcher.issueJobs(successors)
+                    if toilState.successorCounts[job] == 0:
+                        toilState.successorCounts.pop(job)
+                        jobsWithFinishedSuccessors.add(job)
 
                 #There are no remaining tasks to schedule within the job, but
                 #we schedule it anyway to allow it to be deleted.
@@ -430,7 +672,10 @@ def mainLoop(config, batchSystem, jobStore, rootJob):
                         totalFailedJobs += 1
                         logger.warn("Job: %s is empty but completely failed - something is very wrong", job.jobStoreID)
 
-            toilState.updatedJobs = set() #We've considered them all, so reset
+            toilState.updatedJobs = jobsWithFinishedSuccessors | toilState.unissuedJobs #We've considered them all, so reset
+            toilState.unissuedJobs = set()
+            if len(toilState.updatedJobs) > 0:
+                continue
 
         ##########################################
         #The exit criterion
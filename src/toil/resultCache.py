@@ -0,0 +1,261 @@
+# Copyright (C) 2015 UCSC Computational Genomics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+import os
+import hashlib
+import tempfile
+import cPickle
+import logging
+from io import BytesIO
+
+from toil.jobStores.abstractJobStore import NoSuchFileException
+
+logger = logging.getLogger( __name__ )
+
+class CachedResult(object):
+    """
+    The record of a previous, successful invocation of a job's run method, as stored in a
+    ResultCache.
+    """
+    def __init__(self, readFiles, writtenFiles, deletedFiles, pickledReturnValues, loggingMessages):
+        #Map of the jobStoreFileIDs of the global files read by the job to the SHA1 of their content
+        self.readFiles = readFiles
+        #Map of the jobStoreFileIDs of the global files written by the job to a tuple of the
+        #SHA1 of their content and a boolean indicating if the file was written with cleanup=True
+        self.writtenFiles = writtenFiles
+        #The jobStoreFileIDs of the files read by the job that the job deleted
+        self.deletedFiles = deletedFiles
+        #The return value of the run method, pickled
+        self.pickledReturnValues = pickledReturnValues
+        #Any messages the job logged to the leader
+        self.loggingMessages = loggingMessages
+
+class ResultCache(object):
+    """
+    A persistent cache of job results, keyed on a hash of the pickled job, in which the FileIDs
+    held by the job are replaced by the hashes of the content of the files. The content of the
+    other global files the job reads is checked on lookup. The cache lives in a directory,
+    independently of any job store, so that it can be shared between workflows and their job
+    stores. The directory must be accessible by all the workers.
+
+    Only jobs that do not create successors are cached, as on a hit the run method is skipped
+    entirely. When a job is found in the cache its return values are restored and the global
+    files it wrote are imported into the job store from the copies kept in the cache, with any
+    references to the old file IDs in the return values replaced by the new ones.
+    """
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.entriesDir = os.path.join(cacheDir, "entries")
+        self.blobsDir = os.path.join(cacheDir, "blobs")
+        for directory in (self.entriesDir, self.blobsDir):
+            if not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    #Another worker may have created it concurrently
+                    if not os.path.isdir(directory):
+                        raise
+
+    #Job attributes that do not affect the result of running the job
+    _ignoredJobAttributes = set(("_rvs", "_promiseJobStore", "_children", "_followOns",
+                                 "_services", "_directPredecessors", "_fileStore",
+                                 "_releasedJobs", "_releasedUpdateIDs",
+                                 "memory", "cores", "disk"))
+
+    def getKey(self, job, jobStore):
+        """
+        Returns the key of the job in the cache, a hash of the pickled job, excluding the parts
+        of the job (like its promises and resource requirements) that do not change the result
+        of running it. The FileIDs held by the job, for example as arguments, are replaced by
+        the SHA1 of the content of the files, as the IDs of the same files differ between runs.
+        Other global files the job reads are not part of the key, but their content is checked
+        by lookup, see store.
+
+        :rtype : tuple of the key and of the set of the jobStoreFileIDs replaced in the key.
+        """
+        from toil.job import FileID
+        state = sorted((name, value) for name, value in job.__dict__.iteritems()
+                       if name not in self._ignoredJobAttributes)
+        fileIDMap = {}
+        def persistentID(obj):
+            if type(obj) is not FileID:
+                return None
+            if obj not in fileIDMap:
+                try:
+                    fileIDMap[obj] = "file:" + self.hashJobStoreFile(jobStore, obj)
+                except NoSuchFileException:
+                    fileIDMap[obj] = None #Deleted, so the job cannot read it, keep the ID
+            return fileIDMap[obj]
+        payload = BytesIO()
+        pickler = cPickle.Pickler(payload, cPickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistentID
+        pickler.dump((job.__class__.__module__, job.__class__.__name__, state))
+        return (hashlib.sha1(payload.getvalue()).hexdigest(),
+                set(jobStoreFileID for jobStoreFileID, contentHash in fileIDMap.iteritems()
+                    if contentHash is not None))
+
+    def lookup(self, key, jobStore):
+        """
+        Returns the CachedResult for the given key, or None if there is no entry for the key or
+        if any of the global files read by the cached invocation are missing or have changed.
+        """
+        try:
+            with open(self._getEntryPath(key), 'rb') as fileHandle:
+                cachedResult = cPickle.load(fileHandle)
+        except IOError:
+            return None
+        for jobStoreFileID, contentHash in cachedResult.readFiles.iteritems():
+            try:
+                if self.hashJobStoreFile(jobStore, jobStoreFileID) != contentHash:
+                    return None
+            except NoSuchFileException:
+                return None
+        for contentHash, cleanup in cachedResult.writtenFiles.itervalues():
+            if not os.path.exists(self._getBlobPath(contentHash)):
+                return None
+        return cachedResult
+
+    def store(self, key, jobStore, readFiles, writtenFiles, deletedFiles, returnValues,
+              loggingMessages):
+        """
+        Adds an entry to the cache for the invocation of a job.
+
+        :param readFiles: the jobStoreFileIDs of the global files read by the job, other than
+        those replaced in the key, see getKey.
+        :param writtenFiles: map of the jobStoreFileIDs of the global files written by the job
+        to a boolean indicating if the file was written with cleanup=True.
+        :param deletedFiles: the jobStoreFileIDs of the global files deleted by the job.
+        """
+        readFileHashes = {}
+        for jobStoreFileID in readFiles:
+            if jobStoreFileID not in writtenFiles:
+                readFileHashes[jobStoreFileID] = self.hashJobStoreFile(jobStore, jobStoreFileID)
+        writtenFileHashes = {}
+        for jobStoreFileID, cleanup in writtenFiles.iteritems():
+            if jobStoreFileID in deletedFiles:
+                continue #Temporary file, no need to keep it
+            writtenFileHashes[jobStoreFileID] = (self._storeBlob(jobStore, jobStoreFileID), cleanup)
+        cachedResult = CachedResult(readFiles=readFileHashes,
+                                    writtenFiles=writtenFileHashes,
+                                    deletedFiles=set(i for i in deletedFiles if i in readFileHashes),
+                                    pickledReturnValues=cPickle.dumps(returnValues,
+                                                                      cPickle.HIGHEST_PROTOCOL),
+                                    loggingMessages=list(loggingMessages))
+        self._writeAtomically(self._getEntryPath(key),
+                              lambda f : cPickle.dump(cachedResult, f, cPickle.HIGHEST_PROTOCOL))
+
+    def restore(self, cachedResult, job, fileStore):
+        """
+        Restores the effects of running the job from the given cached result, returning the
+        return values of the job's run method.
+        """
+        #Import the files written by the job
+        fileIDMap = {}
+        for oldJobStoreFileID, (contentHash, cleanup) in cachedResult.writtenFiles.iteritems():
+            with fileStore.writeGlobalFileStream(cleanup=cleanup) as (fileHandle, jobStoreFileID):
+                with open(self._getBlobPath(contentHash), 'rb') as blobHandle:
+                    _copyStream(blobHandle, fileHandle)
+            fileIDMap[oldJobStoreFileID] = jobStoreFileID
+        #Replay the deletions and log messages
+        for jobStoreFileID in cachedResult.deletedFiles:
+            fileStore.deleteGlobalFile(jobStoreFileID)
+        for message in cachedResult.loggingMessages:
+            fileStore.logToMaster(message)
+        returnValues = job._unpickle(job._loadUserModule(job.getUserScript()),
+                                     BytesIO(cachedResult.pickledReturnValues))
+        return _replaceFileIDs(returnValues, fileIDMap)
+
+    @staticmethod
+    def hashJobStoreFile(jobStore, jobStoreFileID):
+        """
+        Returns the SHA1 of the content of the given file in the job store.
+        """
+        contentHash = hashlib.sha1()
+        with jobStore.readFileStream(jobStoreFileID) as fileHandle:
+            while True:
+                data = fileHandle.read(_blockSize)
+                if not data:
+                    break
+                contentHash.update(data)
+        return contentHash.hexdigest()
+
+    def _storeBlob(self, jobStore, jobStoreFileID):
+        """
+        Copies the given file in the job store into the cache, returning the SHA1 of its content.
+        """
+        fd, tempPath = tempfile.mkstemp(dir=self.blobsDir, suffix=".tmp")
+        try:
+            contentHash = hashlib.sha1()
+            with os.fdopen(fd, 'wb') as blobHandle:
+                with jobStore.readFileStream(jobStoreFileID) as fileHandle:
+                    while True:
+                        data = fileHandle.read(_blockSize)
+                        if not data:
+                            break
+                        contentHash.update(data)
+                        blobHandle.write(data)
+            contentHash = contentHash.hexdigest()
+            os.rename(tempPath, self._getBlobPath(contentHash))
+        except:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
+        return contentHash
+
+    def _writeAtomically(self, path, writeFn):
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as fileHandle:
+                writeFn(fileHandle)
+            os.rename(tempPath, path)
+        except:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
+
+    def _getEntryPath(self, key):
+        return os.path.join(self.entriesDir, key)
+
+    def _getBlobPath(self, contentHash):
+        return os.path.join(self.blobsDir, contentHash)
+
+_blockSize = 1 << 16
+
+def _copyStream(src, dst):
+    while True:
+        data = src.read(_blockSize)
+        if not data:
+            break
+        dst.write(data)
+
+def _replaceFileIDs(value, fileIDMap):
+    """
+    Returns a copy of value in which the strings that are keys of fileIDMap are replaced by the
+    corresponding values, searching inside lists, tuples, sets and dictionaries.
+    """
+    if len(fileIDMap) == 0:
+        return value
+    if isinstance(value, basestring):
+        return fileIDMap.get(value, value)
+    if type(value) == list:
+        return [ _replaceFileIDs(i, fileIDMap) for i in value ]
+    if type(value) == tuple:
+        return tuple(_replaceFileIDs(i, fileIDMap) for i in value)
+    if type(value) in (set, frozenset):
+        return type(value)(_replaceFileIDs(i, fileIDMap) for i in value)
+    if type(value) == dict:
+        return dict((_replaceFileIDs(k, fileIDMap), _replaceFileIDs(v, fileIDMap))
+                    for k, v in value.iteritems())
+    return value
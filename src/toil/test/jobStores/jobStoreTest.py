@@ -16,15 +16,22 @@ from Queue import Queue
 from abc import abstractmethod, ABCMeta
 import hashlib
 import logging
+import ctypes
+import errno
 import os
 import urllib2
 from threading import Thread
+from multiprocessing.pool import ThreadPool
 import tempfile
 import uuid
 import shutil
+import subprocess
+import time
 
 from toil.common import Config
-from toil.jobStores.abstractJobStore import (NoSuchJobException, NoSuchFileException)
+from toil.jobStores.abstractJobStore import (NoSuchJobException, NoSuchFileException,
+                                             SeekableFileStream)
+from toil.jobStores import fileJobStore
 from toil.jobStores.fileJobStore import FileJobStore
 from toil.test import ToilTest, needs_aws, needs_azure, needs_encryption
 
@@ -261,6 +268,42 @@ class hidden:
 
             # TODO: Test stats methods
 
+        def testClean(self):
+            """
+            Checks that cleaning the job store deletes the jobs left by an interrupted creation,
+            removes them from the stacks of their predecessors and resets the retry counts,
+            with the jobs changed in several batches.
+            """
+            self.master.cleanBatchSize = 2
+            parent = self.master.create("parent", 1, 2, 3)
+            partial = self.master.create("partial", 1, 2, 3, updateID="u1")
+            children = [ self.master.create("child", 1, 2, 3) for i in xrange(5) ]
+            for child in children:
+                child.remainingRetryCount = 0
+                self.master.update(child)
+            parent.jobsToDelete = ["u1"]
+            parent.stack.append([ (child.jobStoreID, 1, 2, 3, 1) for child in children ])
+            parent.stack.append([ (children[0].jobStoreID, 1, 2, 3, 1),
+                                  (partial.jobStoreID, 1, 2, 3, 1) ])
+            self.master.update(parent)
+            #A job with nothing to clean but the deleted job at the top of its stack
+            other = self.master.create("other", 1, 2, 3)
+            other.stack.append([ (partial.jobStoreID, 1, 2, 3, 1) ])
+            self.master.update(other)
+            self.master.clean()
+            self.assertFalse(self.master.exists(partial.jobStoreID))
+            self.assertEquals(set(job.jobStoreID for job in self.master.jobs()),
+                              set([ parent.jobStoreID, other.jobStoreID ] +
+                                  [ child.jobStoreID for child in children ]))
+            self.assertEquals(len(self.master.load(other.jobStoreID).stack), 0)
+            parent = self.master.load(parent.jobStoreID)
+            self.assertEquals(len(parent.jobsToDelete), 0)
+            self.assertEquals(len(parent.stack), 2)
+            self.assertEquals(list(parent.stack[-1]), [ (children[0].jobStoreID, 1, 2, 3, 1) ])
+            for child in children:
+                self.assertEquals(self.master.load(child.jobStoreID).remainingRetryCount,
+                                  self.master._defaultTryCount())
+
         def testFileDeletion(self):
             """
             Intended to cover the batch deletion of items in the AWSJobStore, but it doesn't hurt running it on the
@@ -275,6 +318,125 @@ class hidden:
             for file in file_list:
                 self.assertRaises(NoSuchFileException, self.master.readFileStream(file).__enter__)
 
+        def testMoveLinkAndMemoryMapFiles(self):
+            """
+            Checks moving files into the job store, linking them out of it and reading them
+            through memory maps.
+            """
+            tempDir = self._createTempDir()
+            localPath = os.path.join(tempDir, "a")
+            with open(localPath, 'w') as f:
+                f.write("one")
+            fileID = self.master.moveFile(localPath)
+            self.assertFalse(os.path.exists(localPath))
+            # A linked copy is unaffected by updates to the file ...
+            linkedPath = os.path.join(tempDir, "b")
+            self.master.linkFile(fileID, linkedPath)
+            with self.master.updateFileStream(fileID) as f:
+                f.write("two")
+            with open(linkedPath, 'r') as f:
+                self.assertEquals(f.read(), "one")
+            # ... and replaced when linked over.
+            self.master.linkFile(fileID, linkedPath)
+            with open(linkedPath, 'r') as f:
+                self.assertEquals(f.read(), "two")
+            with self.master.readFileMemoryMap(fileID) as f:
+                f.seek(1)
+                self.assertEquals(f.read(), "wo")
+            with self.master.readFileMemoryMap(self.master.getEmptyFileStoreID()) as f:
+                self.assertEquals(f.read(), "")
+
+        def testReadFileRange(self):
+            """
+            Checks reading parts of a file, directly and through a seekable stream.
+            """
+            with self.master.writeFileStream() as (f, fileID):
+                f.write("0123456789\nabc\n")
+            self.assertEquals(self.master.readFileRange(fileID, 2, 5), "234")
+            self.assertEquals(self.master.readFileRange(fileID, 12, 20), "bc\n")
+            self.assertEquals(self.master.readFileRange(fileID, 20, 30), "")
+            with self.master.readSeekableFileStream(fileID) as f:
+                f.seek(8)
+                self.assertEquals(f.readline(), "89\n")
+                self.assertEquals(f.tell(), 11)
+                f.seek(-3, 1)
+                self.assertEquals(f.read(4), "89\na")
+                self.assertEquals(f.read(), "bc\n")
+                self.assertEquals(f.read(), "")
+            # Reading a few bytes at a time from the job store
+            f = SeekableFileStream(self.master, fileID)
+            f.blockSize = 4
+            self.assertEquals(list(f), ["0123456789\n", "abc\n"])
+
+        def testConfigFromEarlierVersion(self):
+            """
+            Checks that a jobStore whose config was pickled by an earlier version, without the
+            options added since, can be loaded and used, the options taking their defaults.
+            """
+            for name in ("profileJobs", "profileRate", "resultCache", "collectFiles",
+                         "fuseJobs", "jobCompression", "fileCompression", "fileDeduplication",
+                         "filesCompressed"):
+                self.master.config.__dict__.pop(name, None)
+            self.master.writeConfigToStore()
+            master = self._createJobStore()
+            self.assertEquals(master.config.jobCompression, Config().jobCompression)
+            job = master.create("1", 2, 3, 4, 0)
+            job.remainingRetryCount = 1
+            master.update(job)
+            self.assertEquals(master.load(job.jobStoreID), job)
+            with master.writeFileStream(job.jobStoreID) as (f, fileID):
+                f.write("data")
+            with master.readFileStream(fileID) as f:
+                self.assertEquals(f.read(), "data")
+
+        def testGetFileSize(self):
+            """
+            Checks the sizes of files, including empty files.
+            """
+            with self.master.writeFileStream() as (f, fileID):
+                f.write("0123456789")
+            self.assertEquals(self.master.getFileSize(fileID), 10)
+            self.assertEquals(self.master.getFileSize(self.master.getEmptyFileStoreID()), 0)
+
+        def testWaitForDeletion(self):
+            """
+            Checks that waitForDeletion returns once another thread deletes the files.
+            """
+            job = self.master.create("1", 2, 3, 4, 0)
+            fileIDs = [self.master.getEmptyFileStoreID(job.jobStoreID),
+                       self.master.getEmptyFileStoreID()]
+            def deleteFiles():
+                for fileID in fileIDs:
+                    time.sleep(0.5)
+                    self.master.deleteFile(fileID)
+            thread = Thread(target=deleteFiles)
+            thread.start()
+            try:
+                self.master.waitForDeletion(fileIDs)
+                for fileID in fileIDs:
+                    self.assertFalse(self.master.fileExists(fileID))
+            finally:
+                thread.join()
+            #Returns immediately if the files do not exist
+            self.master.waitForDeletion(fileIDs)
+
+        def testDeleteFiles(self):
+            """
+            Checks the bulk deletion of files, which ignores files that do not exist.
+            """
+            job = self.master.create("1", 2, 3, 4, 0)
+            fileIDs = [ self.master.getEmptyFileStoreID(job.jobStoreID) for i in xrange(30) ]
+            for fileID in fileIDs[:10]:
+                with self.master.updateFileStream(fileID) as f:
+                    f.write(fileID)
+            keptFileID = self.master.getEmptyFileStoreID(job.jobStoreID)
+            self.master.deleteFile(fileIDs[-1])
+            self.master.deleteFiles(fileIDs)
+            for fileID in fileIDs:
+                self.assertFalse(self.master.fileExists(fileID))
+            self.assertTrue(self.master.fileExists(keptFileID))
+            self.master.deleteFiles([])
+
         partSize = 5 * 1024 * 1024
 
         def testMultipartUploads(self):
@@ -372,6 +534,144 @@ class hidden:
                 self.assertEquals(f.read(), "")
             self.master.delete(job.jobStoreID)
 
+        def testFileCompression(self):
+            """
+            Checks that files are compressed when it saves space, and read back unchanged
+            through each of the ways of reading files.
+            """
+            self.master.config.fileCompression = "zlib"
+            self.master.writeConfigToStore()
+            tempDir = self._createTempDir()
+            compressible = "toil " * 100000
+            incompressible = os.urandom(100000)
+            # Data that happens to look like a compressed file must not be mistaken for one
+            magic = "\x89TOILZ\r\n\x01" + compressible
+            fileIDs = {}
+            for name, data in (("compressible", compressible),
+                               ("incompressible", incompressible),
+                               ("magic", magic)):
+                localPath = os.path.join(tempDir, name)
+                with open(localPath, 'w') as f:
+                    f.write(data)
+                fileIDs[(name, "file")] = self.master.writeFile(localPath)
+                with self.master.writeFileStream() as (f, fileID):
+                    f.write(data)
+                fileIDs[(name, "stream")] = fileID
+                fileID = self.master.getEmptyFileStoreID()
+                self.master.updateFile(fileID, localPath)
+                fileIDs[(name, "update")] = fileID
+                fileID = self.master.getEmptyFileStoreID()
+                with self.master.updateFileStream(fileID) as f:
+                    f.write(data)
+                fileIDs[(name, "updateStream")] = fileID
+                fileIDs[(name, "move")] = self.master.moveFile(localPath)
+            for (name, how), fileID in fileIDs.iteritems():
+                data = {"compressible": compressible,
+                        "incompressible": incompressible,
+                        "magic": magic}[name]
+                self.assertEquals(self.master.getFileSize(fileID), len(data))
+                if name != "incompressible":
+                    self.assertTrue(self.master._getFileSize(fileID) < len(data) / 10)
+                else:
+                    self.assertEquals(self.master._getFileSize(fileID), len(data))
+                localPath = os.path.join(tempDir, "read")
+                self.master.readFile(fileID, localPath)
+                with open(localPath, 'r') as f:
+                    self.assertEquals(f.read(), data)
+                linkedPath = os.path.join(tempDir, "linked")
+                self.master.linkFile(fileID, linkedPath)
+                with open(linkedPath, 'r') as f:
+                    self.assertEquals(f.read(), data)
+                with self.master.readFileStream(fileID) as f:
+                    self.assertEquals(f.read(), data)
+                self.assertEquals(self.master.readFileRange(fileID, 5, 20), data[5:20])
+                with self.master.readSeekableFileStream(fileID) as f:
+                    f.seek(len(data) - 10)
+                    self.assertEquals(f.read(), data[-10:])
+                with self.master.readFileMemoryMap(fileID) as f:
+                    self.assertEquals(f.read(), data)
+            self.assertTrue(self.master.compressionSavedBytes > 4 * len(compressible))
+            # Files compressed when written are read back once the option is no longer set, as
+            # the config records that files may have been compressed, and data that looks like
+            # a compressed file is still not mistaken for one
+            self.master.config.fileCompression = "none"
+            self.master.writeConfigToStore()
+            master = self._createJobStore()
+            with master.readFileStream(fileIDs[("compressible", "file")]) as f:
+                self.assertEquals(f.read(), compressible)
+            for name, data in (("compressible", compressible), ("magic", magic)):
+                with master.writeFileStream() as (f, fileID):
+                    f.write(data)
+                self.assertEquals(master.readFileRange(fileID, 0, 20), data[:20])
+                with master.readFileStream(fileID) as f:
+                    self.assertEquals(f.read(), data)
+            # A public URL gives the content of a compressed file, which is left as it is
+            for name, data in (("compressible", compressible), ("magic", magic)):
+                fileID = fileIDs[(name, "stream")]
+                url = master.getPublicUrl(fileID)
+                self.assertEquals(urllib2.urlopen(urllib2.Request(url)).read(), data)
+                self.assertTrue(master._getFileSize(fileID) < len(data) / 10)
+                with master.readFileStream(fileID) as f:
+                    self.assertEquals(f.read(), data)
+
+        def _countBlobs(self):
+            """
+            :rtype: the number of blobs, each shared by the files with the same content, in the
+            job store, or None if the job store does not deduplicate files.
+            """
+            return None
+
+        def testFileDeduplication(self):
+            """
+            Checks that files with the same content share a blob, where the job store
+            deduplicates files, and that deleting or updating some of the files leaves the
+            others intact and removes the blob with the last of them. Job stores that do not
+            deduplicate files must reject the option.
+            """
+            if not self.master.deduplicatesFiles:
+                config = self._createConfig()
+                config.fileDeduplication = True
+                self.assertRaises(RuntimeError, self._createJobStore, config)
+                return
+            self.master.config.fileDeduplication = True
+            tempDir = self._createTempDir()
+            localPath = os.path.join(tempDir, "a")
+            with open(localPath, 'w') as f:
+                f.write("foo")
+            job = self.master.create("1", 2, 3, 4, 0)
+            fileIDs = [ self.master.writeFile(localPath),
+                        self.master.writeFile(localPath, job.jobStoreID) ]
+            with self.master.writeFileStream() as (f, fileID):
+                f.write("foo")
+            fileIDs.append(fileID)
+            fileIDs.append(self.master.moveFile(localPath, job.jobStoreID))
+            self.assertFalse(os.path.exists(localPath))
+            with self.master.writeFileStream() as (f, otherFileID):
+                f.write("bar")
+            if self._countBlobs() is not None:
+                # The files are links to the blob on their volume, where there are several
+                inodes = set(os.stat(self.master.getPublicUrl(fileID).split(':', 1)[1]).st_ino
+                             for fileID in fileIDs)
+                self.assertEquals(len(inodes), self._countBlobs() - 1)
+            with open(localPath, 'w') as f:
+                f.write("baz")
+            self.master.updateFile(fileIDs[0], localPath)
+            self.master.deleteFile(fileIDs[1])
+            with self.master.readFileStream(fileIDs[0]) as f:
+                self.assertEquals(f.read(), "baz")
+            for fileID in fileIDs[2:]:
+                with self.master.readFileStream(fileID) as f:
+                    self.assertEquals(f.read(), "foo")
+            self.master.delete(job.jobStoreID)
+            with self.master.readFileStream(fileIDs[2]) as f:
+                self.assertEquals(f.read(), "foo")
+            self.master.deleteFile(fileIDs[2])
+            if self._countBlobs() is not None:
+                self.assertEquals(self._countBlobs(), 1)
+            self.master.deleteFile(otherFileID)
+            if self._countBlobs() is not None:
+                self.assertEquals(self._countBlobs(), 0)
+
         def assertUrl(self, url):
             prefix, path = url.split(':', 1)
             if prefix == 'file':
@@ -417,6 +717,237 @@ class FileJobStoreTest(hidden.AbstractJobStoreTest):
     def _createJobStore(self, config=None):
         return FileJobStore(self.namePrefix, config=config)
 
+    def _countBlobs(self):
+        return sum(fileNames.count("data") for volume in self.master.volumes
+                   for _, _, fileNames in os.walk(os.path.join(volume, "blobs")))
+
+    def testStatsLogSegments(self):
+        """
+        Checks that the stats log is continued in new segments, that the segments are deleted
+        once read and that the position of the reader is kept by other instances of the job
+        store.
+        """
+        stats = []
+        self.master.statsSegmentSize = 10
+        for i in xrange(5):
+            self.master.writeStatsAndLogging(str(i) * 4)
+        self.assertEquals(len(self.master._statsSegments()), 3)
+        self.assertEquals(self.master.readStatsAndLogging(lambda f: stats.append(f.read())), 5)
+        self.assertEquals(stats, [ str(i) * 4 for i in xrange(5) ])
+        self.assertEquals(len(self.master._statsSegments()), 1)
+        self.master.writeStatsAndLogging("5")
+        stats = []
+        worker = self._createJobStore()
+        self.assertEquals(worker.readStatsAndLogging(lambda f: stats.append(f.read())), 1)
+        self.assertEquals(stats, ["5"])
+        self.assertEquals(self.master.readStatsAndLogging(lambda f: stats.append(f.read())), 0)
+
+    def testOldStatsFiles(self):
+        """
+        Checks that the stats files written to the temporary directories by earlier versions,
+        which had no stats log, are read once, along with the stats log.
+        """
+        shutil.rmtree(self.master.statsDir)
+        tempDir = self.master._getTempSharedDir()
+        if not os.path.exists(tempDir):
+            os.makedirs(tempDir)
+        for fileName, string in (("stats1", "old"), ("stats2.new", "partial")):
+            with open(os.path.join(tempDir, fileName), 'w') as f:
+                f.write(string)
+        master = self._createJobStore()
+        master.writeStatsAndLogging("new")
+        stats = []
+        self.assertEquals(master.readStatsAndLogging(lambda f: stats.append(f.read())), 2)
+        self.assertEquals(stats, ["old", "new"])
+        self.assertEquals(os.listdir(tempDir), ["stats2.new"])
+        self.assertEquals(master.readStatsAndLogging(lambda f: stats.append(f.read())), 0)
+
+    def testWaitForDeletionWithoutWatches(self):
+        """
+        Checks that waitForDeletion polls for the deletion of the files if the directories
+        holding them can not be watched, as when the limit on inotify watches is reached.
+        """
+        libc = fileJobStore._getLibc()
+        class Libc(object):
+            inotify_init = libc.inotify_init
+            @staticmethod
+            def inotify_add_watch(fd, path, mask):
+                ctypes.set_errno(errno.ENOSPC)
+                return -1
+        fileJobStore._libc = Libc()
+        try:
+            self.testWaitForDeletion()
+        finally:
+            fileJobStore._libc = libc
+
+    def testJobIndex(self):
+        """
+        Checks that the jobs are listed by the index, which is compacted as it grows, and that
+        the index is rebuilt from the job directories when cleaning the job store.
+        """
+        self.master.jobIndexCompactionSize = 200
+        jobs = [ self.master.create("1", 2, 3, 4, 0) for i in xrange(10) ]
+        for job in jobs[:8]:
+            self.master.delete(job.jobStoreID)
+        jobStoreIDs = [ job.jobStoreID for job in jobs[8:] ]
+        self.assertEquals([ job.jobStoreID for job in self.master.jobs() ], jobStoreIDs)
+        self.assertTrue(os.path.getsize(self.master.jobIndexPath) < 200)
+        #An index left by an interrupted creation and deletion
+        with open(self.master.jobIndexPath, 'w') as f:
+            f.write("+%s\n+%s\n" % (jobs[0].jobStoreID, jobStoreIDs[0]))
+        self.assertEquals([ job.jobStoreID for job in self.master.jobs() ], jobStoreIDs[:1])
+        self.master.clean()
+        self.assertEquals(set(job.jobStoreID for job in self.master.jobs()), set(jobStoreIDs))
+        self.assertEquals(set(self.master._readJobIndex()), set(jobStoreIDs))
+
+    def testJobIndexThreads(self):
+        """
+        Checks that the index of jobs stays consistent with the jobs when they are created and
+        deleted by several threads of the process, as clean does, while it is compacted.
+        """
+        self.master.jobIndexCompactionSize = 500
+        def createAndDelete(i):
+            jobs = [ self.master.create("1", 2, 3, 4, 0) for j in xrange(20) ]
+            for job in jobs[::2]:
+                self.master.delete(job.jobStoreID)
+            return [ job.jobStoreID for job in jobs[1::2] ]
+        pool = ThreadPool(8)
+        try:
+            jobStoreIDs = sum(pool.map(createAndDelete, xrange(8)), [])
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEquals(sorted(self.master._readJobIndex()), sorted(jobStoreIDs))
+
+    def testFileStreamToSubprocess(self):
+        """
+        Checks that the file handles of file streams are files, which subprocesses can write to
+        and read from, unless files may have been compressed, see writeFileStream.
+        """
+        with self.master.writeFileStream() as (f, fileID):
+            subprocess.check_call(["echo", "foo"], stdout=f)
+        with self.master.readFileStream(fileID) as f:
+            self.assertEquals(subprocess.check_output(["cat"], stdin=f), "foo\n")
+
+    def testSyscallCounts(self):
+        """
+        Counts the metadata system calls, each a round trip on a network file system, made by
+        each operation on the job store, checking that none is spent on checks that the
+        operation itself makes.
+        """
+        import toil.jobStores.fileJobStore as fileJobStore
+        counts = {}
+        def counting(name, fn):
+            def wrapper(*args, **kwargs):
+                counts[name] = counts.get(name, 0) + 1
+                return fn(*args, **kwargs)
+            return wrapper
+        names = [ "stat", "lstat", "open", "mkdir", "rename", "remove", "unlink", "link",
+                  "rmdir", "listdir", "chmod" ]
+        originals = dict((name, getattr(os, name)) for name in names)
+        #The directories for jobs are made as they are first used, see _makeInTempSharedDir,
+        #so all are put in one
+        self.master.validDirs = "A"
+        localFilePath = os.path.join(self._createTempDir(), "local")
+        with open(localFilePath, 'w') as f:
+            f.write("foo")
+        job = self.master.create("1", 2, 3, 4, 0)
+        fileID = self.master.writeFile(localFilePath, job.jobStoreID)
+        def update():
+            with self.master.updateFileStream(fileID) as f:
+                f.write("bar")
+        def read():
+            with self.master.readFileStream(fileID) as f:
+                f.read()
+        operations = [
+            ("create", lambda: self.master.create("1", 2, 3, 4, 0), 4),
+            ("load", lambda: self.master.load(job.jobStoreID), 2),
+            ("update", lambda: self.master.update(job), 2),
+            ("writeFile", lambda: self.master.writeFile(localFilePath, job.jobStoreID), 2),
+            ("readFile", lambda: self.master.readFile(fileID, localFilePath), 2),
+            ("readFileStream", read, 1),
+            ("updateFile", lambda: self.master.updateFile(fileID, localFilePath), 4),
+            ("updateFileStream", update, 3),
+            ("getFileSize", lambda: self.master.getFileSize(fileID), 1),
+            ("deleteFile", lambda: self.master.deleteFile(fileID), 1) ]
+        fileJobStore.open = counting("open", open)
+        try:
+            for name in names:
+                setattr(os, name, counting(name, originals[name]))
+            results = []
+            for operation, fn, limit in operations:
+                counts.clear()
+                fn()
+                results.append((operation, sum(counts.values()), limit, dict(counts)))
+        finally:
+            for name in names:
+                setattr(os, name, originals[name])
+            del fileJobStore.open
+        for operation, n, limit, syscalls in results:
+            logger.info("%-20s %3i %s", operation, n,
+                        ", ".join("%s=%i" % i for i in sorted(syscalls.items())))
+        for operation, n, limit, syscalls in results:
+            self.assertTrue(n <= limit, "%s made %i metadata system calls: %s" %
+                            (operation, n, syscalls))
+
+
+class MultiVolumeFileJobStoreTest(FileJobStoreTest):
+    def _createJobStore(self, config=None):
+        volumes = [ "%s.%i" % (self.namePrefix, i) for i in xrange(1, 3) ]
+        return FileJobStore(self.namePrefix, config=config, volumes=volumes)
+
+    def testVolumes(self):
+        """
+        Checks that the jobs and files are spread over the volumes, which are found by other
+        instances of the job store without being given, and that the shared files are copied
+        to every volume.
+        """
+        jobs = [ self.master.create("1", 2, 3, 4, 0) for i in xrange(30) ]
+        fileIDs = [ self.master.getEmptyFileStoreID(job.jobStoreID) for job in jobs ]
+        with self.master.writeSharedFileStream("foo") as f:
+            f.write("bar")
+        worker = FileJobStore(self.namePrefix)
+        self.assertEquals(worker.volumes, self.master.volumes)
+        self.assertEquals(set(job.jobStoreID for job in worker.jobs()),
+                          set(job.jobStoreID for job in jobs))
+        for volume in worker.volumes:
+            self.assertTrue(any(os.path.exists(os.path.join(volume, "tmp", fileID))
+                                for fileID in fileIDs))
+            with open(os.path.join(volume, "foo")) as f:
+                self.assertEquals(f.read(), "bar")
+        with worker.readSharedFileStream("foo") as f:
+            self.assertEquals(f.read(), "bar")
+
+
+class SQLiteJobStoreTest(hidden.AbstractJobStoreTest):
+    def _createJobStore(self, config=None):
+        from toil.jobStores.sqliteJobStore import SQLiteJobStore
+        return SQLiteJobStore(self.namePrefix, config=config)
+
+    def _countBlobs(self):
+        return len(self.master._query("SELECT hash FROM blobs"))
+
+    def testBatch(self):
+        """
+        Checks that the jobs created in a batch are only seen by other instances of the job
+        store once the batch is committed, and that no jobs are created by a failed batch.
+        """
+        worker = self._createJobStore()
+        with self.master.batch():
+            job = self.master.create("1", 2, 3, 4, 0)
+            with self.master.batch():
+                self.master.create("2", 2, 3, 4, 0)
+            self.assertTrue(self.master.exists(job.jobStoreID))
+            self.assertFalse(worker.exists(job.jobStoreID))
+        self.assertEquals(len(list(worker.jobs())), 2)
+        try:
+            with self.master.batch():
+                self.master.create("3", 2, 3, 4, 0)
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEquals(len(list(worker.jobs())), 2)
+
 
 @needs_aws
 class AWSJobStoreTest(hidden.AbstractJobStoreTest):
@@ -23,42 +23,45 @@ import random
 from bd2k.util.humanize import human2bytes
 
 from toil.job import Job
-from toil.test.sort.lib import merge, sort, copySubRangeOfFile, getMidPoint
+from toil.test.sort.lib import merge, sort
 
 success_ratio = 0.5
 sortMemory = human2bytes('1000M')
 
 def setup(job, inputFile, N):
-    """Sets up the sort.
+    """Sets up the sort, copying the input file to the global file store.
     """
+    inputFileID = job.fileStore.writeGlobalFile(inputFile, cleanup=True)
     job.addFollowOnJobFn(cleanup, job.addChildJobFn(down, 
-        inputFile, 0, os.path.getsize(inputFile), N).rv(), inputFile, memory=sortMemory)
+        inputFileID, 0, os.path.getsize(inputFile), N).rv(), inputFile, memory=sortMemory)
 
-def down(job, inputFile, fileStart, fileEnd, N):
-    """Input is a file and a range into that file to sort and an output location in which
+def down(job, inputFileID, fileStart, fileEnd, N):
+    """Input is a global file and a range into that file to sort and an output location in which
     to write the sorted file.
     If the range is larger than a threshold N the range is divided recursively and
     a follow on job is then created which merges back the results else
-    the file is sorted and placed in the output.
+    the file is sorted and placed in the output. Only the range is read from the file.
     """
     if random.random() > success_ratio:
         raise RuntimeError() #This error is a test error, it does not mean the tests have failed.
     length = fileEnd - fileStart
-    if length > N:
+    splitPoints = job.fileStore.getGlobalFileSplitPoints(inputFileID, fileStart, fileEnd) \
+        if length > N else []
+    if len(splitPoints) > 0:
         #We will subdivide the file
         job.fileStore.logToMaster( "Splitting range (%i..%i) of file: %s"
-                                      % (fileStart, fileEnd, inputFile) )
-        midPoint = getMidPoint(inputFile, fileStart, fileEnd)
+                                      % (fileStart, fileEnd, inputFileID) )
+        midPoint = splitPoints[0]
         return job.addFollowOnJobFn(up,
-            job.addChildJobFn(down, inputFile, fileStart, midPoint+1, N, memory=sortMemory).rv(),
-            job.addChildJobFn(down, inputFile, midPoint+1, fileEnd, N, memory=sortMemory).rv()).rv()          
+            job.addChildJobFn(down, inputFileID, fileStart, midPoint, N, memory=sortMemory).rv(),
+            job.addChildJobFn(down, inputFileID, midPoint, fileEnd, N, memory=sortMemory).rv()).rv()          
     else:
         #We can sort this bit of the file
         job.fileStore.logToMaster( "Sorting range (%i..%i) of file: %s"
-                                      % (fileStart, fileEnd, inputFile) )
+                                      % (fileStart, fileEnd, inputFileID) )
         t = job.fileStore.getLocalTempFile()
         with open(t, 'w') as fH:
-            copySubRangeOfFile(inputFile, fileStart, fileEnd, fH)
+            fH.write(job.fileStore.readGlobalFileRange(inputFileID, fileStart, fileEnd))
         sort(t)
         return job.fileStore.writeGlobalFile(t)
 
@@ -14,9 +14,10 @@
 from __future__ import absolute_import
 import os
 import unittest
+import cPickle
 
 from toil.lib.bioio import getTempFile
-from toil.job import Job
+from toil.job import Job, ServiceJob, FileID, collectFileIDs
 from toil.test import ToilTest
 
 class JobServiceTest(ToilTest):
@@ -43,6 +44,18 @@ class JobServiceTest(ToilTest):
         finally:
             os.remove(outFile)
 
+    def testServiceFileIDs(self):
+        """
+        Checks that the FileIDs held by a service are collected when its job is pickled.
+        """
+        fileID = FileID("foo")
+        serviceJob = ServiceJob(TestService(fileID, "3", "out"))
+        with collectFileIDs() as fileIDs:
+            pickledJob = cPickle.dumps(serviceJob, cPickle.HIGHEST_PROTOCOL)
+        self.assertEquals(fileIDs, set([ fileID ]))
+        service = cPickle.loads(cPickle.loads(pickledJob).pickledService)
+        self.assertEquals(service.startString, fileID)
+
 class TestService(Job.Service):
     def __init__(self, startString, stopString, outFile):
         Job.Service.__init__(self)
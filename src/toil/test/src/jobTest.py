@@ -15,9 +15,18 @@ from __future__ import absolute_import
 import unittest
 import os
 import random
+import signal
+import socket
+from threading import Thread
+import time
+from functools import partial
 
 from toil.lib.bioio import getTempFile
-from toil.job import Job, JobGraphDeadlockException
+from toil.job import Job, FusedJob, JobGraphDeadlockException
+from toil.common import loadJobStore, Config
+from toil.leader import FailedJobsException
+from toil.jobWrapper import ChunkedSuccessors
+from toil.utils.toilStats import getStats
 from toil.test import ToilTest
 
 
@@ -103,6 +112,402 @@ class JobTest(ToilTest):
         finally:
             os.remove(outFile)
 
+    def testNoOpJobElision(self):
+        """
+        Checks that jobs which do nothing, like barriers and the follow-on of an encapsulated
+        job, are not run, while the order of the remaining jobs is unchanged. The graph is:
+        
+        A -> E
+         \
+          Job() -- B -> D
+                \
+                 C
+        
+        where Job() is a barrier and B is encapsulated, and follow ons are marked by ->
+        """
+        outFile = getTempFile(rootDir=self._createTempDir())
+        try:
+            A = Job.wrapFn(f, "A", outFile)
+            barrier = A.addChild(Job())
+            B = barrier.addChild(Job.wrapFn(f, "B", outFile).encapsulate())
+            barrier.addChildFn(f, "C", outFile)
+            B.addFollowOnFn(f, "D", outFile)
+            A.addFollowOnFn(f, "E", outFile)
+
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            options.stats = True
+            Job.Runner.startToil(A, options)
+            
+            output = open(outFile, 'r').readline()
+            self.assertEquals(set(output), set("ABCDE"))
+            self.assertTrue(output.index("B") < output.index("D"))
+            self.assertEquals(output[0], "A")
+            self.assertEquals(output[-1], "E")
+            
+            # Check no job that does nothing was run
+            jobStore = loadJobStore(options.jobStore)
+            stats = getStats(options)
+            jobNames = [ job.attrib["class"] for job in stats.iter("job") ]
+            self.assertEquals(len(jobNames), 5)
+            self.assertTrue("Job" not in jobNames)
+            jobStore.deleteJobStore()
+        finally:
+            os.remove(outFile)
+
+    def testJobChainFusion(self):
+        """
+        Checks that a chain of jobs is fused into a single job and that the jobs of the chain
+        are run in order, passing their return values, when a job of the chain creates
+        successors. The graph is:
+        
+        A -> E
+        |
+        B -- C -- D -- Z
+        
+        where B creates a child X and a follow-on Y, C and D take the return values of B
+        and C respectively, and Z requires different resources to the other jobs.
+        """
+        def makeGraph(outFile):
+            A = Job.wrapFn(f, "A", outFile)
+            B = A.addChildJobFn(g, outFile)
+            C = B.addChildFn(f, B.rv(), outFile)
+            D = C.addChildFn(f, C.rv(), outFile)
+            D.addChildFn(f, "Z", outFile, memory="10M")
+            A.addFollowOnFn(f, "E", outFile)
+            return A, [B, C, D]
+        
+        # Check the chain is replaced by a FusedJob
+        A, chain = makeGraph(None)
+        A._fuseJobChains(None)
+        self.assertEquals(len(A._children), 1)
+        self.assertTrue(isinstance(A._children[0], FusedJob))
+        self.assertEquals(A._children[0]._jobs, chain)
+        
+        outFile = getTempFile(rootDir=self._createTempDir())
+        try:
+            A, chain = makeGraph(outFile)
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            options.stats = True
+            options.fuseJobs = True
+            Job.Runner.startToil(A, options)
+            
+            output = open(outFile, 'r').readline()
+            self.assertEquals(set(output), set("ABCDEXYZ"))
+            self.assertEquals(output[:2], "AB")
+            self.assertTrue(output.index("C") < output.index("D") < output.index("Z"))
+            for i in "CDXZ":
+                self.assertTrue(output.index(i) < output.index("Y"))
+            self.assertEquals(output[-1], "E")
+            
+            # Check the stats of each job of the chain are reported
+            jobStore = loadJobStore(options.jobStore)
+            stats = getStats(options)
+            self.assertEquals(len(list(stats.iter("job"))), 8)
+            jobStore.deleteJobStore()
+        finally:
+            os.remove(outFile)
+
+    def testJobChainFusionRetry(self):
+        """
+        Checks that when the second job of a fused chain fails the chain is retried from its
+        first job, which is run again, and that chains are not fused unless the fuseJobs option
+        is set, in which case only the failed job is run again. The graph is R -> A -> B -> C,
+        where B fails the first time it is run.
+        """
+        for fuseJobs, expected in ((True, "RAABC"), (False, "RABC")):
+            tempDir = self._createTempDir()
+            outFile = os.path.join(tempDir, "out")
+            R = Job.wrapFn(f, "R", outFile)
+            A = R.addChildFn(f, "A", outFile)
+            B = A.addChildFn(failOnce, "B", outFile, os.path.join(tempDir, "failed"))
+            B.addChildFn(f, "C", outFile)
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            options.retryCount = 1
+            options.fuseJobs = fuseJobs
+            Job.Runner.startToil(R, options)
+            with open(outFile, 'r') as fileHandle:
+                self.assertEquals(fileHandle.read(), expected)
+
+    def testFailingRequirements(self):
+        """
+        Checks that a job whose requirement raises an exception when computed is treated as
+        having failed, being retried if it has retries remaining and failing the workflow if
+        not. The requirement fails the first time it is computed.
+        """
+        for retryCount in (1, 0):
+            tempDir = self._createTempDir()
+            outFile = os.path.join(tempDir, "out")
+            R = Job.wrapFn(f, "R", outFile)
+            R.addChildFn(f, "A", outFile,
+                         memory=partial(failingRequirement, os.path.join(tempDir, "failed")))
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            options.retryCount = retryCount
+            if retryCount > 0:
+                Job.Runner.startToil(R, options)
+                with open(outFile, 'r') as fileHandle:
+                    self.assertEquals(fileHandle.read(), "RA")
+            else:
+                self.assertRaises(FailedJobsException, Job.Runner.startToil, R, options)
+
+    def testReleaseChildren(self):
+        """
+        Checks that the children released by a job are run while the job is still running,
+        and that the follow-ons of the job are run after them.
+        """
+        outFile = getTempFile(rootDir=self._createTempDir())
+        try:
+            A = Job.wrapJobFn(releaser, outFile, cores=0.5)
+            A.addFollowOnFn(f, "F", outFile)
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            Job.Runner.startToil(A, options)
+            
+            output = open(outFile, 'r').readline()
+            self.assertEquals(output[0], "A")
+            self.assertEquals(set(output[1:3]), set("BC"))
+            self.assertEquals(output[3:], "DEF")
+        finally:
+            os.remove(outFile)
+
+    def testReleaseChildrenRetry(self):
+        """
+        Checks that the children released by a job that then fails, or whose worker is
+        killed, are withdrawn, so that only the children released when the job is retried are
+        run. Jobs are run one at a time, so the children released by the failed job can not
+        be run before it fails.
+        """
+        for kill in (False, True):
+            tempDir = self._createTempDir()
+            outFile = os.path.join(tempDir, "out")
+            A = Job.wrapJobFn(failingReleaser, outFile, os.path.join(tempDir, "failed"), kill)
+            A.addFollowOnFn(f, "F", outFile)
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            options.retryCount = 1
+            options.maxMemory = options.defaultMemory
+            Job.Runner.startToil(A, options)
+            with open(outFile, 'r') as fileHandle:
+                self.assertEquals(fileHandle.read(), "AABF")
+
+    def testAddChildrenFrom(self):
+        """
+        Checks that the children yielded by a generator are all run, in batches, before the
+        follow-ons of the job.
+        """
+        outFile = getTempFile(rootDir=self._createTempDir())
+        try:
+            A = Job.wrapJobFn(streamer, outFile)
+            A.addFollowOnFn(f, "C", outFile)
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            Job.Runner.startToil(A, options)
+            
+            output = open(outFile, 'r').readline()
+            self.assertEquals(output, "A" + "B" * 25 + "C")
+        finally:
+            os.remove(outFile)
+
+    def testChunkedSuccessors(self):
+        """
+        Checks that the successors of a job with more children than fit in a chunk are all run.
+        """
+        outFile = getTempFile(rootDir=self._createTempDir())
+        chunkSize = ChunkedSuccessors.chunkSize
+        ChunkedSuccessors.chunkSize = 10
+        try:
+            A = Job.wrapFn(f, "A", outFile)
+            for i in xrange(25):
+                A.addChildFn(f, "B", outFile)
+            A.addFollowOnFn(f, "C", outFile)
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            Job.Runner.startToil(A, options)
+            
+            output = open(outFile, 'r').readline()
+            self.assertEquals(output, "A" + "B" * 25 + "C")
+        finally:
+            ChunkedSuccessors.chunkSize = chunkSize
+            os.remove(outFile)
+
+    def testReadGlobalFiles(self):
+        """
+        Checks that global files read concurrently are all read, and that the downloads are
+        reported in the stats.
+        """
+        outFile = getTempFile(rootDir=self._createTempDir())
+        try:
+            A = Job.wrapJobFn(writeFiles, 20)
+            A.addFollowOnJobFn(readFiles, A.rv(), outFile)
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            options.stats = True
+            Job.Runner.startToil(A, options)
+            
+            self.assertEquals(open(outFile, 'r').read(), "".join(map(str, xrange(20))))
+            jobStore = loadJobStore(options.jobStore)
+            downloadedBytes = [ job.attrib["downloaded_bytes"] for job in 
+                                getStats(options).iter("job") if "downloaded_bytes" in job.attrib ]
+            self.assertEquals(downloadedBytes, [ str(len("".join(map(str, xrange(20))))) ])
+            jobStore.deleteJobStore()
+        finally:
+            os.remove(outFile)
+
+    def testCollectFiles(self):
+        """
+        Checks that with the collectFiles option global files are deleted once the jobs they
+        are passed to have completed, and that the storage they use is reported in the stats.
+        """
+        outFile = getTempFile(rootDir=self._createTempDir())
+        try:
+            A = Job.wrapJobFn(writeCollectedFiles, outFile)
+            A.addFollowOnJobFn(readCollectedFiles, A.rv(), outFile)
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            options.stats = True
+            options.collectFiles = True
+            Job.Runner.startToil(A, options)
+            
+            lines = open(outFile, 'r').read().split()
+            self.assertEquals(lines[3:], [ "one", "two" ])
+            jobStore = loadJobStore(options.jobStore)
+            for fileStoreID in lines[:3]:
+                self.assertFalse(jobStore.fileExists(fileStoreID))
+            storage = list(getStats(options).iter("storage"))
+            self.assertEquals(storage[-1].attrib["bytes"], "0")
+            self.assertEquals(storage[-1].attrib["peak_bytes"], str(len("onetwothree")))
+            jobStore.deleteJobStore()
+        finally:
+            os.remove(outFile)
+
+    def testDynamicRequirements(self):
+        """
+        Checks that the requirements of a job given as a promise and as a callable are
+        computed when the job is issued.
+        """
+        outFile = getTempFile(rootDir=self._createTempDir())
+        try:
+            A = Job.wrapJobFn(writeSizedFile, 1000)
+            A.addFollowOnJobFn(writeRequirements, outFile,
+                               memory=partial(memoryForFile, A.rv(0)), disk=A.rv(1))
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            Job.Runner.startToil(A, options)
+            
+            self.assertEquals(open(outFile, 'r').read(), "%i %i" % (1000 * 1024, 3 * 1024 * 1024))
+        finally:
+            os.remove(outFile)
+
+    def testMapReduce(self):
+        """
+        Checks the results of a map and of a map with a reduction, each split over a tree of
+        jobs, made both from within the run method of a job and before the workflow is run.
+        """
+        outFile = getTempFile(rootDir=self._createTempDir())
+        try:
+            A = Job.wrapJobFn(mapReducer, outFile)
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            Job.Runner.startToil(A, options)
+            
+            squares = [ i * i for i in xrange(95) ]
+            self.assertEquals(open(outFile, 'r').read(), repr((squares, sum(squares), None)))
+            
+            A = Job()
+            squares = A.map(square, xrange(25), chunkSize=10)
+            A.addFollowOnFn(writeValues, outFile, squares.rv())
+            Job.Runner.startToil(A, options)
+            
+            self.assertEquals(open(outFile, 'r').read(), repr(([ i * i for i in xrange(25) ],)))
+        finally:
+            os.remove(outFile)
+
+    def testStreaming(self):
+        """
+        Checks that data written to a stream is passed through a socket to a released child
+        reading it, and through the job store to a child that is not run at the same time.
+        """
+        for release, mode in ((True, "done"), (False, "file")):
+            outFile = getTempFile(rootDir=self._createTempDir())
+            modeFile = getTempFile(rootDir=self._createTempDir())
+            try:
+                A = Job.wrapJobFn(streamWriter, outFile, release, cores=0.5)
+                A.addFollowOnFn(writeValues, modeFile, A.rv())
+                options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+                options.logLevel = "INFO"
+                Job.Runner.startToil(A, options)
+                
+                lines = "".join("%i\n" % i for i in xrange(1000))
+                self.assertEquals(open(outFile, 'r').read(), lines)
+                self.assertEquals(open(modeFile, 'r').read(), repr((mode,)))
+            finally:
+                os.remove(outFile)
+                os.remove(modeFile)
+
+    def testStreamFailure(self):
+        """
+        Checks that the reader of a stream fails if the writer fails before writing all the
+        data, and that connections that do not send the token of the stream are not taken for
+        the reader.
+        """
+        jobStore = loadJobStore(self._getTestJobStorePath(), config=Config())
+        try:
+            jobWrapper = jobStore.create("1", 2, 3, 4, 0)
+            fileStore = Job.FileStore(jobStore, jobWrapper, self._createTempDir())
+            for fail in (False, True):
+                streamID = fileStore.createGlobalStream()
+                def write():
+                    try:
+                        with fileStore.writeGlobalStream(streamID, timeout=30) as fileHandle:
+                            fileHandle.write("foo\n")
+                            if fail:
+                                raise RuntimeError("Failing before writing all the data")
+                            fileHandle.write("bar\n")
+                    except RuntimeError:
+                        pass
+                writer = Thread(target=write)
+                writer.start()
+                try:
+                    header = []
+                    while len(header) == 0:
+                        with jobStore.readFileStream(streamID) as fileHandle:
+                            header = fileHandle.readline().split()
+                    connection = socket.create_connection((header[1], int(header[2])))
+                    connection.sendall("x" * len(header[3]))
+                    connection.close()
+                    with fileStore.readGlobalStream(streamID) as fileHandle:
+                        self.assertEquals(fileHandle.readline(), "foo\n")
+                        if fail:
+                            self.assertRaises(RuntimeError, fileHandle.read)
+                        else:
+                            self.assertEquals(list(fileHandle), [ "bar\n" ])
+                finally:
+                    writer.join()
+        finally:
+            jobStore.deleteJobStore()
+
+    def testDownloadFailure(self):
+        """
+        Checks that reading prefetched global files fails, rather than waiting forever, if the
+        download threads can not load the job store.
+        """
+        jobStore = loadJobStore(self._getTestJobStorePath(), config=Config())
+        try:
+            jobWrapper = jobStore.create("1", 2, 3, 4, 0)
+            fileStore = Job.FileStore(jobStore, jobWrapper, self._createTempDir())
+            with jobStore.writeFileStream() as (fileHandle, fileStoreID):
+                fileHandle.write("foo")
+            jobStore.config.jobStore = os.path.join(self._createTempDir(), "missing")
+            try:
+                self.assertRaises(Exception, list, fileStore.readGlobalFiles([ fileStoreID ]))
+            finally:
+                fileStore._stopDownloads()
+        finally:
+            jobStore.deleteJobStore()
+
     def testDeadlockDetection(self):
         """
         Randomly generate job graphs with various types of cycle in them and
@@ -428,5 +833,193 @@ def f(string, outFile, promises=[]):
     fH.close()
     return chr(ord(string[0]) + 1)
 
+def failOnce(string, outFile, failedFile):
+    """
+    Function that fails the first time it is run, creating failedFile, and then behaves as f.
+    """
+    if not os.path.exists(failedFile):
+        open(failedFile, 'w').close()
+        raise RuntimeError("Failing once")
+    return f(string, outFile)
+
+def releaser(job, outFile):
+    """
+    Job function that releases two children then waits for them to be run, before adding
+    another child.
+    """
+    f("A", outFile)
+    for string in "BC":
+        job.addChildFn(f, string, outFile, cores=0.1)
+    job.releaseChildren()
+    for i in xrange(600):
+        with open(outFile, 'r') as fileHandle:
+            if len(fileHandle.read()) == 3:
+                break
+        time.sleep(0.1)
+    else:
+        raise RuntimeError("The released children were not run")
+    f("D", outFile)
+    job.addChildFn(f, "E", outFile, cores=0.1)
+
+def failingReleaser(job, outFile, failedFile, kill=False):
+    """
+    Job function that releases a child and then fails the first time it is run, creating
+    failedFile, by killing its worker if kill is True.
+    """
+    f("A", outFile)
+    job.addChildFn(f, "B", outFile)
+    job.releaseChildren()
+    if not os.path.exists(failedFile):
+        open(failedFile, 'w').close()
+        if kill:
+            os.kill(os.getpid(), signal.SIGKILL)
+        raise RuntimeError("Failing once, after releasing a child")
+
+def streamer(job, outFile):
+    """
+    Job function that adds 25 children from a generator, in batches of 10.
+    """
+    f("A", outFile)
+    job.addChildrenFrom((Job.wrapFn(f, "B", outFile) for i in xrange(25)), batchSize=10)
+
+def writeFiles(job, n):
+    """
+    Job function that writes n global files, the ith containing i, returning their IDs.
+    """
+    fileStoreIDs = []
+    for i in xrange(n):
+        with job.fileStore.writeGlobalFileStream() as (fileHandle, fileStoreID):
+            fileHandle.write(str(i))
+        fileStoreIDs.append(fileStoreID)
+    return fileStoreIDs
+
+def readFiles(job, fileStoreIDs, outFile):
+    """
+    Job function that reads the given global files concurrently, writing their content to
+    the out file in the order of the IDs.
+    """
+    job.fileStore.prefetchGlobalFiles(fileStoreIDs[:5])
+    completedFiles = job.fileStore.readGlobalFiles(fileStoreIDs[::-1])
+    #The downloads start before the files are iterated over
+    assert all(fileStoreID in job.fileStore._downloads for fileStoreID in fileStoreIDs)
+    paths = dict(completedFiles)
+    assert paths[fileStoreIDs[0]] == job.fileStore.readGlobalFile(fileStoreIDs[0])
+    with open(outFile, 'w') as fileHandle:
+        for fileStoreID in fileStoreIDs:
+            fileHandle.write(open(paths[fileStoreID], 'r').read())
+
+def writeCollectedFiles(job, outFile):
+    """
+    Job function that writes three global files, passing the first to a child, returning the
+    second and referring to the third nowhere, and writes their IDs to the out file.
+    """
+    localFile = job.fileStore.getLocalTempFile()
+    with open(localFile, 'w') as fileHandle:
+        fileHandle.write("one")
+    fileStoreIDs = [ job.fileStore.writeGlobalFile(localFile) ]
+    for string in ("two", "three"):
+        with job.fileStore.writeGlobalFileStream() as (fileHandle, fileStoreID):
+            fileHandle.write(string)
+        fileStoreIDs.append(fileStoreID)
+    with open(outFile, 'w') as fileHandle:
+        fileHandle.write(" ".join(fileStoreIDs) + "\n")
+    job.addChildJobFn(readCollectedFiles, fileStoreIDs[:1], outFile)
+    return fileStoreIDs[1:2]
+
+def readCollectedFiles(job, fileStoreIDs, outFile):
+    """
+    Job function that appends the content of the given global files to the out file.
+    """
+    with open(outFile, 'a') as fileHandle:
+        for fileStoreID in fileStoreIDs:
+            fileHandle.write(open(job.fileStore.readGlobalFile(fileStoreID), 'r').read() + "\n")
+
+def writeSizedFile(job, size):
+    """
+    Job function that writes a global file of the given size, returning its ID and a disk
+    requirement.
+    """
+    with job.fileStore.writeGlobalFileStream() as (fileHandle, fileStoreID):
+        fileHandle.write("A" * size)
+    return fileStoreID, "3M"
+
+def memoryForFile(fileStoreID, context):
+    """
+    Memory requirement of 1024 bytes per byte of the given global file, see
+    Job.RequirementContext.
+    """
+    return 1024 * context.getGlobalFileSize(fileStoreID)
+
+def failingRequirement(failedFile, context):
+    """
+    Memory requirement that raises an exception the first time it is computed, creating
+    failedFile, and is then 100M.
+    """
+    if not os.path.exists(failedFile):
+        open(failedFile, 'w').close()
+        raise RuntimeError("Failing once")
+    return "100M"
+
+def writeRequirements(job, outFile):
+    """
+    Job function that writes the memory and disk requirements of the job to the out file.
+    """
+    with open(outFile, 'w') as fileHandle:
+        fileHandle.write("%i %i" % (job.fileStore.jobWrapper.memory, job.fileStore.jobWrapper.disk))
+
+def mapReducer(job, outFile):
+    """
+    Job function that squares the numbers below 95, sums them, and writes the squares, the
+    sum and the sum of no numbers to the out file.
+    """
+    squares = job.map(square, xrange(95), chunkSize=10)
+    total = job.map(square, xrange(95), chunkSize=10).reduce(sumValues, arity=3)
+    noTotal = job.map(square, [], chunkSize=10).reduce(sumValues)
+    job.addFollowOnFn(writeValues, outFile, squares.rv(), total.rv(), noTotal.rv())
+
+def square(i):
+    return i * i
+
+def sumValues(values):
+    assert len(values) <= 10
+    return sum(values)
+
+def writeValues(outFile, *values):
+    """
+    Writes the representation of the tuple of the given values to the out file.
+    """
+    with open(outFile, 'w') as fileHandle:
+        fileHandle.write(repr(values))
+
+def streamWriter(job, outFile, release):
+    """
+    Job function that writes lines to a stream read by a child, released if release is True,
+    which writes them to the out file. Returns the header of the stream file, showing how
+    the stream was passed.
+    """
+    streamID = job.fileStore.createGlobalStream()
+    job.addChildJobFn(streamReader, streamID, outFile, cores=0.1)
+    if release:
+        job.releaseChildren()
+    with job.fileStore.writeGlobalStream(streamID, timeout=30 if release else 1) as fileHandle:
+        for i in xrange(1000):
+            fileHandle.write("%i\n" % i)
+    #The header of the stream file is "done" once streamed data has been read
+    with job.fileStore.jobStore.readFileStream(streamID) as fileHandle:
+        return fileHandle.readline().strip()
+
+def streamReader(job, streamID, outFile):
+    with job.fileStore.readGlobalStream(streamID) as fileHandle:
+        with open(outFile, 'w') as outHandle:
+            outHandle.write(fileHandle.read())
+
+def g(job, outFile):
+    """
+    Job function that creates a child and a follow-on, then behaves as f for the string "B".
+    """
+    job.addChildFn(f, "X", outFile)
+    job.addFollowOnFn(f, "Y", outFile)
+    return f("B", outFile)
+
 if __name__ == '__main__':
     unittest.main()
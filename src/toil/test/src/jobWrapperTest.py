@@ -17,12 +17,20 @@
 from __future__ import absolute_import
 import unittest
 import os
+import time
+import logging
+import marshal
+import cPickle
+import bz2
+import base64
 from toil.lib.bioio import system
 from argparse import ArgumentParser
 from toil.common import setupToil
 from toil.job import Job
 from toil.test import ToilTest
-from toil.jobWrapper import JobWrapper
+from toil.jobWrapper import JobWrapper, ChunkedSuccessors
+
+logger = logging.getLogger(__name__)
 
 class JobWrapperTest(ToilTest):
     
@@ -82,5 +90,127 @@ class JobWrapperTest(ToilTest):
         
         ###TODO test other functionality
 
+    def testChunkedSuccessors(self):
+        """
+        Tests that long lists of successors are stored in chunks, and deleted with the job.
+        """
+        chunkSize = ChunkedSuccessors.chunkSize
+        ChunkedSuccessors.chunkSize = 10
+        try:
+            j = self.jobStore.create("by your command", 1, 1, 1)
+            successors = [ (str(i), 1, 1, 1, None) for i in xrange(25) ]
+            j.stack = [ successors[:5], successors ]
+            ChunkedSuccessors.chunkStack(self.jobStore, j)
+            self.jobStore.update(j)
+        finally:
+            ChunkedSuccessors.chunkSize = chunkSize
+        j = self.jobStore.load(j.jobStoreID)
+        self.assertEquals(j.stack[0], successors[:5])
+        chunkedSuccessors = j.stack[1]
+        self.assertTrue(isinstance(chunkedSuccessors, ChunkedSuccessors))
+        self.assertEquals(len(chunkedSuccessors.chunkIDs), 3)
+        self.assertEquals(len(chunkedSuccessors), 25)
+        self.assertEquals(list(chunkedSuccessors), successors)
+        self.assertEquals(chunkedSuccessors[12], successors[12])
+        self.assertEquals(chunkedSuccessors[-1], successors[-1])
+        self.jobStore.delete(j.jobStoreID)
+        for chunkID in chunkedSuccessors.chunkIDs:
+            self.assertFalse(self.jobStore.fileExists(chunkID))
+
+    def testCleanChunkedSuccessors(self):
+        """
+        Tests that cleaning a job store rewrites the chunks of successors of which some no longer
+        exist, deleting the old chunks.
+        """
+        chunkSize = ChunkedSuccessors.chunkSize
+        ChunkedSuccessors.chunkSize = 10
+        try:
+            j = self.jobStore.create("by your command", 1, 1, 1)
+            successors = [ (self.jobStore.create("successor", 1, 1, 1).jobStoreID, 1, 1, 1, None)
+                           for i in xrange(25) ]
+            j.stack = [ successors ]
+            ChunkedSuccessors.chunkStack(self.jobStore, j)
+            self.jobStore.update(j)
+            oldChunkIDs = j.stack[0].chunkIDs
+            for successor in successors[:3]:
+                self.jobStore.delete(successor[0])
+            self.jobStore.clean()
+        finally:
+            ChunkedSuccessors.chunkSize = chunkSize
+        j = self.jobStore.load(j.jobStoreID)
+        self.assertTrue(isinstance(j.stack[0], ChunkedSuccessors))
+        self.assertEquals(list(j.stack[0]), successors[3:])
+        for chunkID in oldChunkIDs:
+            self.assertFalse(self.jobStore.fileExists(chunkID))
+
+    def _makeJob(self, successorNumber):
+        """
+        Returns a JobWrapper with a stack holding the given number of successors, and a
+        ChunkedSuccessors instance.
+        """
+        j = JobWrapper("_toil abcdef0123456789 /path/to/script toil.test.module", 2147483648, 1.0,
+                       2147483648, "tmp/a/b/jobABCDEF", 3, "0123456789abcdef0123456789abcdef", 2,
+                       predecessorsFinished=set(("tmp/c/d/job123456",)))
+        j.stack = [ [ ("tmp/%i/%i/jobABCDEF" % (i, i), 2147483648, 1.0, 2147483648, 1)
+                      for i in xrange(successorNumber) ],
+                    ChunkedSuccessors(self.jobStorePath, ["tmp/e/f/chunk1", "tmp/e/f/chunk2"],
+                                      1500, 1000) ]
+        return j
+
+    def testEncode(self):
+        """
+        Tests that jobs are decoded as they were encoded with each compression, and that the
+        job store reads jobs written by earlier versions.
+        """
+        j = self._makeJob(10)
+        for compression in ("none", "zlib", "bz2"):
+            data = j.encode(compression)
+            self.assertTrue(JobWrapper.isEncoded(data))
+            self.assertEquals(JobWrapper.decode(data).toDict(), j.toDict())
+        self.assertFalse(JobWrapper.isEncoded(marshal.dumps(j.toDict())))
+        self.assertRaises(ValueError, JobWrapper.decode, marshal.dumps(j.toDict()))
+        
+        j = self.jobStore.create("by your command", 1, 1, 1)
+        with open(self.jobStore._getJobFileName(j.jobStoreID), 'w') as f:
+            marshal.dump(j.toDict(), f)
+        self.assertEquals(self.jobStore.load(j.jobStoreID).toDict(), j.toDict())
+
+    def testEncodingBenchmark(self):
+        """
+        Compares the time taken to encode and decode a job, and the size of the job, between
+        the serialisations used by the job stores before JobWrapper.encode and the encodings
+        with each compression.
+        """
+        j = self._makeJob(100)
+        codecs = [ ("marshal of dict (file)",
+                    lambda j: marshal.dumps(j.toDict()),
+                    lambda data: JobWrapper.fromDict(marshal.loads(data))),
+                   ("pickle+bz2+base64 (aws/azure)",
+                    lambda j: base64.b64encode(bz2.compress(cPickle.dumps(j))),
+                    lambda data: cPickle.loads(bz2.decompress(base64.b64decode(data)))) ]
+        for compression in ("none", "zlib", "bz2"):
+            codecs.append(("encode %s" % compression,
+                           lambda j, compression=compression: j.encode(compression),
+                           JobWrapper.decode))
+            codecs.append(("encode %s+base64" % compression,
+                           lambda j, compression=compression: base64.b64encode(j.encode(compression)),
+                           lambda data: JobWrapper.decode(base64.b64decode(data))))
+        sizes = {}
+        for name, encode, decode in codecs:
+            start = time.time()
+            for i in xrange(100):
+                data = encode(j)
+            encodeTime = (time.time() - start) * 10
+            start = time.time()
+            for i in xrange(100):
+                decode(data)
+            decodeTime = (time.time() - start) * 10
+            self.assertEquals(decode(data).toDict(), j.toDict())
+            sizes[name] = len(data)
+            logger.info("%-32s encode %7.3f ms decode %7.3f ms size %6i bytes",
+                        name, encodeTime, decodeTime, len(data))
+        self.assertTrue(sizes["encode none"] < sizes["marshal of dict (file)"])
+        self.assertTrue(sizes["encode zlib+base64"] < sizes["pickle+bz2+base64 (aws/azure)"])
+
 if __name__ == '__main__':
     unittest.main()
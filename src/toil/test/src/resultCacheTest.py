@@ -0,0 +1,122 @@
+# Copyright (C) 2015 UCSC Computational Genomics Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+import os
+
+from toil.lib.bioio import getTempFile
+from toil.job import Job, FileID
+from toil.common import loadJobStore, Config
+from toil.resultCache import ResultCache
+from toil.utils.toilStats import getStats, processData
+from toil.test import ToilTest
+
+class ResultCacheTest(ToilTest):
+    """
+    Tests the cross-run cache of job results
+    """
+    def testResultCache(self):
+        """
+        Runs the same workflow twice with different job stores but the same result cache, checking
+        that the producing job and the job consuming its output file are only run once, though
+        the ID of the file differs between the runs, and that the output files are restored.
+        """
+        tempDir = self._createTempDir()
+        counterFile = getTempFile(rootDir=tempDir)
+        cacheDir = os.path.join(tempDir, "cache")
+        for i in xrange(2):
+            # The job writing the local output file differs between the runs, so is run each time
+            outFile = os.path.join(tempDir, "out%i" % i)
+            options = Job.Runner.getDefaultOptions(self._getTestJobStorePath())
+            options.logLevel = "INFO"
+            options.resultCache = cacheDir
+            options.stats = True
+            producer = Job.wrapJobFn(produce, "hello", counterFile)
+            consumer = producer.addChildJobFn(consume, producer.rv(), counterFile)
+            consumer.addChildJobFn(export, consumer.rv(), outFile)
+            Job.Runner.startToil(producer, options)
+            # The producer and consumer only run the first time around
+            with open(counterFile, 'r') as fileHandle:
+                self.assertEquals(fileHandle.read(), "xy")
+            with open(outFile, 'r') as fileHandle:
+                self.assertEquals(fileHandle.read(), "HELLO")
+            # Check the hits and misses are reported
+            jobStore = loadJobStore(options.jobStore)
+            collatedStats = processData(jobStore.config, getStats(options), options)
+            self.assertEquals(collatedStats.attrib["cache_hits"], str(2 * i))
+            self.assertEquals(collatedStats.attrib["cache_misses"], str(3 - 2 * i))
+            jobStore.deleteJobStore()
+
+    def testKey(self):
+        """
+        Checks that only the FileIDs held by a job are replaced by the hashes of the content of
+        the files in its key, and that the other files it reads are checked on lookup.
+        """
+        jobStore = loadJobStore(self._getTestJobStorePath(), config=Config())
+        try:
+            resultCache = ResultCache(os.path.join(self._createTempDir(), "cache"))
+            def writeFile(content):
+                with jobStore.writeFileStream() as (fileHandle, jobStoreFileID):
+                    fileHandle.write(content)
+                return jobStoreFileID
+            fileID1, fileID2 = FileID(writeFile("a")), FileID(writeFile("a"))
+            key1, keyedFileIDs = resultCache.getKey(Job.wrapJobFn(export, fileID1, "x"), jobStore)
+            self.assertEquals(keyedFileIDs, set([ fileID1 ]))
+            self.assertEquals(key1, resultCache.getKey(Job.wrapJobFn(export, fileID2, "x"),
+                                                       jobStore)[0])
+            # Plain strings are not replaced, even if they are the IDs of files
+            key2, keyedFileIDs = resultCache.getKey(Job.wrapJobFn(export, str(fileID1), "x"),
+                                                    jobStore)
+            self.assertEquals(keyedFileIDs, set())
+            self.assertNotEquals(key2, resultCache.getKey(Job.wrapJobFn(export, str(fileID2), "x"),
+                                                          jobStore)[0])
+            # Files read by the job outside of the key invalidate the entry when they change
+            readFileID = writeFile("b")
+            resultCache.store(key2, jobStore, readFiles=set([ readFileID ]), writtenFiles={},
+                              deletedFiles=set(), returnValues=None, loggingMessages=[])
+            self.assertIsNotNone(resultCache.lookup(key2, jobStore))
+            with jobStore.updateFileStream(readFileID) as fileHandle:
+                fileHandle.write("c")
+            self.assertIsNone(resultCache.lookup(key2, jobStore))
+        finally:
+            jobStore.deleteJobStore()
+
+def produce(job, string, counterFile):
+    """
+    Appends to the counter file and writes the string to a global file, returning its ID.
+    """
+    with open(counterFile, 'a') as fileHandle:
+        fileHandle.write("x")
+    with job.fileStore.writeGlobalFileStream() as (fileHandle, fileStoreID):
+        fileHandle.write(string)
+    return fileStoreID
+
+def consume(job, fileStoreID, counterFile):
+    """
+    Appends to the counter file and writes the given global file, in upper case, to another
+    global file, returning its ID.
+    """
+    with open(counterFile, 'a') as fileHandle:
+        fileHandle.write("y")
+    with job.fileStore.readGlobalFileStream(fileStoreID) as fileHandle:
+        with job.fileStore.writeGlobalFileStream() as (outFileHandle, outFileStoreID):
+            outFileHandle.write(fileHandle.read().upper())
+    return outFileStoreID
+
+def export(job, fileStoreID, outFile):
+    """
+    Copies the given global file to the output file.
+    """
+    with job.fileStore.readGlobalFileStream(fileStoreID) as fileHandle:
+        with open(outFile, 'w') as outFileHandle:
+            outFileHandle.write(fileHandle.read())
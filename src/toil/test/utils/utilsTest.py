@@ -14,6 +14,7 @@
 from __future__ import absolute_import
 import unittest
 import os
+import pstats
 from subprocess import CalledProcessError
 
 from toil.lib.bioio import system
@@ -124,14 +125,15 @@ class UtilsTest(ToilTest):
             
     def testUtilsStatsSort(self):
         """
-        Tests the stats commands on a complete run of the stats test.
+        Tests the stats commands on a complete run of the stats test, including the report of
+        the profiles of the jobs that split the file.
         """
         # Get the sort command to run
         toilCommandString = ("{self.sort} "
                              "{self.toilDir} "
                              "--logLevel=DEBUG "
                              "--fileToSort={self.tempFile} "
-                             "--N {self.N} --stats "
+                             "--N {self.N} --stats --profileJobs down "
                              "--retryCount 99".format(**locals()))
 
         # Run the script for the first time
@@ -144,6 +146,18 @@ class UtilsTest(ToilTest):
                            "{self.toilDir} --pretty".format(**locals()))
         system(toilStatsString)
 
+        # Check the profiles of the down jobs are merged
+        profileDir = os.path.join(self.tempDir, "profiles")
+        toilStatsString = ("{self.toilMain} stats "
+                           "{self.toilDir} --profile "
+                           "--profileDir {profileDir}".format(**locals()))
+        system(toilStatsString)
+        profileFiles = os.listdir(profileDir)
+        self.assertEquals(len(profileFiles), 1)
+        self.assertTrue(profileFiles[0].endswith(".down.prof"))
+        profile = pstats.Stats(os.path.join(profileDir, profileFiles[0]))
+        self.assertTrue(any(function[2] == "down" for function in profile.stats))
+
         # Check the file is properly sorted
         with open(self.tempFile, 'r') as fileHandle:
             l2 = fileHandle.readlines()
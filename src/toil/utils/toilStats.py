@@ -21,6 +21,8 @@ import sys
 import xml.etree.ElementTree as ET  # not cElementTree so as to allow caching
 from xml.dom import minidom  # For making stuff pretty
 import os
+import marshal
+import pstats
 from toil.lib.bioio import getBasicOptionParser
 from toil.lib.bioio import parseBasicOptions
 from toil.common import loadJobStore
@@ -117,6 +119,21 @@ def initializeOptions(parser):
     parser.add_argument("--sortReverse", "--reverseSort", default=False,
                       action="store_true",
                       help="reverse sort order.")
+    parser.add_argument("--profile", action="store_true", default=False,
+                      help=("report the profiles of the jobs run under cProfile (see the "
+                            "--profileJobs and --profileRate options of toil), merged across "
+                            "the jobs of each job class, instead of the stats."))
+    parser.add_argument("--profileSort", default="cumulative",
+                      help=("how to sort the functions of the profiles, as for "
+                            "pstats.Stats.sort_stats. default=%(default)s"))
+    parser.add_argument("--profileLines", type=int, default=20,
+                      help=("the number of functions to report from the profile of each job "
+                            "class. default=%(default)s"))
+    parser.add_argument("--profileDir", default=None,
+                      help=("directory in which to write the merged profile of each job class, "
+                            "as a file named after the class in the format written by "
+                            "pstats.Stats.dump_stats, which can be read by pstats and by "
+                            "profile viewers and flame graph generators."))
     parser.add_argument("--version", action='version', version=version)
     #parser.add_option("--cache", default=False, action="store_true",
     #                  help="stores a cache to speed up data display.")
@@ -435,6 +452,26 @@ def reportPrettyData(root, worker, job, job_types, options):
         reportTime(get(root, "total_clock"), options),
         reportTime(get(root, "total_run_time"), options),
         ))
+    if "cache_hits" in root.attrib:
+        out_str += ("Result Cache Hits: %s  Misses: %s\n" % (
+            reportNumber(get(root, "cache_hits"), options),
+            reportNumber(get(root, "cache_misses"), options),
+            ))
+    if "downloaded_bytes" in root.attrib:
+        out_str += ("Downloaded: %s  Download Time: %s  Throughput: %s/s\n" % (
+            reportMemory(get(root, "downloaded_bytes"), options, isBytes=True),
+            reportTime(get(root, "download_time"), options),
+            reportMemory(get(root, "download_throughput"), options, isBytes=True),
+            ))
+    if "compression_saved_bytes" in root.attrib:
+        out_str += ("Saved by File Compression: %s\n" % (
+            reportMemory(get(root, "compression_saved_bytes"), options, isBytes=True),
+            ))
+    if "storage_bytes" in root.attrib:
+        out_str += ("Stored: %s  Peak Stored: %s\n" % (
+            reportMemory(get(root, "storage_bytes"), options, isBytes=True),
+            reportMemory(get(root, "storage_peak_bytes"), options, isBytes=True),
+            ))
     job_types = sortJobs(job_types, options)
     columnWidths = computeColumnWidths(job_types, worker, job, options)
     out_str += "Worker\n"
@@ -595,6 +632,33 @@ def processData(config, stats, options):
         return list(worker.findall("job"))
     createSummary(buildElement(collatedStatsTag, jobs, "job"),
                   workers, "worker", fn4)
+    # Add result cache info, if the cache was used
+    cacheLookups = [ job.attrib["cache"] for job in jobs if "cache" in job.attrib ]
+    if len(cacheLookups) > 0:
+        collatedStatsTag.attrib["cache_hits"] = str(cacheLookups.count("hit"))
+        collatedStatsTag.attrib["cache_misses"] = str(cacheLookups.count("miss"))
+    # Add the throughput of the concurrent downloads of global files, if any
+    downloads = [ job for job in jobs if "downloaded_bytes" in job.attrib ]
+    if len(downloads) > 0:
+        downloadedBytes = sum(float(job.attrib["downloaded_bytes"]) for job in downloads)
+        downloadTime = sum(float(job.attrib["download_time"]) for job in downloads)
+        collatedStatsTag.attrib["downloaded_bytes"] = str(downloadedBytes)
+        collatedStatsTag.attrib["download_time"] = str(downloadTime)
+        collatedStatsTag.attrib["download_throughput"] = str(
+            downloadedBytes / downloadTime if downloadTime > 0 else 0.0)
+    # Add the bytes saved by compressing global files, if any
+    compressed = [ job for job in jobs if "compression_saved_bytes" in job.attrib ]
+    if len(compressed) > 0:
+        collatedStatsTag.attrib["compression_saved_bytes"] = str(
+            sum(float(job.attrib["compression_saved_bytes"]) for job in compressed))
+    # Add the storage used by global files over time, if recorded, see toil.leader.FileCollector
+    storage = stats.findall("storage")
+    if len(storage) > 0:
+        collatedStatsTag.attrib["storage_bytes"] = storage[-1].attrib["bytes"]
+        collatedStatsTag.attrib["storage_peak_bytes"] = storage[-1].attrib["peak_bytes"]
+        storageTag = ET.SubElement(collatedStatsTag, "storage")
+        for sample in storage:
+            ET.SubElement(storageTag, "sample", sample.attrib)
     # Get info for each job
     jobNames = set()
     for job in jobs:
@@ -607,6 +671,48 @@ def processData(config, stats, options):
         jobTypeTag = buildElement(jobTypesTag, jobTypes, jobName)
     return collatedStatsTag
 
+class StoredProfile(object):
+    """
+    A profile written by a job to the job store, see toil.job.Job._addStats, in the form
+    accepted by pstats.Stats.
+    """
+    def __init__(self, jobStore, profileFileID):
+        with jobStore.readFileStream(profileFileID) as fileHandle:
+            self.stats = marshal.loads(fileHandle.read())
+
+    def create_stats(self):
+        pass
+
+def getProfiles(jobStore, stats):
+    """ Return a dictionary of the names of the profiled job classes to
+    pstats.Stats objects merging the profiles of their jobs.
+    """
+    profiles = {}
+    for job in stats.iter("job"):
+        if "profile" not in job.attrib:
+            continue
+        profile = StoredProfile(jobStore, job.attrib["profile"])
+        jobName = job.attrib["class"]
+        if jobName in profiles:
+            profiles[jobName].add(profile)
+        else:
+            profiles[jobName] = pstats.Stats(profile, stream=sys.stdout)
+    return profiles
+
+def reportProfiles(profiles, options):
+    """ Print the ranked functions of the profile of each job class, writing
+    the profiles to the profile directory if given.
+    """
+    if len(profiles) == 0:
+        print "No jobs were profiled, see the --profileJobs and --profileRate options of toil."
+    for jobName in sorted(profiles.keys()):
+        print "Profile of %s" % jobName
+        profiles[jobName].sort_stats(options.profileSort).print_stats(options.profileLines)
+        if options.profileDir is not None:
+            if not os.path.exists(options.profileDir):
+                os.makedirs(options.profileDir)
+            profiles[jobName].dump_stats(os.path.join(options.profileDir, jobName + ".prof"))
+
 def reportData(xml_tree, options):
     # Now dump it all out to file
     if options.raw:
@@ -734,6 +840,9 @@ def main():
     #collatedStatsTag = cacheAvailable(options)
     #if collatedStatsTag is None:
     stats = getStats(options)
+    if options.profile:
+        reportProfiles(getProfiles(jobStore, stats), options)
+        return
     collatedStatsTag = processData(jobStore.config, stats, options)
     reportData(collatedStatsTag, options)
     #packData(collatedStatsTag, options)
@@ -74,6 +74,7 @@ def main():
     from toil.lib.bioio import system
     from toil.common import loadJobStore
     from toil.job import Job
+    from toil.jobWrapper import ChunkedSuccessors
     
     ########################################## 
     #Input args
@@ -88,6 +89,12 @@ def main():
     
     jobStore = loadJobStore(jobStoreString)
     config = jobStore.config
+    
+    #A job released by a job that then failed is deleted, and may be run after being
+    #deleted, see toil.job.Job.releaseChildren
+    if not jobStore.exists(jobStoreID):
+        logger.warn("The job %s has been withdrawn, so is not run", jobStoreID)
+        return
 
     ##########################################
     #Load the environment for the job
@@ -247,8 +254,9 @@ def main():
                     system(job.command)
             else:
                 #The command may be none, in which case
-                #the job is just a shell ready to be deleted
-                assert len(job.stack) == 0
+                #the job is just a shell ready to be deleted, or a job released by
+                #its predecessor (see Job.releaseChildren) that the leader issued
+                #before being told of its release, whose successors are left to the leader
                 break
             
             ##########################################
@@ -272,6 +280,9 @@ def main():
             #We check the requirements of the job to see if we can run it
             #within the current worker
             successorJobStoreID, successorMemory, successorCores, successorsDisk, successorPredecessorID = jobs[0]
+            if successorMemory is None or successorCores is None or successorsDisk is None:
+                logger.debug("The requirements of the next job are computed by the leader, so finishing")
+                break
             if successorMemory > job.memory:
                 logger.debug("We need more memory for the next job, so finishing")
                 break
@@ -294,11 +305,17 @@ def main():
             #wholly incorporated into the current job.
             ##########################################
             
-            #Remove the successor job
-            job.stack.pop()
-            
             #Load the successor job
             successorJob = jobStore.load(successorJobStoreID)
+            
+            #A job released by the job while running (see Job.releaseChildren) has
+            #no command and is already known to the leader
+            if successorJob.command == None:
+                logger.debug("The next job was released by the job, we must return to the leader.")
+                break
+            
+            #Remove the successor job
+            job.stack.pop()
             #These should all match up
             assert successorJob.memory == successorMemory
             assert successorJob.cores == successorCores
@@ -309,7 +326,11 @@ def main():
             
             #Transplant the command and stack to the current job
             job.command = successorJob.command
-            job.stack += successorJob.stack
+            #Chunked lists of successors are associated with the successor job, so
+            #must be copied, as the successor job is deleted
+            job.stack += [ ChunkedSuccessors.create(jobStore, job.jobStoreID, successors)
+                           if isinstance(successors, ChunkedSuccessors) else successors
+                           for successors in successorJob.stack ]
             assert job.memory >= successorJob.memory
             assert job.cores >= successorJob.cores
             
@@ -318,9 +339,8 @@ def main():
             jobStore.update(job)
             jobStore.delete(successorJob.jobStoreID)
             
-            #Remove any jobs that the user specified should be removed during the job
-            for f in fileStoreIDsToDelete:
-                jobStore.delete(f)
+            #Remove any files that the user specified should be removed during the job
+            jobStore.deleteFiles(fileStoreIDsToDelete)
             
             logger.debug("Starting the next job")
         
@@ -397,8 +417,7 @@ def main():
     #This must happen after the log file is done with, else there is no place to put the log
     if (not workerFailed) and job.command == None and len(job.stack) == 0:
         #Delete files the user specified should be deleted
-        for f in fileStoreIDsToDelete:
-            jobStore.delete(f)
+        jobStore.deleteFiles(fileStoreIDsToDelete)
         #We can now safely get rid of the job
         jobStore.delete(job.jobStoreID)
         